@@ -0,0 +1,366 @@
+import os
+import json
+import hashlib
+from datetime import datetime, timezone, timedelta
+from functools import wraps
+from flask import Blueprint, current_app, request
+from sqlalchemy import select
+from database import get_db, Trip, Participant, Expense, ExpenseShare, Category, TripParticipantDefaultProportion, DeletedExpense, TripSnapshot
+import ledger
+from query_budget import query_budget
+from caching import get_versions, trip_key, CATEGORIES_KEY, TRIPS_KEY
+from pagination import paginate_expenses, paginate_changes, EXPENSES_PER_PAGE
+
+try:
+    import orjson
+except ImportError: # Listed in requirements.txt; the standard json module is only a fallback
+    orjson = None
+
+# JSON API (/api/v1) for clients that keep their own copy of trips.
+#
+# - Compact responses: `fields=id,amount,...` selects the fields of the listed
+#   items, and only the columns (and joins) those fields need are queried.
+# - ETags: responses are keyed by the version counters the web routes bump
+#   (see caching.py), so an unchanged resource is answered with a 304 after a
+#   single query.
+# - Delta sync: /trips/<id>/expenses?since=<timestamp> returns the expenses
+#   modified after the timestamp and the ids of those deleted since then
+#   (DeletedExpense tombstones). Clients apply `deleted` first, then upsert
+#   `expenses`, and pass `next_since` to their next sync.
+# - Archived trips (see trip_archive.py) keep their participants and balances;
+#   their expenses are not listed (409) until they are unarchived.
+#
+# The resources are plain functions of a database session and an ApiRequest,
+# registered on the blueprint from ROUTES; asgi.py serves the same ROUTES
+# natively with an AsyncSession.
+
+API_VERSION = 'v1'
+
+# Largest page of expenses a client can ask for
+API_MAX_PER_PAGE = int(os.environ.get("API_MAX_PER_PAGE", 500))
+# Seconds subtracted from next_since, so changes whose transaction committed
+# after a sync had read the table are returned by the next one
+API_SYNC_OVERLAP = int(os.environ.get("API_SYNC_OVERLAP", 5))
+
+api_blueprint = Blueprint('api_blueprint', __name__, url_prefix=f'/api/{API_VERSION}')
+
+
+def _timestamp(value):
+    """Formats a naive UTC datetime as ISO 8601 with a Z suffix."""
+    return value.isoformat() + 'Z' if value else None
+
+
+def _date(value):
+    return value.strftime('%Y-%m-%d') if value else None
+
+
+def _weights(weights):
+    # JSON object keys are strings
+    return {str(participant_id): weight for participant_id, weight in weights.items()}
+
+
+# Fields of the listed items: name -> formatter of the column value
+TRIP_FIELDS = {
+    'id': None,
+    'name': None,
+    'created_at': _timestamp,
+    'updated_at': _timestamp,
+}
+PARTICIPANT_FIELDS = {
+    'id': None,
+    'name': None,
+    'avatar': None,
+    'default_weight': None,
+    'updated_at': _timestamp,
+}
+EXPENSE_FIELDS = {
+    'id': None,
+    'description': None,
+    'amount': None,
+    'expense_date': _date,
+    'paid_by_id': None,
+    'category_id': None,
+    'category': None, # Category name
+    'weights': _weights, # {participant_id: weight}
+    'date_added': _timestamp,
+    'last_modified': _timestamp,
+}
+# Sections of the single trip resource
+TRIP_DETAIL_FIELDS = [*TRIP_FIELDS, 'participants', 'balances', 'transactions']
+
+
+class ApiError(Exception):
+    """An error reported to the client as {"error": message} with an HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api_blueprint.errorhandler(ApiError)
+def handle_api_error(error):
+    return json_response({'error': error.message}, error.status)
+
+
+class ApiRequest:
+    """The parts of an HTTP request the resources read, so that they do not depend on Flask's request."""
+
+    def __init__(self, path, args, if_none_match):
+        self.path = path
+        self.args = args # werkzeug MultiDict of the query string
+        self.if_none_match = if_none_match # werkzeug ETags of the If-None-Match header
+
+    @classmethod
+    def from_flask(cls):
+        return cls(request.path, request.args, request.if_none_match)
+
+    def etag(self, db, keys):
+        """ETag of the request from the versions of keys (one query) and the request's arguments."""
+        versions = get_versions(db, keys)
+        arguments = sorted(self.args.items(multi=True))
+        return hashlib.sha1(repr((API_VERSION, self.path, arguments, sorted(versions.items()))).encode()).hexdigest()
+
+    def has(self, etag):
+        """True if the client already has the representation with this ETag."""
+        return etag in self.if_none_match
+
+
+def encode_json(payload):
+    """Encodes payload with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(encode_json(payload), status=status, mimetype='application/json')
+
+
+def parse_fields(args, allowed):
+    """Returns the fields selected by the `fields` argument (all allowed fields by default), in the allowed order."""
+    fields = args.get('fields')
+    if not fields:
+        return list(allowed)
+    requested = {field.strip() for field in fields.split(',') if field.strip()}
+    unknown = requested.difference(allowed)
+    if unknown:
+        raise ApiError(f"Unknown field(s): {', '.join(sorted(unknown))}. Available fields: {', '.join(allowed)}.")
+    return [field for field in allowed if field in requested]
+
+
+def parse_since(value):
+    """Parses an ISO 8601 timestamp into a naive UTC datetime (timestamps without offset are UTC)."""
+    try:
+        since = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ApiError(f"Invalid since timestamp '{value}'. Expected ISO 8601, e.g. 2024-05-01T12:00:00Z.")
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+def parse_per_page(args):
+    per_page = args.get('per_page', EXPENSES_PER_PAGE, type=int)
+    if not 1 <= per_page <= API_MAX_PER_PAGE:
+        raise ApiError(f"per_page must be between 1 and {API_MAX_PER_PAGE}.")
+    return per_page
+
+
+def serialize(row, fields, formatters, values=None):
+    """Item of the selected fields of a row; `values` provides fields that are not columns of the row."""
+    item = {}
+    for field in fields:
+        value = values[field] if values and field in values else getattr(row, field)
+        formatter = formatters[field]
+        item[field] = formatter(value) if formatter and value is not None else value
+    return item
+
+
+def trip_exists(db, trip_id):
+    if db.scalar(select(Trip.id).where(Trip.id == trip_id)) is None:
+        raise ApiError("Trip not found", 404)
+
+
+def live_trip_exists(db, trip_id):
+    """Like trip_exists, for the resources reading expense rows, which archived trips do not have."""
+    row = db.execute(
+        select(Trip.id, TripSnapshot.trip_id).outerjoin(TripSnapshot, TripSnapshot.trip_id == Trip.id).where(Trip.id == trip_id)
+    ).first()
+    if row is None:
+        raise ApiError("Trip not found", 404)
+    if row[1] is not None:
+        raise ApiError("Trip is archived: its expenses are not listed until it is unarchived.", 409)
+
+
+def participant_rows(db, trip_id, fields):
+    """The participants of a trip, with their default weight when selected."""
+    columns = [Participant.id, Participant.name, Participant.avatar_url.label('avatar'), Participant.updated_at]
+    query = select(*columns).where(Participant.trip_id == trip_id).order_by(Participant.id)
+    if 'default_weight' in fields:
+        query = query.add_columns(TripParticipantDefaultProportion.default_proportion.label('default_weight')).outerjoin(
+            TripParticipantDefaultProportion,
+            (TripParticipantDefaultProportion.trip_id == Participant.trip_id)
+            & (TripParticipantDefaultProportion.participant_id == Participant.id)
+        )
+    return db.execute(query).all()
+
+
+def expense_query(db, trip_id, fields):
+    """
+    Column query for the expenses of a trip with the selected fields.
+
+    The keyset columns of both paginations are always selected; the category
+    is only joined when its name is requested.
+    """
+    columns = [Expense.id, Expense.expense_date, Expense.date_added, Expense.last_modified]
+    columns += [getattr(Expense, field) for field in ('description', 'amount', 'paid_by_id', 'category_id') if field in fields]
+    query = db.query(*columns).filter(Expense.trip_id == trip_id)
+    if 'category' in fields:
+        query = query.add_columns(Category.name.label('category')).outerjoin(Category, Category.id == Expense.category_id)
+    return query
+
+
+def expense_items(db, rows, fields):
+    """Serializes a page of expense rows, loading the weights of the whole page with one query when selected."""
+    weights = {}
+    if 'weights' in fields and rows:
+        shares = db.execute(
+            select(ExpenseShare.expense_id, ExpenseShare.participant_id, ExpenseShare.weight)
+            .where(ExpenseShare.expense_id.in_([row.id for row in rows]))
+        )
+        for expense_id, participant_id, weight in shares:
+            weights.setdefault(expense_id, {})[participant_id] = weight
+
+    return [serialize(row, fields, EXPENSE_FIELDS, {'weights': weights.get(row.id, {})}) for row in rows]
+
+
+# Resources: each returns (payload, etag). The payload is None when the client
+# already has the current representation (304); delta responses have no ETag.
+
+def list_trips(db, api_request):
+    """All trips."""
+    etag = api_request.etag(db, [TRIPS_KEY])
+    if api_request.has(etag):
+        return None, etag
+
+    fields = parse_fields(api_request.args, list(TRIP_FIELDS))
+    rows = db.execute(select(Trip.id, Trip.name, Trip.created_at, Trip.updated_at).order_by(Trip.id)).all()
+    return {'trips': [serialize(row, fields, TRIP_FIELDS) for row in rows]}, etag
+
+
+def get_trip(db, api_request, trip_id):
+    """A trip with its participants, balances and settlement transactions; `fields` selects the sections."""
+    etag = api_request.etag(db, [trip_key(trip_id)])
+    if api_request.has(etag):
+        return None, etag
+
+    fields = parse_fields(api_request.args, TRIP_DETAIL_FIELDS)
+    trip = db.execute(select(Trip.id, Trip.name, Trip.created_at, Trip.updated_at).where(Trip.id == trip_id)).first()
+    if trip is None:
+        raise ApiError("Trip not found", 404)
+
+    payload = serialize(trip, [field for field in fields if field in TRIP_FIELDS], TRIP_FIELDS)
+    if 'participants' in fields:
+        participant_fields = list(PARTICIPANT_FIELDS)
+        payload['participants'] = [
+            serialize(row, participant_fields, PARTICIPANT_FIELDS) for row in participant_rows(db, trip_id, participant_fields)
+        ]
+    if 'balances' in fields or 'transactions' in fields:
+        balances, transactions = ledger.get_trip_balances(db, trip_id)
+        if 'balances' in fields:
+            payload['balances'] = balances
+        if 'transactions' in fields:
+            payload['transactions'] = transactions
+    return payload, etag
+
+
+def list_participants(db, api_request, trip_id):
+    """The participants of a trip."""
+    etag = api_request.etag(db, [trip_key(trip_id)])
+    if api_request.has(etag):
+        return None, etag
+
+    fields = parse_fields(api_request.args, list(PARTICIPANT_FIELDS))
+    trip_exists(db, trip_id)
+    rows = participant_rows(db, trip_id, fields)
+    return {'participants': [serialize(row, fields, PARTICIPANT_FIELDS) for row in rows]}, etag
+
+
+def get_balances(db, api_request, trip_id):
+    """The balances of a trip's participants and the transactions that settle them."""
+    etag = api_request.etag(db, [trip_key(trip_id)])
+    if api_request.has(etag):
+        return None, etag
+
+    trip_exists(db, trip_id)
+    balances, transactions = ledger.get_trip_balances(db, trip_id)
+    return {'balances': balances, 'transactions': transactions}, etag
+
+
+def list_expenses(db, api_request, trip_id):
+    """
+    The expenses of a trip, one page at a time (most recent first).
+
+    With `since`, returns the expenses modified after that timestamp instead
+    (oldest change first) and, on the last page, the ids of the expenses
+    deleted since then together with the `next_since` of the next sync.
+    Delta responses depend on the time they are made and have no ETag.
+    """
+    args = api_request.args
+    since = args.get('since')
+    cursor = args.get('cursor')
+    fields = parse_fields(args, list(EXPENSE_FIELDS))
+    per_page = parse_per_page(args)
+
+    if since:
+        since = parse_since(since)
+        # Taken before reading, so that nothing committed during the sync is skipped by the next one
+        sync_started = datetime.utcnow()
+        live_trip_exists(db, trip_id)
+        rows, next_cursor = paginate_changes(expense_query(db, trip_id, fields), since, cursor, per_page)
+        payload = {'since': _timestamp(since), 'expenses': expense_items(db, rows, fields), 'next_cursor': next_cursor}
+        if next_cursor is None:
+            payload['deleted'] = list(db.scalars(
+                select(DeletedExpense.expense_id)
+                .where(DeletedExpense.trip_id == trip_id, DeletedExpense.deleted_at > since)
+                .order_by(DeletedExpense.deleted_at, DeletedExpense.id)
+            ))
+            payload['next_since'] = _timestamp(sync_started - timedelta(seconds=API_SYNC_OVERLAP))
+        return payload, None
+
+    etag = api_request.etag(db, [trip_key(trip_id), CATEGORIES_KEY])
+    if api_request.has(etag):
+        return None, etag
+
+    live_trip_exists(db, trip_id)
+    rows, next_cursor = paginate_expenses(expense_query(db, trip_id, fields), cursor, per_page)
+    return {'expenses': expense_items(db, rows, fields), 'next_cursor': next_cursor}, etag
+
+
+# (URL rule, resource, query budget) of every API endpoint
+ROUTES = [
+    ('/trips', list_trips, {'queries': 3, 'rows': 0}),
+    ('/trips/<int:trip_id>', get_trip, {'queries': 6}),
+    ('/trips/<int:trip_id>/participants', list_participants, {'queries': 3, 'rows': 0}),
+    ('/trips/<int:trip_id>/balances', get_balances, {'queries': 5}),
+    ('/trips/<int:trip_id>/expenses', list_expenses, {'queries': 5, 'rows': 0}),
+]
+
+
+def flask_view(resource):
+    """Flask view serving a resource with the request's session."""
+    @wraps(resource)
+    def view(**ids):
+        payload, etag = resource(get_db(), ApiRequest.from_flask(), **ids)
+        response = current_app.response_class(status=304) if payload is None else json_response(payload)
+        if etag:
+            response.set_etag(etag)
+            # Clients keep the response but revalidate it on every use
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return view
+
+
+for rule, resource, budget in ROUTES:
+    api_blueprint.add_url_rule(rule, resource.__name__, query_budget(**budget)(flask_view(resource)))
@@ -1,13 +1,26 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash
+import click
+import logging
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
 # Import necessary models and database session
-from database import init_db, SessionLocal
+from database import init_db, get_db, close_db, get_pool_status
 # Import the trip blueprint
 from trip_blueprint import trip_blueprint
+# Import the JSON API blueprint
+from api_blueprint import api_blueprint
+import query_budget
+import metrics
+from caching import bump_version, TRIPS_KEY
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Log level of the app's modules (slow queries and requests are logged as warnings)
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+)
+
 app = Flask(__name__)
 # Secret key is needed for session management and flashing messages
 app.secret_key = os.environ.get('SECRET_KEY', 'a_super_secret_key')
@@ -17,34 +30,38 @@ app.config['UPLOAD_FOLDER'] = 'uploads'
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 
-# Initialize the database
+# Initialize the database (tables, then pending migrations, see migrations.py)
 init_db()
 
-# Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# One database session per request (or CLI command), closed when the app context ends
+app.teardown_appcontext(close_db)
 
 # Register the trip blueprint
 app.register_blueprint(trip_blueprint)
+# Register the JSON API (/api/v1)
+app.register_blueprint(api_blueprint)
+
+# Count SQL queries and loaded rows per request against the views' budgets
+query_budget.init_app(app)
+# Request latency, SQL and PDF metrics on /metrics, opt-in profiling (X-Profile header)
+metrics.init_app(app)
 
 
 @app.route('/')
 def index():
     """Displays a list of all trips."""
-    db = next(get_db())
+    db = get_db()
     # Import Trip model here as it's used in this route
-    from database import Trip
+    from database import Trip, TripSnapshot
     trips = db.query(Trip).all()
-    return render_template('index.html', trips=trips)
+    # Archived trips are marked in the list
+    archived_trip_ids = {trip_id for (trip_id,) in db.query(TripSnapshot.trip_id)}
+    return render_template('index.html', trips=trips, archived_trip_ids=archived_trip_ids)
 
 @app.route('/create_trip', methods=['GET', 'POST'])
 def create_trip():
     """Handles creating a new trip."""
-    db = next(get_db())
+    db = get_db()
     # Import Trip model here as it's used in this route
     from database import Trip
     if request.method == 'POST':
@@ -52,6 +69,8 @@ def create_trip():
         if trip_name:
             new_trip = Trip(name=trip_name)
             db.add(new_trip)
+            # Invalidate the cached list of trips (API ETags)
+            bump_version(db, TRIPS_KEY)
             db.commit()
             db.refresh(new_trip)
             flash(f"Trip '{trip_name}' created successfully!", 'success')
@@ -64,6 +83,121 @@ def create_trip():
     return render_template('create_trip.html')
 
 
+@app.route('/pool_stats')
+def pool_stats():
+    """Reports the database connection pool usage: checked-out connections, overflow and checkout wait times."""
+    return jsonify(get_pool_status())
+
+
+@app.cli.command('migrate')
+@click.option('--list', 'list_only', is_flag=True, help="Only list the migrations and whether they are applied.")
+def migrate_command(list_only):
+    """Applies the pending schema migrations (see migrations.py)."""
+    import migrations
+    if list_only:
+        applied = migrations.applied_versions()
+        for migration in migrations.MIGRATIONS:
+            status = f"applied {applied[migration.version]:%Y-%m-%d %H:%M}" if migration.version in applied else "pending"
+            click.echo(f"{migration.version:<26} {status:<24} {migration.description}")
+        return
+    versions = migrations.migrate()
+    click.echo(f"Applied {len(versions)} migration(s){': ' + ', '.join(versions) if versions else ''}.")
+
+
+@app.cli.command('import-statement')
+@click.argument('statement', type=click.File('rb'))
+@click.option('--trip-id', type=int, required=True)
+@click.option('--paid-by', type=int, required=True, help="Id of the participant who paid the expenses.")
+@click.option('--positive', is_flag=True, help="Expenses are the positive amounts (negative ones by default).")
+@click.option('--chunk-size', type=int, default=None, help="Lines saved per transaction.")
+def import_statement_command(statement, trip_id, paid_by, positive, chunk_size):
+    """Imports the expenses of a CSV or OFX bank statement into a trip."""
+    import statement_import
+    import trip_archive
+    from database import Participant
+    db = get_db()
+    if db.query(Participant).filter_by(id=paid_by, trip_id=trip_id).first() is None:
+        raise click.BadParameter(f"Participant {paid_by} is not in trip {trip_id}.", param_hint='--paid-by')
+    if trip_archive.is_archived(db, trip_id):
+        raise click.ClickException(f"Trip {trip_id} is archived. Unarchive it before importing expenses.")
+    try:
+        result = statement_import.import_statement(
+            db, trip_id, paid_by, statement, filename=statement.name,
+            expense_sign=statement_import.POSITIVE if positive else statement_import.NEGATIVE, chunk_size=chunk_size,
+        )
+    except statement_import.StatementError as e:
+        raise click.ClickException(str(e))
+
+    for issue in result.issues:
+        click.echo(f"Line {issue.row}: {issue.message}")
+    click.echo(f"Imported {result.imported} expense(s), ignored {result.ignored} line(s) of the other sign, skipped {result.skipped} unreadable line(s).")
+    if result.error:
+        raise click.ClickException(f"The import stopped: {result.error}")
+
+
+@app.cli.command('archive-trip')
+@click.argument('trip_ids', type=int, nargs=-1, required=True)
+@click.option('--unarchive', is_flag=True, help="Restore the expenses of archived trips instead.")
+def archive_trip_command(trip_ids, unarchive):
+    """Archives finished trips into snapshots, or unarchives them (see trip_archive.py)."""
+    import trip_archive
+    db = get_db()
+    for trip_id in trip_ids:
+        try:
+            if unarchive:
+                restored, renumbered = trip_archive.restore_trip(db, trip_id)
+                message = f"Trip {trip_id}: {restored} expense(s) restored" + (f", {renumbered} with a new id." if renumbered else ".")
+            else:
+                snapshot = trip_archive.archive_trip(db, trip_id)
+                message = f"Trip {trip_id}: {snapshot.expense_count} expense(s) archived in {len(snapshot.expenses)} bytes."
+            db.commit()
+        except trip_archive.ArchiveError as e:
+            db.rollback()
+            message = f"Trip {trip_id}: {e}"
+        click.echo(message)
+
+
+@app.cli.command('rebuild-ledger')
+@click.option('--trip-id', type=int, default=None, help="Only rebuild this trip (defaults to all trips).")
+def rebuild_ledger_command(trip_id):
+    """Recomputes the balance ledger from expenses and reports any drift."""
+    import ledger
+    import caching
+    db = get_db()
+    drift = ledger.rebuild_ledger(db, [trip_id] if trip_id else None)
+    # Cached pages of trips whose balances were corrected are stale
+    for drift_trip_id in {drift_trip_id for drift_trip_id, _, _, _ in drift}:
+        caching.bump_trip_version(db, drift_trip_id)
+    db.commit()
+
+    for drift_trip_id, participant_id, ledger_balance, recomputed_balance in drift:
+        click.echo(f"Trip {drift_trip_id}, participant {participant_id}: ledger had {ledger_balance:.2f}, recomputed {recomputed_balance:.2f}")
+    click.echo(f"Ledger rebuilt. {len(drift)} balance(s) differed from the recomputed values.")
+
+
+@app.cli.command('settle-trips')
+@click.option('--chunk-size', type=int, default=1000, help="Number of trips computed per batch.")
+def settle_trips_command(chunk_size):
+    """Prints the balances and transactions of every trip as JSON lines (batch engine)."""
+    import json
+    import batch_settlement
+    db = get_db()
+    for trip_id, balances, transactions in batch_settlement.settle_trips(db, chunk_size=chunk_size):
+        click.echo(json.dumps({'trip_id': trip_id, 'balances': balances, 'transactions': transactions}))
+
+
+@app.cli.command('purge-imports')
+def purge_imports_command():
+    """Deletes staged PDF imports whose TTL has passed and old import jobs."""
+    import import_staging
+    import import_jobs
+    db = get_db()
+    deleted = import_staging.purge_expired_imports(db)
+    deleted_jobs = import_jobs.purge_old_jobs(db)
+    db.commit()
+    click.echo(f"Deleted {deleted} expired import(s) and {deleted_jobs} old import job(s).")
+
+
 if __name__ == '__main__':
     # In a production environment, you would use a production-ready WSGI server
     # like Gunicorn or uWSGI instead of app.run().
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.routing import Map, Rule
+from app import app
+from api_blueprint import api_blueprint, ROUTES, API_VERSION, ApiRequest, ApiError, encode_json
+import metrics
+import query_budget
+
+# ASGI entry point (async serving mode):
+#
+#     uvicorn asgi:application --workers 2
+#
+# The read-only JSON API (api_blueprint.ROUTES) is served natively on the
+# event loop: its resources run on an AsyncSession through run_sync, so a
+# request waiting for the database holds no thread, and one worker can serve
+# many concurrent readers. Every other route (HTML pages, forms, PDF uploads)
+# is handed to the Flask app on a bounded thread pool; PDF parsing itself
+# already runs outside the request, on the import job executor (see
+# import_jobs.py and pdf_extraction.py).
+#
+# Without the async packages of requirements-async.txt, the API is served
+# through the thread pool too.
+
+logger = logging.getLogger(__name__)
+
+# Threads running the synchronous Flask routes
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", 32))
+# Request bodies larger than this many bytes (e.g. PDF uploads) are spooled to disk
+ASGI_SPOOL_BYTES = int(os.environ.get("ASGI_SPOOL_BYTES", 1024 * 1024))
+
+try:
+    from async_database import async_engine, AsyncSessionLocal
+except (ImportError, ValueError) as e:
+    logger.warning("Async database unavailable (%s): the API is served by the synchronous app.", e)
+    async_engine = AsyncSessionLocal = None
+else:
+    # Statement timings and slow query log of the natively served API
+    query_budget.instrument_engine(async_engine.sync_engine)
+
+_wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+
+# URL matcher of the natively served API endpoints
+_api_urls = Map([
+    Rule(f'/api/{API_VERSION}{rule}', endpoint=resource, methods=['GET']) for rule, resource, _ in ROUTES
+]).bind('localhost')
+
+_END = object()
+
+
+async def _read_body(receive):
+    """Reads the request body into a file, spooled to disk past ASGI_SPOOL_BYTES."""
+    body = tempfile.SpooledTemporaryFile(max_size=ASGI_SPOOL_BYTES)
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.write(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body
+
+
+def _wsgi_environ(scope, body):
+    """WSGI environ of an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]) if server[1] is not None else '80',
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True, # The whole body was read, chunked uploads included
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def serve_wsgi(scope, receive, send):
+    """Runs the Flask app for a request on the thread pool, streaming its response."""
+    loop = asyncio.get_running_loop()
+    body = await _read_body(receive)
+    environ = _wsgi_environ(scope, body)
+    response_start = {}
+
+    def start_response(status, headers, exc_info=None):
+        response_start['status'] = int(status.split(' ', 1)[0])
+        response_start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    def start():
+        # The app calls start_response at the latest when it produces its first chunk
+        iterable = app(environ, start_response)
+        iterator = iter(iterable)
+        return iterable, iterator, next(iterator, _END)
+
+    iterable, iterator, chunk = await loop.run_in_executor(_wsgi_executor, start)
+    try:
+        await send({'type': 'http.response.start', 'status': response_start['status'], 'headers': response_start['headers']})
+        while chunk is not _END:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(_wsgi_executor, next, iterator, _END)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(_wsgi_executor, iterable.close)
+        body.close()
+
+
+async def _send_json(send, status, payload=None, etag=None, head=False):
+    headers = [(b'content-type', b'application/json')]
+    body = encode_json(payload) if payload is not None else b''
+    if etag:
+        headers += [(b'etag', quote_etag(etag).encode('latin-1')), (b'cache-control', b'no-cache')]
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b'' if head else body})
+
+
+async def serve_api(scope, send, resource, ids):
+    """Serves an API resource with an AsyncSession, running its query code through run_sync."""
+    started = time.perf_counter()
+    status = await _serve_api(scope, send, resource, ids)
+    # Same endpoint name as the Flask route (the Flask request hooks do not run here)
+    metrics.observe_request(f"{api_blueprint.name}.{resource.__name__}", scope['method'], status, time.perf_counter() - started)
+
+
+async def _serve_api(scope, send, resource, ids):
+    """Answers an API request. Returns the response status."""
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope.get('headers', [])}
+    api_request = ApiRequest(
+        scope['path'],
+        MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)),
+        parse_etags(headers.get('if-none-match')),
+    )
+    head = scope['method'] == 'HEAD'
+    try:
+        async with AsyncSessionLocal() as session:
+            payload, etag = await session.run_sync(resource, api_request, **ids)
+    except ApiError as e:
+        await _send_json(send, e.status, {'error': e.message}, head=head)
+        return e.status
+    except Exception:
+        logger.exception("API request %s failed", scope['path'])
+        await _send_json(send, 500, {'error': "Internal server error"}, head=head)
+        return 500
+
+    if payload is None:
+        await _send_json(send, 304, etag=etag, head=True)
+        return 304
+    await _send_json(send, 200, payload, etag=etag, head=head)
+    return 200
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if async_engine is not None:
+                await async_engine.dispose()
+            _wsgi_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    if AsyncSessionLocal is not None:
+        try:
+            resource, ids = _api_urls.match(scope['path'], method=scope['method'])
+        except HTTPException:
+            pass # Not an API endpoint (or not a GET): served by the Flask app
+        else:
+            await serve_api(scope, send, resource, ids)
+            return
+    await serve_wsgi(scope, receive, send)
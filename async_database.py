@@ -0,0 +1,52 @@
+import os
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from database import DATABASE_URL, POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT, POOL_PRE_PING, POOL_RECYCLE
+
+# Async engine of the ASGI serving mode (see asgi.py).
+#
+# It connects to the same database as database.engine, through the async
+# driver of the dialect (asyncpg for PostgreSQL, aiosqlite for SQLite), with
+# the same pool settings. The models of database.py are used as they are:
+# AsyncSession.run_sync runs the synchronous query code of the app on the
+# async connection, without a thread per request.
+#
+# Requires the packages of requirements-async.txt.
+
+# Async drivers by dialect
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite',
+}
+
+
+def async_database_url(url=DATABASE_URL):
+    """The URL of the database with the async driver of its dialect (ASYNC_DATABASE_URL overrides it)."""
+    if os.environ.get("ASYNC_DATABASE_URL"):
+        return os.environ["ASYNC_DATABASE_URL"]
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No async driver is configured for {url.get_backend_name()} databases. Set ASYNC_DATABASE_URL.")
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}").render_as_string(hide_password=False)
+
+
+def _create_async_engine():
+    url = async_database_url()
+    if make_url(url).get_backend_name() == 'sqlite':
+        # The pool settings are tuned for database servers (see database.py)
+        return create_async_engine(url)
+    return create_async_engine(
+        url,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_pre_ping=POOL_PRE_PING,
+        pool_recycle=POOL_RECYCLE,
+    )
+
+
+async_engine = _create_async_engine()
+
+# Sessions of the async routes; expire_on_commit is off because attributes cannot be lazily reloaded outside run_sync
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
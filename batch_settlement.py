@@ -0,0 +1,164 @@
+import json
+import numpy as np
+from sqlalchemy import select
+from database import Trip, Participant, Expense, ExpenseShare, TripSnapshot
+from settlement import simplify_debts
+
+# Batch settlement engine for reporting over many trips at once.
+#
+# Instead of hydrating ORM objects and looping over every expense and weight
+# in Python (utils.calculate_balances), expenses, shares and participants of
+# a chunk of trips are loaded as columnar NumPy arrays and every balance is
+# computed with scatter-adds (np.bincount) over participant indices.
+# The split rules are the same as calculate_balances. Archived trips have no
+# expense rows: their balances and transactions are read from their snapshot.
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class SettlementColumns:
+    """Columnar view of the participants, expenses and shares of a set of trips."""
+
+    def __init__(self, trip_ids, participant_rows, expense_rows, share_rows):
+        self.trip_ids = np.asarray(sorted(trip_ids), dtype=np.int64)
+
+        # Participants, sorted by id so ids can be mapped to indices with searchsorted
+        participant_rows = sorted(participant_rows)
+        self.participant_ids = np.fromiter((row[0] for row in participant_rows), dtype=np.int64, count=len(participant_rows))
+        self.participant_trip_ids = np.fromiter((row[1] for row in participant_rows), dtype=np.int64, count=len(participant_rows))
+        self.participant_names = [row[2] for row in participant_rows]
+
+        # Expenses, sorted by id for the same reason
+        expense_rows = sorted(expense_rows)
+        count = len(expense_rows)
+        self.expense_ids = np.fromiter((row[0] for row in expense_rows), dtype=np.int64, count=count)
+        self.expense_trip_ids = np.fromiter((row[1] for row in expense_rows), dtype=np.int64, count=count)
+        self.expense_payer_ids = np.fromiter((row[2] for row in expense_rows), dtype=np.int64, count=count)
+        self.expense_amounts = np.fromiter((row[3] for row in expense_rows), dtype=np.float64, count=count)
+
+        count = len(share_rows)
+        self.share_expense_ids = np.fromiter((row[0] for row in share_rows), dtype=np.int64, count=count)
+        self.share_participant_ids = np.fromiter((row[1] for row in share_rows), dtype=np.int64, count=count)
+        self.share_weights = np.fromiter((row[2] for row in share_rows), dtype=np.float64, count=count)
+
+    @classmethod
+    def load(cls, db, trip_ids):
+        """Loads the columns of the given trips with three narrow queries (no ORM objects)."""
+        trip_ids = list(trip_ids)
+        participant_rows = db.execute(
+            select(Participant.id, Participant.trip_id, Participant.name).where(Participant.trip_id.in_(trip_ids))
+        ).all()
+        expense_rows = db.execute(
+            select(Expense.id, Expense.trip_id, Expense.paid_by_id, Expense.amount).where(Expense.trip_id.in_(trip_ids))
+        ).all()
+        share_rows = db.execute(
+            select(ExpenseShare.expense_id, ExpenseShare.participant_id, ExpenseShare.weight)
+            .join(Expense, Expense.id == ExpenseShare.expense_id)
+            .where(Expense.trip_id.in_(trip_ids))
+        ).all()
+        return cls(trip_ids, participant_rows, expense_rows, share_rows)
+
+
+def _lookup(sorted_ids, ids):
+    """Maps ids to their index in sorted_ids; ids that are not present get -1."""
+    if len(sorted_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    indices = np.searchsorted(sorted_ids, ids)
+    indices = np.minimum(indices, len(sorted_ids) - 1)
+    return np.where(sorted_ids[indices] == ids, indices, -1)
+
+
+def compute_balances(columns):
+    """
+    Computes the balance of every participant in the columns.
+
+    Returns an array aligned with columns.participant_ids.
+    """
+    participant_count = len(columns.participant_ids)
+    expense_count = len(columns.expense_ids)
+    balances = np.zeros(participant_count, dtype=np.float64)
+    if participant_count == 0:
+        return balances
+
+    # Whoever paid gets the full amount
+    payer_index = _lookup(columns.participant_ids, columns.expense_payer_ids)
+    valid = payer_index >= 0
+    balances += np.bincount(payer_index[valid], weights=columns.expense_amounts[valid], minlength=participant_count)
+
+    # Shares of participants of the expense's trip (the others are ignored, as in calculate_balances)
+    share_expense_index = _lookup(columns.expense_ids, columns.share_expense_ids)
+    share_participant_index = _lookup(columns.participant_ids, columns.share_participant_ids)
+    share_valid = (share_expense_index >= 0) & (share_participant_index >= 0)
+    share_valid[share_valid] &= (
+        columns.participant_trip_ids[share_participant_index[share_valid]]
+        == columns.expense_trip_ids[share_expense_index[share_valid]]
+    )
+
+    # Total weight per expense
+    total_weights = np.bincount(
+        share_expense_index[share_valid], weights=columns.share_weights[share_valid], minlength=expense_count
+    )
+
+    # Weighted shares
+    share_expense = share_expense_index[share_valid]
+    share_totals = total_weights[share_expense]
+    weighted = share_totals > 0
+    owed = columns.expense_amounts[share_expense[weighted]] * columns.share_weights[share_valid][weighted] / share_totals[weighted]
+    balances -= np.bincount(share_participant_index[share_valid][weighted], weights=owed, minlength=participant_count)
+
+    # Unweighted expenses are split equally among all participants of their trip
+    trip_count = len(columns.trip_ids)
+    expense_trip_index = _lookup(columns.trip_ids, columns.expense_trip_ids)
+    participant_trip_index = _lookup(columns.trip_ids, columns.participant_trip_ids)
+    unweighted = (total_weights <= 0) & (expense_trip_index >= 0)
+    unweighted_per_trip = np.bincount(expense_trip_index[unweighted], weights=columns.expense_amounts[unweighted], minlength=trip_count)
+    participants_per_trip = np.bincount(participant_trip_index, minlength=trip_count)
+    equal_shares = np.divide(
+        unweighted_per_trip, participants_per_trip,
+        out=np.zeros(trip_count, dtype=np.float64), where=participants_per_trip > 0
+    )
+    balances -= equal_shares[participant_trip_index]
+
+    return balances
+
+
+def settle_trips(db, trip_ids=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields (trip_id, balances, transactions) for many trips, like calling
+    utils.calculate_balances on each of them.
+
+    Trips (all of them by default) are processed in chunks of `chunk_size`, so
+    memory stays bounded by the size of a chunk.
+    """
+    if trip_ids is None:
+        trip_ids = [trip_id for (trip_id,) in db.execute(select(Trip.id).order_by(Trip.id))]
+    trip_ids = list(trip_ids)
+
+    for start in range(0, len(trip_ids), chunk_size):
+        chunk = trip_ids[start:start + chunk_size]
+        # Archived trips: as they were frozen in their snapshot (see trip_archive.py)
+        frozen = {
+            trip_id: (json.loads(balances), json.loads(transactions))
+            for trip_id, balances, transactions in db.execute(
+                select(TripSnapshot.trip_id, TripSnapshot.balances, TripSnapshot.transactions).where(TripSnapshot.trip_id.in_(chunk))
+            )
+        }
+        live = [trip_id for trip_id in chunk if trip_id not in frozen]
+        settled = {}
+        if live:
+            columns = SettlementColumns.load(db, live)
+            balances = compute_balances(columns)
+
+            # Participants are sorted by id; sort them by trip (stable) to slice out each trip's segment
+            order = np.argsort(columns.participant_trip_ids, kind='stable')
+            segment_trip_ids = columns.participant_trip_ids[order]
+            segment_bounds = np.searchsorted(segment_trip_ids, live, side='left'), np.searchsorted(segment_trip_ids, live, side='right')
+
+            for trip_id, segment_start, segment_end in zip(live, *segment_bounds):
+                members = order[segment_start:segment_end]
+                trip_balances = {columns.participant_names[i]: float(balances[i]) for i in members}
+                settled[trip_id] = (trip_balances, simplify_debts(trip_balances))
+
+        for trip_id in chunk:
+            trip_balances, transactions = frozen[trip_id] if trip_id in frozen else settled[trip_id]
+            yield trip_id, trip_balances, transactions
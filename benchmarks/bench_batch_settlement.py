@@ -0,0 +1,118 @@
+"""
+Compares utils.calculate_balances (one trip at a time, ORM objects) with the
+vectorized batch_settlement engine on a synthetic SQLite database.
+
+Usage:
+    python benchmarks/bench_batch_settlement.py [--trips 10000] [--participants 5] [--expenses 20]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# The database URL must be set before the app modules create their engine
+_db_dir = tempfile.mkdtemp(prefix='bench_settlement_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.orm import selectinload # noqa: E402
+from database import Base, engine, SessionLocal, Trip, Participant, Expense, ExpenseShare # noqa: E402
+from utils import calculate_balances # noqa: E402
+import batch_settlement # noqa: E402
+
+
+def populate(trip_count, participants_per_trip, expenses_per_trip, seed=42):
+    """Fills the database with synthetic trips using bulk Core inserts."""
+    rng = random.Random(seed)
+    Base.metadata.create_all(bind=engine)
+    trips, participants, expenses, shares = [], [], [], []
+    participant_id = expense_id = 0
+    start = datetime(2024, 1, 1)
+    for trip_id in range(1, trip_count + 1):
+        trips.append({'id': trip_id, 'name': f"Trip {trip_id}"})
+        member_ids = []
+        for i in range(participants_per_trip):
+            participant_id += 1
+            member_ids.append(participant_id)
+            participants.append({'id': participant_id, 'trip_id': trip_id, 'name': f"P{i}"})
+        for _ in range(expenses_per_trip):
+            expense_id += 1
+            expenses.append({
+                'id': expense_id, 'trip_id': trip_id, 'paid_by_id': rng.choice(member_ids),
+                'description': 'expense', 'amount': round(rng.uniform(1, 500), 2),
+                'expense_date': start + timedelta(days=rng.randint(0, 365)),
+            })
+            # Roughly one expense in twenty has no weights and is split equally
+            if rng.random() < 0.05:
+                continue
+            for member_id in member_ids:
+                if rng.random() < 0.8:
+                    shares.append({'expense_id': expense_id, 'participant_id': member_id, 'weight': float(rng.randint(0, 3))})
+
+    with engine.begin() as connection:
+        connection.execute(Trip.__table__.insert(), trips)
+        connection.execute(Participant.__table__.insert(), participants)
+        connection.execute(Expense.__table__.insert(), expenses)
+        connection.execute(ExpenseShare.__table__.insert(), shares)
+    return len(expenses), len(shares)
+
+
+def run_per_trip(db):
+    """The current nightly job: load each trip with its expenses and call calculate_balances."""
+    results = {}
+    for (trip_id,) in db.query(Trip.id).order_by(Trip.id).all():
+        trip = db.query(Trip).options(
+            selectinload(Trip.participants),
+            selectinload(Trip.expenses).selectinload(Expense.payer),
+            selectinload(Trip.expenses).selectinload(Expense.shares),
+        ).filter(Trip.id == trip_id).one()
+        results[trip_id] = calculate_balances(trip)
+        db.expunge_all() # Keep memory bounded like a real job would
+    return results
+
+
+def run_batch(db):
+    return {trip_id: (balances, transactions) for trip_id, balances, transactions in batch_settlement.settle_trips(db)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=10000)
+    parser.add_argument('--participants', type=int, default=5, help="Participants per trip")
+    parser.add_argument('--expenses', type=int, default=20, help="Expenses per trip")
+    args = parser.parse_args()
+
+    expense_count, share_count = populate(args.trips, args.participants, args.expenses)
+    print(f"Synthetic data: {args.trips} trips, {expense_count} expenses, {share_count} shares")
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        per_trip = run_per_trip(db)
+        per_trip_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        batch = run_batch(db)
+        batch_seconds = time.perf_counter() - started
+    finally:
+        db.close()
+
+    # Both engines must agree (up to floating point summation order)
+    mismatches = 0
+    for trip_id, (balances, transactions) in per_trip.items():
+        batch_balances, batch_transactions = batch[trip_id]
+        if balances.keys() != batch_balances.keys() or any(abs(balances[name] - batch_balances[name]) > 1e-6 for name in balances):
+            mismatches += 1
+        elif [(t['from'], t['to']) for t in transactions] != [(t['from'], t['to']) for t in batch_transactions]:
+            mismatches += 1
+
+    print(f"calculate_balances per trip: {per_trip_seconds:.2f}s ({args.trips / per_trip_seconds:.0f} trips/s)")
+    print(f"batch_settlement:            {batch_seconds:.2f}s ({args.trips / batch_seconds:.0f} trips/s)")
+    print(f"Speedup: {per_trip_seconds / batch_seconds:.1f}x, trips with differing results: {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Compares the serial and parallel PDF extraction paths of pdf_extraction.py on
+a synthetic statement, reporting pages per second.
+
+Usage:
+    python benchmarks/bench_pdf_extraction.py [--pages 100] [--lines 40] [--workers 2 4]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_extraction # noqa: E402
+from synthetic import build_statement_pdf # noqa: E402
+
+
+def run(pdf_bytes, parallel, workers):
+    started = time.perf_counter()
+    expenses, _ = pdf_extraction.extract_expenses(pdf_bytes, parallel=parallel, workers=workers)
+    return expenses, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--lines', type=int, default=40, help="Statement lines per page.")
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4])
+    args = parser.parse_args()
+
+    pdf_bytes, line_count = build_statement_pdf(args.pages, args.lines)
+    print(f"Statement: {args.pages} pages, {line_count} lines, {len(pdf_bytes) / 1024:.0f} KiB")
+
+    serial_expenses, serial_seconds = run(pdf_bytes, False, 1)
+    assert len(serial_expenses) == line_count, f"extracted {len(serial_expenses)} of {line_count} lines"
+    print(f"{'mode':>12} {'time (s)':>9} {'pages/s':>9} {'speedup':>8}")
+    print(f"{'serial':>12} {serial_seconds:>9.2f} {args.pages / serial_seconds:>9.1f} {1:>8.2f}")
+
+    for workers in args.workers:
+        # Warm the pool up so that process start-up is not measured
+        list(pdf_extraction._get_executor(workers).map(abs, range(workers)))
+        parallel_expenses, parallel_seconds = run(pdf_bytes, True, workers)
+        assert parallel_expenses == serial_expenses, "parallel extraction differs from the serial one"
+        label = f"{workers} workers"
+        print(f"{label:>12} {parallel_seconds:>9.2f} {args.pages / parallel_seconds:>9.1f} {serial_seconds / parallel_seconds:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
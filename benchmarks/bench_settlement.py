@@ -0,0 +1,75 @@
+"""
+Measures the transfers produced and the wall time of the debt simplification
+strategies in settlement.py across group sizes.
+
+Usage:
+    python benchmarks/bench_settlement.py [--sizes 4 8 12 16 100 1000 10000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settlement # noqa: E402
+
+
+def synthetic_balances(size, rng):
+    """
+    Balances of `size` participants after a series of shared expenses.
+
+    Amounts are drawn from a small set of prices so that zero-sum subgroups
+    (which the exact solver can exploit) occur as they do in real trips.
+    """
+    balances = {f"P{i}": 0.0 for i in range(size)}
+    names = list(balances)
+    for _ in range(size * 2):
+        payer, debtor = rng.sample(names, 2)
+        amount = rng.choice([5.0, 10.0, 12.5, 20.0, 45.0])
+        balances[payer] += amount
+        balances[debtor] -= amount
+    return balances
+
+
+def check_settles(balances, transactions):
+    """Asserts that applying the transfers leaves every balance within a cent of zero per transfer."""
+    remaining = dict(balances)
+    for transaction in transactions:
+        remaining[transaction['from']] += transaction['amount']
+        remaining[transaction['to']] -= transaction['amount']
+    tolerance = 0.01 * (len(transactions) + 1)
+    assert all(abs(balance) <= tolerance for balance in remaining.values()), remaining
+
+
+def run(size, mode, repeat, rng_seed=7):
+    rng = random.Random(rng_seed + size)
+    total_transfers = 0
+    total_seconds = 0.0
+    for _ in range(repeat):
+        balances = synthetic_balances(size, rng)
+        started = time.perf_counter()
+        transactions = settlement.simplify_debts(balances, mode=mode)
+        total_seconds += time.perf_counter() - started
+        check_settles(balances, transactions)
+        total_transfers += len(transactions)
+    return total_transfers / repeat, total_seconds / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 12, 16, 100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'mode':>7} {'transfers':>10} {'time (ms)':>10}")
+    for size in args.sizes:
+        # Exact falls back to greedy past EXACT_MAX_STEPS, so every mode runs at every size
+        for mode in (settlement.GREEDY, settlement.AUTO, settlement.EXACT):
+            transfers, seconds = run(size, mode, args.repeat)
+            print(f"{size:>6} {mode:>7} {transfers:>10.1f} {seconds * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
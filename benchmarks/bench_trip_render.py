@@ -0,0 +1,184 @@
+"""
+Measures the render time of the trip page's expense table for a large trip:
+the previous template, which resolved every weight with a scan of the trip's
+participants (selectattr), against the same rows rendered from the view
+models of view_models.py, and the complete _trip_expenses.html fragment.
+
+Usage:
+    python benchmarks/bench_trip_render.py [--participants 50] [--expenses 5000] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# The database URL must be set before the app modules create their engine
+_db_dir = tempfile.mkdtemp(prefix='bench_trip_render_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template # noqa: E402
+from app import app # noqa: E402
+from database import engine, SessionLocal, Trip, Participant, Expense, ExpenseShare, Category # noqa: E402
+from loaders import load_trip, expense_listing_query # noqa: E402
+from pagination import keyset_order # noqa: E402
+import view_models # noqa: E402
+
+# Rows of the expense table as the template rendered them before view_models.py
+LEGACY_ROWS_TEMPLATE = """
+{% for month_year, expenses_list in grouped_expenses.items() %}
+<tr><td colspan="9">{{ month_year }}</td></tr>
+{% for expense in expenses_list %}
+<tr class="{% if loop.index is odd %}bg-gray-50{% else %}bg-white{% endif %}">
+<td>{{ expense.description }}</td>
+<td>{{ "%.2f" | format(expense.amount) }}</td>
+<td>{{ expense.payer.name }}</td>
+<td>{{ expense.category.name if expense.category else 'Uncategorized' }}</td>
+<td>
+{% if expense.shares %}
+{% for participant_id, weight in expense.weights.items() %}
+{% set participant = trip.participants | selectattr('id', 'equalto', participant_id) | first %}
+{% if participant %}{{ participant.name }}: {{ "%.0f" | format(weight) }}<br>{% endif %}
+{% endfor %}
+{% else %}Equal Split (Weight 1){% endif %}
+</td>
+<td>{{ expense.expense_date.strftime('%Y-%m-%d') }}</td>
+<td>{{ expense.date_added.strftime('%Y-%m-%d %H:%M') }}</td>
+<td>{{ expense.last_modified.strftime('%Y-%m-%d %H:%M') }}</td>
+<td><a href="{{ url_for('trip_blueprint.edit_expense', trip_id=trip_id, expense_id=expense.id) }}">Edit</a>
+<form method="POST" action="{{ url_for('trip_blueprint.delete_expense', trip_id=trip_id, expense_id=expense.id) }}"></form></td>
+</tr>
+{% endfor %}
+{% endfor %}
+"""
+
+# The same rows rendered from view models
+VIEW_MODEL_ROWS_TEMPLATE = """
+{% for month_year, expenses_list in expense_groups %}
+<tr><td colspan="9">{{ month_year }}</td></tr>
+{% for expense in expenses_list %}
+<tr class="{% if loop.index is odd %}bg-gray-50{% else %}bg-white{% endif %}">
+<td>{{ expense.description }}</td>
+<td>{{ expense.amount }}</td>
+<td>{{ expense.payer_name }}</td>
+<td>{{ expense.category_name }}</td>
+<td>
+{% if expense.shares %}
+{% for participant_name, weight in expense.shares %}
+{{ participant_name }}: {{ weight }}<br>
+{% endfor %}
+{% else %}Equal Split (Weight 1){% endif %}
+</td>
+<td>{{ expense.expense_date }}</td>
+<td>{{ expense.date_added }}</td>
+<td>{{ expense.last_modified }}</td>
+<td><a href="{{ url_for('trip_blueprint.edit_expense', trip_id=trip_id, expense_id=expense.id) }}">Edit</a>
+<form method="POST" action="{{ url_for('trip_blueprint.delete_expense', trip_id=trip_id, expense_id=expense.id) }}"></form></td>
+</tr>
+{% endfor %}
+{% endfor %}
+"""
+
+
+def populate(participant_count, expense_count, seed=42):
+    """Creates one trip with synthetic participants and expenses using bulk Core inserts. Returns the trip id."""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    start = datetime(2024, 1, 1)
+    with engine.begin() as connection:
+        trip_id = connection.execute(Trip.__table__.insert().values(name='Benchmark trip')).inserted_primary_key[0]
+        category_ids = [
+            connection.execute(Category.__table__.insert().values(name=f"Bench category {i}")).inserted_primary_key[0]
+            for i in range(5)
+        ]
+        connection.execute(Participant.__table__.insert(), [
+            {'trip_id': trip_id, 'name': f"Participant {i}"} for i in range(participant_count)
+        ])
+        member_ids = [row.id for row in connection.execute(Participant.__table__.select().where(Participant.trip_id == trip_id))]
+        connection.execute(Expense.__table__.insert(), [{
+            'trip_id': trip_id, 'paid_by_id': rng.choice(member_ids), 'description': f"Expense {i}",
+            'amount': round(rng.uniform(1, 500), 2), 'expense_date': start + timedelta(days=rng.randint(0, 365)),
+            'category_id': rng.choice(category_ids + [None]), 'date_added': now, 'last_modified': now,
+        } for i in range(expense_count)])
+        expense_ids = [row.id for row in connection.execute(Expense.__table__.select().where(Expense.trip_id == trip_id))]
+        # Every expense is split between all participants
+        connection.execute(ExpenseShare.__table__.insert(), [
+            {'expense_id': expense_id, 'participant_id': member_id, 'weight': float(rng.randint(0, 3))}
+            for expense_id in expense_ids for member_id in member_ids
+        ])
+    return trip_id
+
+
+def load(trip_id):
+    """Loads the trip and all its expenses (most recent first), as the trip page does for one page."""
+    db = SessionLocal()
+    trip = load_trip(db, trip_id, default_proportions=True)
+    expenses = keyset_order(expense_listing_query(db).filter(Expense.trip_id == trip_id)).all()
+    return db, trip, expenses
+
+
+def render_legacy(trip, expenses):
+    grouped_expenses = {}
+    for expense in expenses:
+        grouped_expenses.setdefault(expense.expense_date.strftime('%B %Y'), []).append(expense)
+    return app.jinja_env.from_string(LEGACY_ROWS_TEMPLATE).render(
+        trip_id=trip.id, trip=trip, grouped_expenses=grouped_expenses
+    )
+
+
+def render_view_models(trip, expenses):
+    names = view_models.participant_names(trip.participants)
+    return app.jinja_env.from_string(VIEW_MODEL_ROWS_TEMPLATE).render(
+        trip_id=trip.id, expense_groups=view_models.expense_groups(expenses, names)
+    )
+
+
+def render_fragment(trip, expenses):
+    """The complete _trip_expenses.html fragment of the trip page."""
+    names = view_models.participant_names(trip.participants)
+    return render_template(
+        '_trip_expenses.html', trip_id=trip.id, total_expenses='0.00', search_query=None,
+        expense_groups=view_models.expense_groups(expenses, names), cursor=None, next_cursor=None,
+        start_date=None, end_date=None,
+    )
+
+
+def timed(render, trip, expenses, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        html = render(trip, expenses)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(html)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--participants', type=int, default=50)
+    parser.add_argument('--expenses', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    trip_id = populate(args.participants, args.expenses)
+    db, trip, expenses = load(trip_id)
+    print(f"{len(trip.participants)} participants, {len(expenses)} expenses, "
+          f"{sum(len(expense.shares) for expense in expenses)} weights")
+
+    with app.test_request_context():
+        # Warm up the template caches
+        render_legacy(trip, expenses[:10])
+        render_view_models(trip, expenses[:10])
+        render_fragment(trip, expenses[:10])
+        print(f"{'renderer':>12} {'time (ms)':>10} {'html (KB)':>10}")
+        for name, render in (('legacy', render_legacy), ('view models', render_view_models), ('fragment', render_fragment)):
+            seconds, size = timed(render, trip, expenses, args.repeat)
+            print(f"{name:>12} {seconds * 1000:>10.1f} {size / 1024:>10.0f}")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+Benchmark suite: times the app's hot paths on a synthetic SQLite database
+(see synthetic.py) and stores the results as JSON, so that runs on different
+commits can be compared.
+
+Benchmarks:
+    calculate_balances   utils.calculate_balances over loaded trips
+    view_trip_cold       GET /trip/<id> with the trip page cache cleared
+    view_trip_cached     GET /trip/<id> served from the trip page cache
+    view_trip_304        GET /trip/<id> revalidated with If-None-Match
+    process_pdf_report   utils.process_pdf_report on a synthetic statement
+    import_commit        POST /trip/<id>/validate_expenses saving a staged import
+
+Usage:
+    python benchmarks/suite.py [--scale small] [--repeat 5] [--output results.json]
+                               [--compare previous.json] [--threshold 0.2]
+
+Results go to benchmarks/results/<time>-<commit>.json by default. With
+--compare, the fastest run of each benchmark (less sensitive to machine noise
+than the median) is compared with a previous results file, and the exit
+status is 1 if any benchmark is slower by more than --threshold.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# The database URL must be set before the app modules create their engine
+_db_dir = tempfile.mkdtemp(prefix='bench_suite_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+_repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _repo_dir)
+
+import sqlalchemy # noqa: E402
+from sqlalchemy.orm import selectinload # noqa: E402
+from app import app # noqa: E402
+from database import SessionLocal, Trip, Expense # noqa: E402
+from utils import calculate_balances, process_pdf_report # noqa: E402
+from query_budget import track_queries # noqa: E402
+from import_staging import stage_import # noqa: E402
+from import_jobs import guess_categories # noqa: E402
+import trip_page # noqa: E402
+from synthetic import SCALES, populate, build_statement_pdf # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def measure(function, repeat, setup=None):
+    """
+    Runs function once to warm up, then `repeat` times, calling setup (untimed) before each run.
+
+    Returns the timings in milliseconds and the queries and ORM rows of the last run.
+    """
+    timings = []
+    for run in range(repeat + 1):
+        if setup:
+            setup()
+        with track_queries() as stats:
+            started = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - started
+        if run:
+            timings.append(elapsed * 1000)
+    return {
+        'runs': repeat,
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'queries': stats.queries,
+        'rows': stats.rows,
+    }
+
+
+def bench_calculate_balances(repeat, trip_count=10):
+    db = SessionLocal()
+    try:
+        trips = db.query(Trip).options(
+            selectinload(Trip.participants),
+            selectinload(Trip.expenses).selectinload(Expense.payer),
+            selectinload(Trip.expenses).selectinload(Expense.shares),
+        ).order_by(Trip.id).limit(trip_count).all()
+        return measure(lambda: [calculate_balances(trip) for trip in trips], repeat)
+    finally:
+        db.close()
+
+
+def bench_view_trip(repeat, client, trip_id):
+    url = f'/trip/{trip_id}'
+
+    def get(headers=None):
+        response = client.get(url, headers=headers)
+        assert response.status_code in (200, 304), response.status_code
+        return response
+
+    results = {
+        'view_trip_cold': measure(get, repeat, setup=trip_page._page_cache.clear),
+        'view_trip_cached': measure(get, repeat),
+    }
+    etag = get().headers.get('ETag')
+    results['view_trip_304'] = measure(lambda: get({'If-None-Match': etag}), repeat)
+    return results
+
+
+def bench_process_pdf_report(repeat, pdf_bytes):
+    with app.test_request_context():
+        return measure(lambda: process_pdf_report(io.BytesIO(pdf_bytes)), repeat)
+
+
+def bench_import_commit(repeat, client, trip_id, pdf_bytes):
+    """Saves a staged import of the statement's expenses, all rows accepted."""
+    with app.test_request_context():
+        extracted = process_pdf_report(io.BytesIO(pdf_bytes))
+    db = SessionLocal()
+    try:
+        guess_categories(db, extracted)
+        participant_ids = [participant.id for participant in db.get(Trip, trip_id).participants]
+    finally:
+        db.close()
+
+    form = {}
+
+    def stage():
+        db = SessionLocal()
+        try:
+            form.clear()
+            form['import_id'] = stage_import(db, trip_id, extracted)
+            db.commit()
+        finally:
+            db.close()
+        form['paid_by_all'] = str(participant_ids[0])
+        for index, expense in enumerate(extracted):
+            form[f'accept_expense_{index}'] = 'on'
+            form[f'amount_{index}'] = str(expense['amount'])
+            form[f'expense_date_{index}'] = expense['expense_date']
+            form[f'category_{index}'] = str(expense['category_id'] or '')
+            for participant_id in participant_ids:
+                form[f'proportion_{index}_{participant_id}'] = '1'
+
+    def commit():
+        response = client.post(f'/trip/{trip_id}/validate_expenses', data=form, headers={'Accept': 'application/json'})
+        assert response.status_code == 200 and response.get_json()['saved'] == len(extracted), response.data[:200]
+
+    result = measure(commit, repeat, setup=stage)
+    result['expenses_per_run'] = len(extracted)
+    return result
+
+
+def git_commit():
+    """The current commit and whether the working tree has changes, or (None, None) outside a git checkout."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=_repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=_repo_dir,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def compare(results, previous_path, threshold):
+    """Prints the change of each fastest run against a previous results file. Returns the names of regressed benchmarks."""
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+    print(f"\nCompared with {previous_path} (commit {(previous.get('commit') or 'unknown')[:10]}):")
+    print(f"{'benchmark':>20} {'min (ms)':>10} {'previous':>10} {'change':>8}")
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        before = previous.get('benchmarks', {}).get(name)
+        if not before:
+            print(f"{name:>20} {result['min_ms']:>10.2f} {'-':>10} {'new':>8}")
+            continue
+        change = result['min_ms'] / before['min_ms'] - 1 if before['min_ms'] else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:>20} {result['min_ms']:>10.2f} {before['min_ms']:>10.2f} {change:>+8.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--pdf-pages', type=int, default=10, help="Pages of the synthetic statement.")
+    parser.add_argument('--output', help="Results file (default: benchmarks/results/<time>-<commit>.json).")
+    parser.add_argument('--compare', help="Previous results file to compare with.")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Slowdown reported as a regression (0.2 = 20%%).")
+    args = parser.parse_args()
+
+    dataset = populate(**SCALES[args.scale])
+    print(", ".join(f"{count} {table}" for table, count in dataset.items()))
+    pdf_bytes, line_count = build_statement_pdf(args.pdf_pages, 40)
+
+    db = SessionLocal()
+    trip_ids = [trip_id for (trip_id,) in db.query(Trip.id).order_by(Trip.id)]
+    db.close()
+    client = app.test_client()
+
+    benchmarks = {'calculate_balances': bench_calculate_balances(args.repeat)}
+    benchmarks.update(bench_view_trip(args.repeat, client, trip_ids[0]))
+    benchmarks['process_pdf_report'] = bench_process_pdf_report(args.repeat, pdf_bytes)
+    # Imports go to another trip, so that they do not change the trip the other benchmarks read
+    benchmarks['import_commit'] = bench_import_commit(args.repeat, client, trip_ids[-1], pdf_bytes)
+
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'dataset': dict(dataset, statement_pages=args.pdf_pages, statement_lines=line_count),
+        'benchmarks': benchmarks,
+    }
+
+    print(f"{'benchmark':>20} {'median (ms)':>12} {'min (ms)':>10} {'queries':>8}")
+    for name, result in benchmarks.items():
+        print(f"{name:>20} {result['median_ms']:>12.2f} {result['min_ms']:>10.2f} {result['queries']:>8}")
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{(commit or 'nocommit')[:10]}.json")
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
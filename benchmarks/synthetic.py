@@ -0,0 +1,193 @@
+"""
+Synthetic data for the benchmarks: trips with participants, default weights,
+categorized expenses and their shares, and statement PDFs whose lines use the
+same merchant descriptions (so imports get category suggestions).
+
+Usage:
+    python benchmarks/synthetic.py --database-url sqlite:///bench.db [--scale small] [--pdf statement.pdf --pages 20]
+
+The DATABASE_URL of the app modules is set from --database-url before they
+are imported. Other scripts import populate() and build_statement_pdf().
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Sizes of the synthetic datasets
+SCALES = {
+    'small': {'trips': 10, 'participants': 5, 'expenses': 200, 'categories': 8},
+    'medium': {'trips': 100, 'participants': 8, 'expenses': 1000, 'categories': 20},
+    'large': {'trips': 1000, 'participants': 10, 'expenses': 2000, 'categories': 40},
+}
+
+# Descriptions of the synthetic expenses and statement lines
+MERCHANTS = ['SUPERMARKET', 'RESTAURANT LE PORT', 'FUEL STATION', 'PHARMACY', 'BAKERY', 'MUSEUM TICKETS',
+             'TRAIN TICKETS', 'HOTEL DU LAC', 'CAFE CENTRAL', 'SKI RENTAL']
+
+# Rows per bulk insert statement
+INSERT_BATCH_SIZE = 5000
+
+
+def _insert(connection, table, rows):
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        connection.execute(table.insert(), rows[start:start + INSERT_BATCH_SIZE])
+
+
+def populate(trips, participants, expenses, categories, seed=42, start=datetime(2024, 1, 1)):
+    """
+    Fills the app's database with synthetic data using bulk Core inserts.
+
+    Args:
+        trips: Number of trips.
+        participants: Participants per trip (each with a default weight).
+        expenses: Expenses per trip, each split between the trip's participants.
+        categories: Number of categories, shared by all trips (one expense in categories + 1 has none).
+
+    The balance ledger of the new trips is built as well.
+
+    Returns:
+        A dictionary with the number of rows inserted per table.
+    """
+    from database import Base, engine, SessionLocal, Trip, Participant, Category, Expense, ExpenseShare, TripParticipantDefaultProportion
+    import ledger
+
+    rng = random.Random(seed)
+    Base.metadata.create_all(bind=engine)
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        # Ids are allocated here, after the rows already in the database
+        def next_id(table):
+            return (connection.execute(table.select().with_only_columns(table.c.id).order_by(table.c.id.desc()).limit(1)).scalar() or 0) + 1
+
+        category_id = next_id(Category.__table__)
+        category_rows = [{'id': category_id + i, 'name': f"Category {category_id + i}", 'created_at': now} for i in range(categories)]
+        category_ids = [row['id'] for row in category_rows] + [None]
+
+        trip_rows, participant_rows, default_rows, expense_rows, share_rows = [], [], [], [], []
+        trip_id, participant_id, expense_id = next_id(Trip.__table__), next_id(Participant.__table__), next_id(Expense.__table__)
+        for trip_number in range(trips):
+            trip_rows.append({'id': trip_id, 'name': f"Trip {trip_id}", 'created_at': now, 'updated_at': now})
+            member_ids = list(range(participant_id, participant_id + participants))
+            participant_id += participants
+            for number, member_id in enumerate(member_ids):
+                participant_rows.append({'id': member_id, 'trip_id': trip_id, 'name': f"Participant {number}", 'created_at': now, 'updated_at': now})
+                default_rows.append({'trip_id': trip_id, 'participant_id': member_id, 'default_proportion': float(rng.randint(1, 2))})
+            for _ in range(expenses):
+                added = start + timedelta(minutes=rng.randint(0, 525600))
+                expense_rows.append({
+                    'id': expense_id, 'trip_id': trip_id, 'paid_by_id': rng.choice(member_ids),
+                    'description': rng.choice(MERCHANTS), 'amount': round(rng.uniform(1, 500), 2),
+                    'expense_date': added.replace(hour=0, minute=0), 'category_id': rng.choice(category_ids),
+                    'date_added': added, 'last_modified': added,
+                })
+                for member_id in member_ids:
+                    if rng.random() < 0.8:
+                        share_rows.append({'expense_id': expense_id, 'participant_id': member_id, 'weight': float(rng.randint(0, 3))})
+                expense_id += 1
+            trip_id += 1
+
+        _insert(connection, Category.__table__, category_rows)
+        _insert(connection, Trip.__table__, trip_rows)
+        _insert(connection, Participant.__table__, participant_rows)
+        _insert(connection, TripParticipantDefaultProportion.__table__, default_rows)
+        _insert(connection, Expense.__table__, expense_rows)
+        _insert(connection, ExpenseShare.__table__, share_rows)
+
+    # The app keeps the balance ledger up to date as expenses change
+    db = SessionLocal()
+    try:
+        ledger.rebuild_ledger(db, [row['id'] for row in trip_rows])
+    finally:
+        db.close()
+
+    return {
+        'trips': len(trip_rows),
+        'participants': len(participant_rows),
+        'categories': len(category_rows),
+        'expenses': len(expense_rows),
+        'shares': len(share_rows),
+    }
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def build_statement_pdf(page_count, lines_per_page, seed=42):
+    """
+    Writes a minimal PDF statement (Helvetica text, one statement line per row)
+    in the layout expected by pdf_extraction.EXPENSE_LINE_PATTERN.
+
+    Returns (pdf bytes, number of expense lines).
+    """
+    rng = random.Random(seed)
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None) # Filled in once the pages are known
+    pages = add(None)
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    page_ids = []
+    for _ in range(page_count):
+        rows = [b"BT /F1 9 Tf 40 800 Td 11 TL"]
+        for _ in range(lines_per_page):
+            day, month = rng.randint(1, 28), rng.randint(1, 12)
+            amount = f"{rng.randint(1, 500)},{rng.randint(0, 99):02d}"
+            line = f"{day:02d} {month:02d} {day:02d} {month:02d} {rng.choice(MERCHANTS)} 0,00 % {amount}"
+            rows.append(f"({_escape(line)}) Tj T*".encode())
+        rows.append(b"ET")
+        stream = b"\n".join(rows)
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages, content, font)
+        ))
+
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[pages - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref)
+    return bytes(output), page_count * lines_per_page
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--pdf', help="Also write a statement PDF to this path.")
+    parser.add_argument('--pages', type=int, default=20, help="Pages of the statement PDF.")
+    parser.add_argument('--lines', type=int, default=40, help="Statement lines per page.")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    counts = populate(seed=args.seed, **SCALES[args.scale])
+    print(", ".join(f"{count} {table}" for table, count in counts.items()))
+
+    if args.pdf:
+        pdf_bytes, line_count = build_statement_pdf(args.pages, args.lines, seed=args.seed)
+        with open(args.pdf, 'wb') as pdf_file:
+            pdf_file.write(pdf_bytes)
+        print(f"Statement: {args.pages} pages, {line_count} lines written to {args.pdf}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import io
+import csv
+from datetime import datetime
+from sqlalchemy import select, text
+from database import engine, Expense, ExpenseShare, Category
+import ledger
+
+# Bulk commit path for validated imports.
+#
+# validate_rows parses the rows of the validation form and checks every
+# referenced category with a single IN query; insert_rows then writes all
+# accepted expenses with one multi-row INSERT ... RETURNING and their shares
+# with one executemany, so saving a full statement takes a bounded number of
+# round trips in a single transaction. Problems are returned as RowIssue
+# records instead of being flashed one by one.
+#
+# copy_rows is the PostgreSQL variant used by the statement importer
+# (statement_import.py): expense ids are drawn from the sequence up front and
+# the rows are streamed with COPY FROM STDIN.
+
+ERROR = 'error' # The row is skipped
+WARNING = 'warning' # The row is saved, with the problematic value dropped
+
+
+class RowIssue:
+    """A validation problem of one row of an import."""
+
+    def __init__(self, row, description, field, message, severity=ERROR):
+        self.row = row
+        self.description = description
+        self.field = field
+        self.message = message
+        self.severity = severity
+
+    def as_dict(self):
+        return {
+            'row': self.row,
+            'description': self.description,
+            'field': self.field,
+            'message': self.message,
+            'severity': self.severity,
+        }
+
+    def __repr__(self):
+        return f"<RowIssue row={self.row} field={self.field} {self.severity}: {self.message}>"
+
+
+def _parse_row(index, staged, form_data, participants):
+    """Parses one accepted row of the validation form. Returns (row values, issues); values are None if the row is skipped."""
+    description = staged.get('description')
+    issues = []
+
+    def error(field, message):
+        issues.append(RowIssue(index, description, field, message))
+        return None, issues
+
+    try:
+        amount = float(form_data.get(f'amount_{index}', staged.get('amount')))
+    except (TypeError, ValueError):
+        return error('amount', "Invalid amount.")
+
+    # Weights of the trip's participants: proportion_<row>_<participant id>
+    weights = {}
+    for participant in participants:
+        weight_key = f'proportion_{index}_{participant.id}'
+        if weight_key not in form_data:
+            continue
+        try:
+            weight = float(form_data[weight_key])
+        except ValueError:
+            return error('weights', f"Invalid weight value for {participant.name}. Please enter numbers only.")
+        if weight < 0:
+            return error('weights', f"Weight for {participant.name} cannot be negative.")
+        weights[participant.id] = weight
+
+    # Total weight can be 0, but not if there are participants
+    if sum(weights.values()) == 0 and participants:
+        return error('weights', "Total weight cannot be zero if there are participants. Please specify how the expense is split.")
+
+    expense_date_str = form_data.get(f'expense_date_{index}')
+    try:
+        expense_date = datetime.strptime(expense_date_str or '', '%Y-%m-%d')
+    except ValueError:
+        return error('expense_date', f"Invalid date format '{expense_date_str}'. Expected YYYY-MM-DD.")
+
+    category_id = None
+    category_id_str = form_data.get(f'category_{index}')
+    if category_id_str:
+        try:
+            category_id = int(category_id_str)
+        except ValueError:
+            issues.append(RowIssue(index, description, 'category', "Invalid category ID format. The expense will be saved without a category.", WARNING))
+
+    return {
+        'row': index,
+        'description': description,
+        'amount': amount,
+        'expense_date': expense_date,
+        'category_id': category_id,
+        'weights': weights,
+    }, issues
+
+
+def validate_rows(db, trip, staged_expenses, form_data):
+    """
+    Parses and validates the accepted rows of the validation form.
+
+    Every category id referenced by the rows is checked with one query; rows
+    with an unknown category are kept without a category (warning).
+
+    Returns:
+        (rows, issues): the rows to insert and the RowIssue list.
+    """
+    rows = []
+    issues = []
+    for index, staged in enumerate(staged_expenses):
+        if form_data.get(f'accept_expense_{index}') != 'on': # Rejected (unchecked) rows are ignored
+            continue
+        row, row_issues = _parse_row(index, staged, form_data, trip.participants)
+        issues.extend(row_issues)
+        if row is not None:
+            rows.append(row)
+
+    category_ids = {row['category_id'] for row in rows if row['category_id'] is not None}
+    if category_ids:
+        known_ids = set(db.scalars(select(Category.id).where(Category.id.in_(category_ids))))
+        for row in rows:
+            if row['category_id'] is not None and row['category_id'] not in known_ids:
+                issues.append(RowIssue(row['row'], row['description'], 'category', "Invalid category selected. The expense will be saved without a category.", WARNING))
+                row['category_id'] = None
+
+    issues.sort(key=lambda issue: issue.row)
+    return rows, issues
+
+
+def insert_rows(db, trip_id, paid_by_id, rows, participant_ids):
+    """
+    Inserts validated rows and their shares, and updates the balance ledger.
+
+    The caller commits. Returns the ids of the new expenses, in row order.
+    """
+    if not rows:
+        return []
+
+    now = datetime.utcnow()
+    expense_values = [{
+        'description': row['description'],
+        'amount': row['amount'],
+        'expense_date': row['expense_date'],
+        'trip_id': trip_id,
+        'paid_by_id': paid_by_id,
+        'category_id': row['category_id'],
+        'date_added': now,
+        'last_modified': now,
+    } for row in rows]
+
+    # Core inserts: the ORM bulk insert splits rows into batches by their NULL columns
+    expenses_table = Expense.__table__
+    dialect = engine.dialect
+    if dialect.name == 'sqlite' and dialect.insert_executemany_returning:
+        # SQLAlchemy cannot batch ordered RETURNING on SQLite, but rowids of a
+        # multi-row INSERT are allocated in ascending order under the write lock,
+        # so sorting the returned ids gives them in the order of the rows
+        expense_ids = sorted(db.scalars(expenses_table.insert().returning(expenses_table.c.id), expense_values))
+    elif dialect.insert_executemany_returning_sort_by_parameter_order:
+        # One batched INSERT ... RETURNING, ids returned in the order of the rows
+        expense_ids = list(db.scalars(
+            expenses_table.insert().returning(expenses_table.c.id, sort_by_parameter_order=True),
+            expense_values
+        ))
+    else:
+        # Databases without RETURNING for multi-row inserts (e.g. SQLite before 3.35)
+        expenses = [Expense(**values) for values in expense_values]
+        db.add_all(expenses)
+        db.flush()
+        expense_ids = [expense.id for expense in expenses]
+
+    share_values = [
+        {'expense_id': expense_id, 'participant_id': participant_id, 'weight': weight}
+        for expense_id, row in zip(expense_ids, rows)
+        for participant_id, weight in row['weights'].items()
+    ]
+    if share_values:
+        db.execute(ExpenseShare.__table__.insert(), share_values)
+
+    _update_ledger(db, trip_id, paid_by_id, rows, participant_ids)
+    return expense_ids
+
+
+def _update_ledger(db, trip_id, paid_by_id, rows, participant_ids):
+    balance_deltas = {}
+    for row in rows:
+        ledger.split_deltas(row['amount'], paid_by_id, row['weights'], participant_ids, deltas=balance_deltas)
+    ledger.apply_deltas(db, trip_id, balance_deltas)
+
+
+def copy_supported(db):
+    """Whether copy_rows can be used on the session's database (PostgreSQL through psycopg2)."""
+    dialect = db.get_bind().dialect
+    return dialect.name == 'postgresql' and dialect.driver == 'psycopg2'
+
+
+def _copy(cursor, table, columns, values):
+    """Streams rows to a table with COPY FROM STDIN (CSV format, None as NULL)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in values:
+        writer.writerow(['' if value is None else value for value in row])
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def copy_rows(db, trip_id, paid_by_id, rows, participant_ids):
+    """
+    Same as insert_rows, with COPY instead of INSERT statements (see copy_supported).
+
+    Descriptions must not be empty (an unquoted empty CSV field is NULL). The caller commits.
+    """
+    if not rows:
+        return []
+
+    connection = db.connection()
+    expense_ids = list(connection.scalars(
+        text("SELECT nextval(pg_get_serial_sequence('expenses', 'id')) FROM generate_series(1, :count)"),
+        {'count': len(rows)}
+    ))
+    now = datetime.utcnow()
+    # The driver's cursor, in the session's transaction
+    cursor = connection.connection.driver_connection.cursor()
+    try:
+        _copy(cursor, 'expenses', (
+            'id', 'description', 'amount', 'expense_date', 'trip_id', 'paid_by_id', 'category_id', 'date_added', 'last_modified'
+        ), (
+            (expense_id, row['description'], row['amount'], row['expense_date'].isoformat(), trip_id, paid_by_id,
+             row['category_id'], now.isoformat(), now.isoformat())
+            for expense_id, row in zip(expense_ids, rows)
+        ))
+        _copy(cursor, 'expense_shares', ('expense_id', 'participant_id', 'weight'), (
+            (expense_id, participant_id, weight)
+            for expense_id, row in zip(expense_ids, rows)
+            for participant_id, weight in row['weights'].items()
+        ))
+    finally:
+        cursor.close()
+
+    _update_ledger(db, trip_id, paid_by_id, rows, participant_ids)
+    return expense_ids
@@ -0,0 +1,118 @@
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import select, update
+from database import engine, CacheVersion
+
+# Shared caching helpers.
+#
+# - LRUCache: a thread-safe in-process LRU cache with an optional TTL.
+# - Version counters: one integer per cache key ('trip:<id>', 'categories', ...)
+#   stored in the cache_versions table and bumped by every route that changes
+#   the data behind the key, in the same transaction. Cached values are keyed
+#   by the versions they were computed from, so a bump invalidates them in
+#   every process without any cross-process messaging.
+
+CATEGORIES_KEY = 'categories' # Expense categories of every trip (bumped when a category is deleted)
+CATEGORY_LIST_KEY = 'category_list' # The list of categories (bumped when one is added or deleted)
+TRIPS_KEY = 'trips' # The list of trips
+
+
+class LRUCache:
+    """Thread-safe LRU cache. Entries older than `ttl` seconds (if set) are treated as missing."""
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        found = self.get_many([key])
+        return found.get(key, default)
+
+    def get_many(self, keys):
+        """Returns {key: value} for the keys that are cached and fresh."""
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[1] is not None and entry[1] <= now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[0]
+        return found
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, values):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def trip_key(trip_id):
+    return f"trip:{trip_id}"
+
+
+def _upsert_dialect_insert():
+    """Returns the dialect's insert construct supporting ON CONFLICT, or None."""
+    if engine.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    if engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    return None
+
+
+def bump_version(db, *keys):
+    """Increments the version counters of keys in the current transaction (the caller commits)."""
+    table = CacheVersion.__table__
+    dialect_insert = _upsert_dialect_insert()
+    for key in keys:
+        if dialect_insert is not None:
+            statement = dialect_insert(table).values(key=key, version=1)
+            db.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.key], set_={'version': table.c.version + 1}
+            ))
+        else:
+            result = db.execute(update(table).where(table.c.key == key).values(version=table.c.version + 1))
+            if result.rowcount == 0:
+                db.execute(table.insert().values(key=key, version=1))
+
+
+def bump_trip_version(db, trip_id):
+    """Marks the cached pages of a trip as stale."""
+    bump_version(db, trip_key(trip_id))
+
+
+def get_versions(db, keys):
+    """Returns {key: version} for keys, with 0 for keys that were never bumped (one query)."""
+    keys = list(keys)
+    versions = dict.fromkeys(keys, 0)
+    versions.update(db.execute(
+        select(CacheVersion.key, CacheVersion.version).where(CacheVersion.key.in_(keys))
+    ).all())
+    return versions
@@ -0,0 +1,52 @@
+from sqlalchemy import select
+from database import Category
+from caching import LRUCache, get_versions, bump_version, CATEGORIES_KEY, CATEGORY_LIST_KEY
+
+# Process-wide cache of the category list.
+#
+# Categories are global and rarely change, but the expense forms and the
+# category page all list them. The list is cached in each process under the
+# version of CATEGORY_LIST_KEY, which add_category and delete_category bump
+# (see invalidate), so a request costs one primary-key lookup of the version
+# instead of a query of the categories, and every worker picks up changes
+# made by the others.
+
+
+class CachedCategory:
+    """Read-only id and name of a category, safe to share between requests and threads."""
+    __slots__ = ('id', 'name')
+
+    def __init__(self, category_id, name):
+        self.id = category_id
+        self.name = name
+
+    def __repr__(self):
+        return f"<CachedCategory {self.id} {self.name!r}>"
+
+
+# Version -> tuple of CachedCategory (only the current version is kept)
+_cache = LRUCache(1)
+
+
+def get_categories(db):
+    """Returns all categories ordered by name, as CachedCategory objects."""
+    version = get_versions(db, [CATEGORY_LIST_KEY])[CATEGORY_LIST_KEY]
+    categories = _cache.get(version)
+    if categories is None:
+        rows = db.execute(select(Category.id, Category.name).order_by(Category.name))
+        categories = tuple(CachedCategory(category_id, name) for category_id, name in rows)
+        _cache.put(version, categories)
+    return categories
+
+
+def invalidate(db, deleted=False):
+    """
+    Marks the category list as changed, in the current transaction (the caller commits).
+
+    Deleting a category also uncategorizes expenses, which invalidates the
+    pages that show them (CATEGORIES_KEY).
+    """
+    if deleted:
+        bump_version(db, CATEGORY_LIST_KEY, CATEGORIES_KEY)
+    else:
+        bump_version(db, CATEGORY_LIST_KEY)
@@ -0,0 +1,94 @@
+import os
+from sqlalchemy import func, select
+from database import engine, Expense, Category
+from caching import LRUCache
+
+# Category suggestions for imported expenses.
+#
+# An imported line gets the category of the most recently added expense with
+# the same description (case-insensitive). All distinct descriptions of an
+# import are resolved with one windowed query per chunk, served by the
+# ix_expenses_description_lower expression index on lower(description), and
+# results are kept in an in-process LRU cache.
+#
+# The cache is invalidated when categories are deleted and, per description,
+# when expenses are written (forget), since the most recent categorized
+# expense decides the suggestion. Entries also expire after a TTL so that
+# writes handled by other processes are picked up.
+
+# Number of descriptions kept in the cache
+SUGGESTION_CACHE_SIZE = int(os.environ.get("CATEGORY_SUGGESTION_CACHE_SIZE", 10000))
+# Seconds a cached suggestion stays valid
+SUGGESTION_CACHE_TTL = int(os.environ.get("CATEGORY_SUGGESTION_CACHE_TTL", 600))
+# Descriptions per query (bound parameters in the IN list)
+LOOKUP_CHUNK_SIZE = 500
+
+# Table for SQLite's lower(), which only folds ASCII letters
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+# Normalized description -> (category_id, category_name)
+_cache = LRUCache(SUGGESTION_CACHE_SIZE, ttl=SUGGESTION_CACHE_TTL)
+
+
+def normalize_description(description):
+    """Normalizes a description the way the database's lower() does, so it can be compared with the index."""
+    description = description or ''
+    if engine.dialect.name == 'sqlite':
+        return description.translate(_ASCII_LOWER)
+    return description.lower()
+
+
+def _lookup(db, keys):
+    """Resolves normalized descriptions to the category of their most recent categorized expense."""
+    normalized = func.lower(Expense.description)
+    # Rank the categorized expenses of each description, most recently added first
+    ranked = select(
+        normalized.label('description_key'),
+        Expense.category_id,
+        func.row_number().over(
+            partition_by=normalized, order_by=(Expense.date_added.desc(), Expense.id.desc())
+        ).label('position')
+    ).where(
+        normalized.in_(keys),
+        Expense.category_id.isnot(None)
+    ).subquery()
+
+    rows = db.execute(
+        select(ranked.c.description_key, Category.id, Category.name)
+        .join(Category, Category.id == ranked.c.category_id)
+        .where(ranked.c.position == 1)
+    ).all()
+    return {key: (category_id, name) for key, category_id, name in rows}
+
+
+def suggest_categories(db, descriptions):
+    """
+    Suggests a category for each description.
+
+    Returns:
+        {description: (category_id, category_name)} for the descriptions with a
+        suggestion; descriptions without one are left out.
+    """
+    keys = {description: normalize_description(description) for description in descriptions}
+    distinct_keys = set(keys.values())
+    suggestions = _cache.get_many(distinct_keys)
+
+    missing = sorted(distinct_keys - suggestions.keys())
+    for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+        found = _lookup(db, missing[start:start + LOOKUP_CHUNK_SIZE])
+        # Only hits are cached: a description may get its first category at any time
+        _cache.put_many(found)
+        suggestions.update(found)
+
+    return {description: suggestions[key] for description, key in keys.items() if key in suggestions}
+
+
+def forget(*descriptions):
+    """Drops the cached suggestions of descriptions whose expenses were added, edited or deleted."""
+    _cache.discard(normalize_description(description) for description in descriptions)
+
+
+def invalidate():
+    """Clears every cached suggestion, e.g. after a category is deleted."""
+    _cache.clear()
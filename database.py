@@ -1,5 +1,11 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text
+import logging
+import threading
+import time
+from flask import g
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text, LargeBinary, Index, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -8,20 +14,134 @@ from datetime import datetime
 # Defaults to a SQLite database named 'tricount.db' in the current directory
 DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./tricount.db")
 
+logger = logging.getLogger(__name__)
+
+# Connection pool settings, from the environment
+# DB_POOL_SIZE: connections kept open in the pool
+# DB_MAX_OVERFLOW: extra connections opened during spikes, closed when returned
+# DB_POOL_TIMEOUT: seconds a request waits for a connection before failing
+# DB_POOL_PRE_PING: test connections before use (drops connections closed by the server)
+# DB_POOL_RECYCLE: seconds after which connections are replaced (-1 disables)
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes", "on")
+POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+
+# Apply pending schema migrations in init_db, i.e. when the app starts. Turn it
+# off to run them as a deploy step instead (flask --app app migrate).
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "true").lower() in ("1", "true", "yes", "on")
+
+
+class PoolStats:
+    """Counters of connection checkouts from the pool and of the time spent waiting for them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_checkout(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        with self._lock:
+            attempts = self.checkouts + self.timeouts
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'total_wait_seconds': round(self.total_wait, 6),
+                'average_wait_seconds': round(self.total_wait / attempts, 6) if attempts else 0.0,
+                'max_wait_seconds': round(self.max_wait, 6),
+            }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except sa_exc.TimeoutError:
+            # "QueuePool limit of size ... overflow ... reached"
+            pool_stats.record_checkout(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.record_checkout(time.perf_counter() - started)
+        return connection
+
+
 # Create a SQLAlchemy engine
 # The connect_args={"check_same_thread": False} is ONLY needed for SQLite
 # when used with Flask's default single-threaded server.
 # We should remove it to support other databases like PostgreSQL.
-if DATABASE_URL.startswith("sqlite:///"):
+if DATABASE_URL in ("sqlite://", "sqlite:///:memory:"):
+    # In-memory databases live in a single connection, the pool settings do not apply
     engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+elif DATABASE_URL.startswith("sqlite:///"):
+    engine = create_engine(
+        DATABASE_URL, connect_args={"check_same_thread": False},
+        poolclass=InstrumentedQueuePool, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT, pool_pre_ping=POOL_PRE_PING, pool_recycle=POOL_RECYCLE
+    )
 else:
     # For other databases (like PostgreSQL), remove the check_same_thread argument
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(
+        DATABASE_URL,
+        poolclass=InstrumentedQueuePool, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT, pool_pre_ping=POOL_PRE_PING, pool_recycle=POOL_RECYCLE
+    )
+
+
+def get_pool_status():
+    """Returns the state of the connection pool (checked-out connections, overflow) and the checkout wait times."""
+    pool = engine.pool
+    status = {'pool_class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'max_overflow': MAX_OVERFLOW,
+            'timeout_seconds': pool.timeout(),
+        })
+    status.update(pool_stats.as_dict())
+    return status
 
 
 # Create a configured "Session" class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def get_db():
+    """
+    Returns the database session of the current request (or app context),
+    opening it on first use. It is closed by close_db when the context ends,
+    which returns its connection to the pool.
+    """
+    if 'db' not in g:
+        g.db = SessionLocal()
+    return g.db
+
+
+def close_db(exception=None):
+    """Closes the session of the ending app context (rolling back anything left uncommitted)."""
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
 # Base class for declarative models
 Base = declarative_base()
 
@@ -39,6 +159,8 @@ class Trip(Base):
     participants = relationship("Participant", back_populates="trip", cascade="all, delete-orphan")
     expenses = relationship("Expense", back_populates="trip", cascade="all, delete-orphan")
     participant_default_proportions = relationship("TripParticipantDefaultProportion", back_populates="trip", cascade="all, delete-orphan")
+    participant_balances = relationship("ParticipantBalance", back_populates="trip", cascade="all, delete-orphan")
+    snapshot = relationship("TripSnapshot", uselist=False, cascade="all, delete-orphan") # Set while the trip is archived
 
 
 class Participant(Base):
@@ -52,6 +174,11 @@ class Participant(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # Duplicate name checks of add_participant and edit_participant
+        Index('ix_participants_trip_name', 'trip_id', 'name'),
+    )
+
     # Relationships
     trip = relationship("Trip", back_populates="participants")
     # expenses_paid = relationship("Expense", back_populates="payer") # This is handled by payer relationship in Expense
@@ -79,19 +206,66 @@ class Expense(Base):
     expense_date = Column(DateTime)
     trip_id = Column(Integer, ForeignKey("trips.id"))
     paid_by_id = Column(Integer, ForeignKey("participants.id"))
-    # Store proportions as a JSON string (now represents weights)
+    # Legacy JSON weights. No longer written: a migration moved them into expense_shares.
     proportions = Column(Text, nullable=True)
     date_added = Column(DateTime, default=datetime.utcnow)
     last_modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     # New foreign key to the Category table
     category_id = Column(Integer, ForeignKey("categories.id"), nullable=True)
 
+    # Trip-scoped scans use the indexes below that lead with trip_id
+    __table_args__ = (
+        # Serves the keyset-paginated expense listing of a trip (see pagination.py)
+        Index('ix_expenses_trip_keyset', 'trip_id', 'expense_date', 'date_added', 'id'),
+        # Covers the per-category totals over a date range (see stats.py) without reading the table
+        Index('ix_expenses_trip_date', 'trip_id', 'expense_date', 'category_id', 'amount'),
+        # Case-insensitive description lookups of the import category suggestions (see category_suggestions.py)
+        Index('ix_expenses_description_lower', func.lower(description)),
+        # Serves the API's delta sync, which reads a trip's changes in last_modified order (see api_blueprint.py)
+        Index('ix_expenses_trip_last_modified', 'trip_id', 'last_modified', 'id'),
+        # Payer lookups (Participant.expenses_paid) and the foreign key checks of participant deletions
+        Index('ix_expenses_paid_by_id', 'paid_by_id'),
+        # Re-assignment of a deleted category's expenses (delete_category)
+        Index('ix_expenses_category_id', 'category_id'),
+    )
 
     # Relationships
     trip = relationship("Trip", back_populates="expenses")
     payer = relationship("Participant", backref="expenses_paid") # Renamed backref for clarity
     # New relationship to the Category table
     category = relationship("Category", back_populates="expenses")
+    # How the expense is split (one weight per participant)
+    shares = relationship("ExpenseShare", back_populates="expense", cascade="all, delete-orphan")
+
+    @property
+    def weights(self):
+        """The split weights as a {participant_id: weight} dictionary."""
+        return {share.participant_id: share.weight for share in self.shares}
+
+    def set_weights(self, weights):
+        """Replaces the split weights with those of a {participant_id: weight} dictionary (keys may be strings)."""
+        weights = {int(participant_id): weight for participant_id, weight in weights.items()}
+        # Update shares in place so unchanged participants keep their rows
+        for share in list(self.shares):
+            if share.participant_id in weights:
+                share.weight = weights.pop(share.participant_id)
+            else:
+                self.shares.remove(share)
+        for participant_id, weight in weights.items():
+            self.shares.append(ExpenseShare(participant_id=participant_id, weight=weight))
+
+
+class ExpenseShare(Base):
+    """Represents the weight of a participant in the split of an expense."""
+    __tablename__ = "expense_shares"
+
+    expense_id = Column(Integer, ForeignKey("expenses.id"), primary_key=True)
+    participant_id = Column(Integer, ForeignKey("participants.id"), primary_key=True, index=True)
+    weight = Column(Float, nullable=False, default=1.0)
+
+    # Relationships
+    expense = relationship("Expense", back_populates="shares")
+    participant = relationship("Participant")
 
 
 class TripParticipantDefaultProportion(Base):
@@ -108,20 +282,141 @@ class TripParticipantDefaultProportion(Base):
     participant = relationship("Participant", back_populates="default_proportions")
 
 
+class ParticipantBalance(Base):
+    """
+    Running totals of what a participant paid and owes in a trip.
+
+    Maintained incrementally by the expense routes (see ledger.py) so that
+    balances can be read without walking every expense of the trip.
+    """
+    __tablename__ = "participant_balances"
+
+    trip_id = Column(Integer, ForeignKey("trips.id"), primary_key=True)
+    participant_id = Column(Integer, ForeignKey("participants.id"), primary_key=True)
+    paid = Column(Float, default=0.0, nullable=False) # Sum of expense amounts paid by the participant
+    owed = Column(Float, default=0.0, nullable=False) # Sum of the participant's weighted shares
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Relationships
+    trip = relationship("Trip", back_populates="participant_balances")
+    participant = relationship("Participant")
+
+
+class CacheVersion(Base):
+    """
+    Version counter of a cached resource (e.g. 'trip:1', 'categories').
+
+    Bumped by the routes that change the resource; caches key their entries
+    by version (see caching.py).
+    """
+    __tablename__ = "cache_versions"
+
+    key = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class DeletedExpense(Base):
+    """
+    Tombstone of a deleted expense.
+
+    Lets API clients syncing with `since` learn which expenses disappeared
+    (see api_blueprint.py). Expense ids can be reused by SQLite, so a
+    tombstone has its own id.
+    """
+    __tablename__ = "deleted_expenses"
+
+    id = Column(Integer, primary_key=True)
+    expense_id = Column(Integer, nullable=False)
+    trip_id = Column(Integer, ForeignKey("trips.id"), nullable=False)
+    deleted_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index('ix_deleted_expenses_trip_deleted_at', 'trip_id', 'deleted_at'),
+    )
+
+
+class TripSnapshot(Base):
+    """
+    Frozen state of an archived trip (see trip_archive.py).
+
+    Holds what the trip page shows (balances, transactions and category
+    totals, as JSON) and the trip's expenses and shares, which are removed
+    from the expenses tables while the trip is archived, as a compressed blob.
+    A trip is archived when it has a snapshot.
+    """
+    __tablename__ = "trip_snapshots"
+
+    trip_id = Column(Integer, ForeignKey("trips.id"), primary_key=True)
+    archived_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    format = Column(Integer, nullable=False, default=1) # Layout of the expenses blob
+    expense_count = Column(Integer, nullable=False)
+    total_amount = Column(Float, nullable=False)
+    balances = Column(Text, nullable=False) # JSON {participant name: balance}
+    transactions = Column(Text, nullable=False) # JSON list of {'from', 'to', 'amount'}
+    category_totals = Column(Text, nullable=False) # JSON list of {'category', 'amount'}, largest first
+    expenses = Column(LargeBinary, nullable=False) # zlib-compressed JSON lines, one expense (with its shares) per line
+
+
+class ImportStaging(Base):
+    """
+    Expenses extracted from an uploaded report, kept server-side until they are validated.
+
+    Rows are keyed by a random import id and expire after a TTL (see import_staging.py).
+    """
+    __tablename__ = "import_staging"
+
+    id = Column(String(32), primary_key=True) # Random hex token, passed in the validation URL
+    trip_id = Column(Integer, ForeignKey("trips.id"), index=True)
+    payload = Column(Text, nullable=False) # JSON list of the extracted expenses
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class ImportJob(Base):
+    """
+    A background PDF import: extraction and category guessing run in a worker
+    thread (see import_jobs.py) while the browser polls this row for progress.
+    """
+    __tablename__ = "import_jobs"
+
+    id = Column(String(32), primary_key=True) # Random hex token, used in the polling URL
+    trip_id = Column(Integer, ForeignKey("trips.id"), index=True)
+    filename = Column(String, nullable=True)
+    status = Column(String(16), nullable=False, default='pending') # pending, running, done or failed
+    pages_done = Column(Integer, nullable=False, default=0)
+    pages_total = Column(Integer, nullable=True) # Known once the PDF has been opened
+    lines_matched = Column(Integer, nullable=False, default=0)
+    import_id = Column(String(32), nullable=True) # Staged import to validate, once done
+    warnings = Column(Text, nullable=True) # JSON list of warning messages
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class SchemaMigration(Base):
+    """A schema migration applied to the database (see migrations.py)."""
+    __tablename__ = "schema_migrations"
+
+    version = Column(String(64), primary_key=True)
+    description = Column(String, nullable=True)
+    applied_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
 # Function to create database tables
 def init_db():
-    """Creates all database tables."""
-    # Check if tables already exist before creating
-    # This avoids errors if init_db is called multiple times
-    # In a real application, you'd use migrations (e.g., Alembic)
-    # to manage database schema changes.
-    # For this example, we'll just try to create and ignore if they exist.
+    """Creates the database tables and, unless AUTO_MIGRATE is off, applies the pending migrations."""
+    # create_all creates missing tables (with their indexes); changes to
+    # existing tables go through the versioned migrations of migrations.py.
     try:
         Base.metadata.create_all(bind=engine)
-        print("Database tables checked/created.")
+        logger.info("Database tables checked/created.")
+        if AUTO_MIGRATE:
+            # Imported here, migrations.py depends on the models of this module
+            import migrations
+            migrations.migrate()
     except Exception as e:
         # This might catch errors if the database URL is invalid or permissions are wrong
-        print(f"Error during database initialization: {e}")
+        logger.exception("Error during database initialization: %s", e)
         # Depending on the error, you might want to re-raise or handle differently
 
 
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import secrets
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import and_
+from database import SessionLocal, ImportJob
+from category_suggestions import suggest_categories
+from pdf_extraction import extract_expenses
+from import_staging import stage_import
+import metrics
+
+# Background PDF import jobs.
+#
+# upload_pdf creates an ImportJob row and hands the PDF to a local thread pool,
+# so the request returns immediately. The worker thread extracts the expenses
+# (itself using the pdf_extraction process pool for large statements), guesses
+# their categories, stages them for validation (import_staging.py) and records
+# its progress on the job row, which any app process can report. No external
+# broker is involved: running jobs of a process that stops are reported as
+# failed once they have not progressed for IMPORT_JOB_TIMEOUT seconds (pending
+# ones may just be queued behind long imports). Polling only reads the job row;
+# the worker threads record the lost jobs as failed when they start their next
+# import, and only start jobs that are still pending.
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Number of imports processed at the same time by this process
+IMPORT_JOB_WORKERS = int(os.environ.get("IMPORT_JOB_WORKERS", 2))
+# Seconds without progress after which an unfinished job is considered lost
+IMPORT_JOB_TIMEOUT = int(os.environ.get("IMPORT_JOB_TIMEOUT", 600))
+# Seconds finished jobs are kept before being purged
+IMPORT_JOB_RETENTION = int(os.environ.get("IMPORT_JOB_RETENTION", 86400))
+
+INTERRUPTED_ERROR = "The import was interrupted. Please upload the PDF again."
+
+_executor = ThreadPoolExecutor(max_workers=IMPORT_JOB_WORKERS, thread_name_prefix='import-job')
+
+
+def guess_categories(db, expenses):
+    """Sets category_id/category_name on extracted expenses from previously categorized expenses with the same description."""
+    # One lookup for all the distinct descriptions of the import (see category_suggestions.py)
+    suggestions = suggest_categories(db, {expense_data['description'] for expense_data in expenses})
+    for expense_data in expenses:
+        suggestion = suggestions.get(expense_data['description'])
+        if suggestion:
+            # Assign the found category to the extracted expense data (name for display on the validation page)
+            expense_data['category_id'], expense_data['category_name'] = suggestion
+        else:
+            # If no matching expense with category is found, set category_id to None
+            expense_data['category_id'] = None
+            expense_data['category_name'] = 'Uncategorized' # Placeholder name for display
+    return expenses
+
+
+def purge_old_jobs(db, now=None):
+    """Deletes jobs older than IMPORT_JOB_RETENTION. Returns the number of jobs deleted."""
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(seconds=IMPORT_JOB_RETENTION)
+    return db.query(ImportJob).filter(ImportJob.created_at <= cutoff).delete(synchronize_session=False)
+
+
+def submit_import(db, trip_id, pdf_bytes, filename=None):
+    """Records a new import job and queues it on the worker pool. Returns the job id."""
+    purge_old_jobs(db)
+    job = ImportJob(id=secrets.token_hex(16), trip_id=trip_id, filename=filename, status=PENDING)
+    db.add(job)
+    # The worker reads the job with its own session, so it must be committed first
+    db.commit()
+    _executor.submit(run_import, job.id, trip_id, pdf_bytes)
+    return job.id
+
+
+def _update_job(job_id, expected_status=None, **values):
+    """Updates a job, only if it has expected_status when given. Returns the number of jobs updated (0 or 1)."""
+    db = SessionLocal()
+    try:
+        query = db.query(ImportJob).filter(ImportJob.id == job_id)
+        if expected_status is not None:
+            query = query.filter(ImportJob.status == expected_status)
+        count = query.update(dict(values, updated_at=datetime.utcnow()), synchronize_session=False)
+        db.commit()
+        return count
+    finally:
+        db.close()
+
+
+def _lost_jobs_filter(now):
+    return and_(
+        ImportJob.status == RUNNING,
+        ImportJob.updated_at < now - timedelta(seconds=IMPORT_JOB_TIMEOUT),
+    )
+
+
+def fail_lost_jobs(now=None):
+    """Records running jobs that stopped progressing as failed. Returns the number of jobs updated."""
+    now = now or datetime.utcnow()
+    db = SessionLocal()
+    try:
+        count = db.query(ImportJob).filter(_lost_jobs_filter(now)).update(
+            {'status': FAILED, 'error': INTERRUPTED_ERROR, 'updated_at': now}, synchronize_session=False
+        )
+        db.commit()
+        return count
+    finally:
+        db.close()
+
+
+def run_import(job_id, trip_id, pdf_bytes):
+    """Processes an import job. Runs in a worker thread, with its own sessions."""
+    try:
+        fail_lost_jobs()
+    except Exception:
+        logger.exception("Could not record the lost import jobs")
+    # Claim the job: it may have been purged (or failed) while it was queued
+    if not _update_job(job_id, expected_status=PENDING, status=RUNNING):
+        logger.warning("Import job %s is no longer pending, it is dropped.", job_id)
+        return
+    pages = [0] # Pages read so far, for the parse metrics
+
+    def on_progress(pages_done, page_count, lines_matched):
+        pages[0] = pages_done
+        _update_job(job_id, pages_done=pages_done, pages_total=page_count, lines_matched=lines_matched)
+
+    try:
+        started = time.perf_counter()
+        try:
+            expenses, warnings = extract_expenses(pdf_bytes, progress=on_progress)
+        except Exception:
+            metrics.record_pdf_parse('import_job', time.perf_counter() - started, pages[0], failed=True)
+            raise
+        metrics.record_pdf_parse('import_job', time.perf_counter() - started, pages[0], len(expenses))
+        if not expenses:
+            _update_job(job_id, status=FAILED, error="No expenses extracted from the PDF.", warnings=json.dumps(warnings))
+            return
+
+        db = SessionLocal()
+        try:
+            guess_categories(db, expenses)
+            import_id = stage_import(db, trip_id, expenses)
+            db.commit()
+        finally:
+            db.close()
+
+        _update_job(job_id, status=DONE, import_id=import_id, lines_matched=len(expenses), warnings=json.dumps(warnings))
+
+    except Exception as e:
+        logger.exception("Import job %s failed", job_id)
+        _update_job(job_id, status=FAILED, error=f"Error processing PDF: {e}")
+
+
+def get_job(db, trip_id, job_id):
+    """Returns a trip's import job, or None. Read-only: see job_status for the jobs that stopped progressing."""
+    return db.query(ImportJob).filter(ImportJob.id == job_id, ImportJob.trip_id == trip_id).first()
+
+
+def is_lost(job, now=None):
+    """Whether a running job stopped progressing (the process running it was stopped, e.g. during a deploy)."""
+    now = now or datetime.utcnow()
+    return job.status == RUNNING and job.updated_at < now - timedelta(seconds=IMPORT_JOB_TIMEOUT)
+
+
+def job_status(job, now=None):
+    """JSON-serializable progress report of a job. Jobs that stopped progressing are reported as failed."""
+    lost = is_lost(job, now)
+    return {
+        'job_id': job.id,
+        'status': FAILED if lost else job.status,
+        'filename': job.filename,
+        'pages_done': job.pages_done,
+        'pages_total': job.pages_total,
+        'lines_matched': job.lines_matched,
+        'import_id': job.import_id,
+        'warnings': json.loads(job.warnings) if job.warnings else [],
+        'error': INTERRUPTED_ERROR if lost else job.error,
+    }
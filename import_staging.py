@@ -0,0 +1,65 @@
+import os
+import json
+import secrets
+from datetime import datetime, timedelta
+from database import ImportStaging
+
+# Server-side staging store for imported expenses.
+# Extracted expenses used to travel in the signed session cookie, which breaks
+# past the browser's cookie size limit (a few hundred statement lines) and sends
+# the whole payload back with every request. They are now stored in the
+# import_staging table under a random import id; only the id goes to the client.
+
+# Seconds a staged import stays available for validation
+IMPORT_STAGING_TTL = int(os.environ.get("IMPORT_STAGING_TTL", 3600))
+
+
+def purge_expired_imports(db, now=None):
+    """Deletes the staged imports whose TTL has passed. Returns the number of imports deleted."""
+    now = now or datetime.utcnow()
+    return db.query(ImportStaging).filter(ImportStaging.expires_at <= now).delete(synchronize_session=False)
+
+
+def stage_import(db, trip_id, expenses, ttl=IMPORT_STAGING_TTL):
+    """
+    Stores extracted expenses for later validation and returns their import id.
+
+    Expired imports are purged at the same time, so the table does not grow
+    with abandoned uploads. The caller commits.
+    """
+    now = datetime.utcnow()
+    purge_expired_imports(db, now)
+    import_id = secrets.token_hex(16)
+    db.add(ImportStaging(
+        id=import_id,
+        trip_id=trip_id,
+        payload=json.dumps(expenses),
+        created_at=now,
+        expires_at=now + timedelta(seconds=ttl)
+    ))
+    return import_id
+
+
+def get_staged_import(db, trip_id, import_id):
+    """Returns the staged expenses of an import, or None if it does not exist, belongs to another trip or has expired."""
+    if not import_id:
+        return None
+    staged = db.query(ImportStaging).filter(
+        ImportStaging.id == import_id,
+        ImportStaging.trip_id == trip_id,
+        ImportStaging.expires_at > datetime.utcnow()
+    ).first()
+    if staged is None:
+        return None
+    return json.loads(staged.payload)
+
+
+def discard_import(db, import_id):
+    """
+    Deletes a staged import once its expenses have been saved. The caller commits.
+
+    Returns the number of imports deleted: 0 when another request already
+    claimed it (e.g. a double submit), in which case its expenses must not be
+    saved again.
+    """
+    return db.query(ImportStaging).filter(ImportStaging.id == import_id).delete(synchronize_session=False)
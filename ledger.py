@@ -0,0 +1,251 @@
+from sqlalchemy import func, select, union_all, literal, exists, and_, Integer, Float
+from database import Trip, Participant, Expense, ExpenseShare, ParticipantBalance, TripSnapshot
+from settlement import simplify_debts
+
+# Balances are rounded to this many decimals when read, which absorbs the
+# floating point drift accumulated by many small incremental updates.
+BALANCE_PRECISION = 9
+
+
+def expense_deltas(expense, participant_ids, sign=1, deltas=None):
+    """
+    Computes what an expense adds to the paid/owed totals of each participant.
+
+    Follows the same split rules as utils.calculate_balances. Use sign=-1 to
+    get the deltas that remove the expense. Results are accumulated into
+    `deltas` ({participant_id: [paid, owed]}) when given, so several
+    expenses can be applied in one go.
+    """
+    return split_deltas(expense.amount, expense.paid_by_id, expense.weights, participant_ids, sign, deltas)
+
+
+def split_deltas(amount, paid_by_id, weights, participant_ids, sign=1, deltas=None):
+    """Same as expense_deltas, from the expense's values rather than an Expense object (e.g. for bulk inserts)."""
+    if deltas is None:
+        deltas = {}
+
+    def add(participant_id, paid, owed):
+        entry = deltas.setdefault(participant_id, [0.0, 0.0])
+        entry[0] += paid
+        entry[1] += owed
+
+    add(paid_by_id, sign * amount, 0.0)
+
+    # Weights of participants outside the trip are ignored, as in calculate_balances
+    total_weight = sum(weight for participant_id, weight in weights.items() if participant_id in participant_ids)
+    if total_weight > 0:
+        for participant_id, weight in weights.items():
+            if participant_id in participant_ids:
+                add(participant_id, 0.0, sign * (amount * weight) / total_weight)
+    elif participant_ids:
+        # No weights: split equally among all participants in the trip
+        equal_share = amount / len(participant_ids)
+        for participant_id in participant_ids:
+            add(participant_id, 0.0, sign * equal_share)
+
+    return deltas
+
+
+def trip_participant_ids(db, trip_id):
+    """Returns the set of participant ids of a trip."""
+    return {participant_id for (participant_id,) in db.query(Participant.id).filter_by(trip_id=trip_id)}
+
+
+def _is_seeded(db, trip_id):
+    """True when every participant of the trip has a ledger row."""
+    participant_count = db.query(func.count(Participant.id)).filter(Participant.trip_id == trip_id).scalar()
+    ledger_count = db.query(func.count(ParticipantBalance.participant_id)).filter(ParticipantBalance.trip_id == trip_id).scalar()
+    return ledger_count >= participant_count
+
+
+def apply_deltas(db, trip_id, deltas):
+    """
+    Applies paid/owed deltas to the ledger of a trip, in the caller's transaction.
+
+    Trips whose ledger has not been seeded yet (e.g. created before the ledger
+    existed) are rebuilt from their expenses instead; pending changes are
+    flushed first so the rebuild already includes them.
+    """
+    if not _is_seeded(db, trip_id):
+        rebuild_trip_ledger(db, trip_id)
+        return
+
+    for participant_id, (paid, owed) in deltas.items():
+        if not paid and not owed:
+            continue
+        # Update with SQL expressions so concurrent writers don't overwrite each other
+        db.query(ParticipantBalance).filter_by(trip_id=trip_id, participant_id=participant_id).update({
+            ParticipantBalance.paid: ParticipantBalance.paid + paid,
+            ParticipantBalance.owed: ParticipantBalance.owed + owed,
+        }, synchronize_session=False)
+
+
+def _totals_statement(trip_ids):
+    """
+    Builds the query returning (trip_id, participant_id, paid, owed) per participant.
+
+    Paid amounts, weighted shares and unweighted expenses are combined with
+    UNION ALL and summed in a single GROUP BY. Unweighted expenses (no share
+    of a participant of the trip with a positive weight) are reported under a
+    NULL participant_id since they are split equally among all participants
+    of the trip.
+    """
+    expense_filter = Expense.trip_id.in_(trip_ids)
+    # Shares of participants outside the expense's trip are ignored, as in calculate_balances
+    share_in_trip = and_(ExpenseShare.participant_id == Participant.id, Participant.trip_id == Expense.trip_id)
+    # Total weight of the expense each share belongs to (computed over the shares kept by the join)
+    total_weight = func.sum(ExpenseShare.weight).over(partition_by=ExpenseShare.expense_id)
+
+    paid_rows = select(
+        Expense.trip_id.label('trip_id'),
+        Expense.paid_by_id.label('participant_id'),
+        Expense.amount.label('paid'),
+        literal(0.0, Float).label('owed'),
+    ).where(expense_filter)
+
+    owed_rows = select(
+        Expense.trip_id,
+        ExpenseShare.participant_id,
+        literal(0.0, Float),
+        # NULLIF turns zero total weights into NULL (ignored by SUM) instead of a division error
+        Expense.amount * ExpenseShare.weight / func.nullif(total_weight, 0),
+    ).join(ExpenseShare, ExpenseShare.expense_id == Expense.id).join(Participant, share_in_trip).where(expense_filter)
+
+    unweighted_rows = select(
+        Expense.trip_id,
+        literal(None, Integer),
+        literal(0.0, Float),
+        Expense.amount,
+    ).where(
+        expense_filter,
+        ~exists().where(ExpenseShare.expense_id == Expense.id, ExpenseShare.weight > 0, share_in_trip)
+    )
+
+    rows = union_all(paid_rows, owed_rows, unweighted_rows).subquery()
+    return select(
+        rows.c.trip_id, rows.c.participant_id, func.sum(rows.c.paid), func.sum(rows.c.owed)
+    ).group_by(rows.c.trip_id, rows.c.participant_id)
+
+
+def aggregate_trip_totals(db, trip_ids):
+    """
+    Computes {trip_id: {participant_id: [paid, owed]}} for several trips in the database.
+
+    Follows the split rules of utils.calculate_balances without loading any
+    expense into Python: every participant of the requested trips gets an
+    entry, even if they have no expenses.
+    """
+    trip_ids = list(trip_ids)
+    totals = {trip_id: {} for trip_id in trip_ids}
+    if not trip_ids:
+        return totals
+
+    for trip_id, participant_id in db.query(Participant.trip_id, Participant.id).filter(Participant.trip_id.in_(trip_ids)):
+        totals[trip_id][participant_id] = [0.0, 0.0]
+
+    for trip_id, participant_id, paid, owed in db.execute(_totals_statement(trip_ids)):
+        trip_totals = totals[trip_id]
+        if participant_id is None:
+            # Unweighted expenses: split equally among all participants in the trip
+            if trip_totals and owed:
+                equal_share = owed / len(trip_totals)
+                for entry in trip_totals.values():
+                    entry[1] += equal_share
+        elif participant_id in trip_totals:
+            trip_totals[participant_id][0] += paid or 0.0
+            trip_totals[participant_id][1] += owed or 0.0
+
+    return totals
+
+
+def compute_trip_totals(db, trip_id):
+    """Recomputes {participant_id: [paid, owed]} for a trip from its expenses."""
+    db.flush() # Include pending changes of the caller's transaction
+    return aggregate_trip_totals(db, [trip_id])[trip_id]
+
+
+def rebuild_trip_ledger(db, trip_id):
+    """
+    Replaces the ledger rows of a trip with totals recomputed from its expenses.
+
+    Returns (previous, totals), both {participant_id: [paid, owed]}, so
+    callers can report drift.
+    """
+    totals = compute_trip_totals(db, trip_id)
+
+    previous = {
+        row.participant_id: [row.paid, row.owed]
+        for row in db.query(ParticipantBalance).filter_by(trip_id=trip_id)
+    }
+    db.query(ParticipantBalance).filter_by(trip_id=trip_id).delete(synchronize_session=False)
+    for participant_id, (paid, owed) in totals.items():
+        db.add(ParticipantBalance(trip_id=trip_id, participant_id=participant_id, paid=paid, owed=owed))
+    db.flush()
+
+    return previous, totals
+
+
+def get_trip_balances(db, trip_id):
+    """
+    Reads balances and settlement transactions of a trip from the ledger.
+
+    Returns the same (balances, transactions) pair as utils.calculate_balances,
+    but only touches one row per participant. Read-only: participants without
+    a ledger row (trips not seeded yet, see migrations.py and `flask --app app
+    rebuild-ledger`) get their totals recomputed from the expenses instead.
+    """
+    rows = db.query(
+        Participant.id, Participant.name, ParticipantBalance.paid, ParticipantBalance.owed
+    ).outerjoin(
+        ParticipantBalance,
+        (ParticipantBalance.participant_id == Participant.id) & (ParticipantBalance.trip_id == Participant.trip_id)
+    ).filter(Participant.trip_id == trip_id).order_by(Participant.id).all()
+
+    if any(paid is None for _, _, paid, _ in rows):
+        totals = aggregate_trip_totals(db, [trip_id])[trip_id]
+        rows = [(participant_id, name, *totals[participant_id]) for participant_id, name, _, _ in rows]
+
+    balances = {name: round(paid - owed, BALANCE_PRECISION) for _, name, paid, owed in rows}
+    return balances, simplify_debts(balances)
+
+
+def unseeded_trip_ids(db):
+    """Ids of the live trips with participants that have no ledger row."""
+    missing = (
+        select(Participant.trip_id)
+        .outerjoin(
+            ParticipantBalance,
+            (ParticipantBalance.participant_id == Participant.id) & (ParticipantBalance.trip_id == Participant.trip_id)
+        )
+        .where(ParticipantBalance.participant_id.is_(None))
+        .where(~exists().where(TripSnapshot.trip_id == Participant.trip_id))
+        .distinct()
+    )
+    return sorted(db.scalars(missing))
+
+
+def rebuild_ledger(db, trip_ids=None, tolerance=0.005):
+    """
+    Rebuilds the ledger of the given trips (all trips by default) and commits.
+
+    Returns a list of (trip_id, participant_id, ledger_balance, recomputed_balance)
+    for every participant whose stored balance was off by more than `tolerance`.
+
+    Archived trips are skipped: their expenses are in their snapshot, and
+    their ledger rows are kept as they were when they were archived.
+    """
+    if trip_ids is None:
+        trip_ids = [trip_id for (trip_id,) in db.query(Trip.id).order_by(Trip.id)]
+    archived = {trip_id for (trip_id,) in db.query(TripSnapshot.trip_id).filter(TripSnapshot.trip_id.in_(trip_ids))}
+    trip_ids = [trip_id for trip_id in trip_ids if trip_id not in archived]
+
+    drift = []
+    for trip_id in trip_ids:
+        previous, totals = rebuild_trip_ledger(db, trip_id)
+        for participant_id, (paid, owed) in totals.items():
+            old_paid, old_owed = previous.get(participant_id, (0.0, 0.0))
+            if abs((old_paid - old_owed) - (paid - owed)) > tolerance:
+                drift.append((trip_id, participant_id, old_paid - old_owed, paid - owed))
+        db.commit()
+
+    return drift
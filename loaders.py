@@ -0,0 +1,51 @@
+from sqlalchemy.orm import selectinload, joinedload
+from database import Trip, Expense
+
+# Trip loading shared by the routes.
+# Collections are loaded with selectinload: one narrow "WHERE ... IN" query per
+# collection instead of a single joined statement whose rows multiply
+# (participants x expenses x proportions) and must be de-duplicated in Python.
+
+
+def load_trip(db, trip_id, participants=True, default_proportions=False, snapshot=False):
+    """
+    Loads a trip together with the collections a page needs.
+
+    Args:
+        participants: Also load Trip.participants.
+        default_proportions: Also load Trip.participant_default_proportions.
+        snapshot: Also load Trip.snapshot (None unless the trip is archived), joined to the trip's query.
+
+    Returns:
+        The Trip, or None if it does not exist.
+    """
+    options = []
+    if participants:
+        options.append(selectinload(Trip.participants))
+    if default_proportions:
+        options.append(selectinload(Trip.participant_default_proportions))
+    if snapshot:
+        options.append(joinedload(Trip.snapshot))
+    return db.query(Trip).options(*options).filter(Trip.id == trip_id).first()
+
+
+def default_weights(trip):
+    """Returns the default weights of a trip as a {participant_id (str): weight} dictionary for the templates."""
+    return {
+        str(dp.participant_id): dp.default_proportion
+        for dp in trip.participant_default_proportions
+    }
+
+
+def expense_listing_query(db):
+    """
+    Query for expenses to be displayed, with payer, category and weights loaded.
+
+    Payers are usually already in the session through the trip's participants,
+    in which case selectinload resolves them from the identity map without a query.
+    """
+    return db.query(Expense).options(
+        selectinload(Expense.payer),
+        selectinload(Expense.category),
+        selectinload(Expense.shares)
+    )
@@ -0,0 +1,307 @@
+import io
+import os
+import re
+import time
+import pstats
+import logging
+import cProfile
+import threading
+from datetime import datetime
+from flask import g, request, Response, abort
+from database import get_pool_status
+import query_budget
+
+# Request, SQL and PDF import instrumentation, exposed on /metrics in the
+# Prometheus text format.
+#
+# - Every Flask request records its latency, status, SQL query count and SQL
+#   time under its endpoint (see init_app). Requests slower than
+#   SLOW_REQUEST_SECONDS are logged.
+# - Every statement timed by query_budget (its instrumented engines) records
+#   its duration by operation (SELECT, INSERT, ...). Statements slower than
+#   SLOW_QUERY_SECONDS are logged with their SQL (without the parameters).
+# - PDF extractions record their duration, pages and expenses (record_pdf_parse).
+# - Connection pool gauges are read from database.get_pool_status when scraped.
+#
+# Values are kept per process: with several worker processes, each scrape
+# reports the worker that answered it.
+#
+# Profiling: with PROFILING_ENABLED set, a request sent with an `X-Profile`
+# header (equal to PROFILING_TOKEN, if set) runs under cProfile. Its profile is
+# written to PROFILE_DIR, the slowest functions are logged, and the response
+# carries the file name in X-Profile-File and a Server-Timing header.
+
+logger = logging.getLogger(__name__)
+
+# Statements taking at least this many seconds are logged as slow queries
+SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_SECONDS", 0.25))
+# Requests taking at least this many seconds are logged as slow requests
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1.0))
+# If set, /metrics requires an "Authorization: Bearer <METRICS_TOKEN>" header
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Per-request profiling (X-Profile header), off by default
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes", "on")
+# If set, profiling also requires the X-Profile header to equal this token
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN")
+# Directory receiving the .prof files of profiled requests
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# Histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+PDF_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Operation label of SQL statements (other statements are reported as OTHER)
+SQL_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'}
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """Counts of observations per bucket (cumulative when exported), with their sum and count, per label set."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {} # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[index] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {label_values: list(entry) for label_values, entry in self._values.items()}
+        for label_values, entry in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labels, label_values, [('le', _format_value(float(bound)))]), cumulative
+            yield f"{self.name}_bucket", _format_labels(self.labels, label_values, [('le', '+Inf')]), entry[-1]
+            yield f"{self.name}_sum", _format_labels(self.labels, label_values), entry[-2]
+            yield f"{self.name}_count", _format_labels(self.labels, label_values), entry[-1]
+
+
+http_requests = Counter(
+    'http_requests_total', "HTTP requests by endpoint, method and status.", ('endpoint', 'method', 'status'))
+http_request_duration = Histogram(
+    'http_request_duration_seconds', "Time to produce the response (streamed bodies excluded).", ('endpoint', 'method'))
+http_request_queries = Histogram(
+    'http_request_queries', "SQL statements executed per request.", ('endpoint',), buckets=QUERY_COUNT_BUCKETS)
+http_request_query_duration = Histogram(
+    'http_request_query_duration_seconds', "Time spent in SQL per request.", ('endpoint',))
+db_query_duration = Histogram(
+    'db_query_duration_seconds', "Duration of SQL statements by operation.", ('operation',), buckets=QUERY_LATENCY_BUCKETS)
+db_slow_queries = Counter(
+    'db_slow_queries_total', "SQL statements slower than SLOW_QUERY_SECONDS.", ('operation',))
+pdf_parse_duration = Histogram(
+    'pdf_parse_duration_seconds', "Duration of PDF statement extractions.", ('source',), buckets=PDF_BUCKETS)
+pdf_pages = Counter('pdf_pages_parsed_total', "Pages of PDF statements extracted.", ('source',))
+pdf_expenses = Counter('pdf_expenses_extracted_total', "Expenses extracted from PDF statements.", ('source',))
+pdf_failures = Counter('pdf_parse_failures_total', "PDF statements that could not be read.", ('source',))
+
+METRICS = [
+    http_requests, http_request_duration, http_request_queries, http_request_query_duration,
+    db_query_duration, db_slow_queries, pdf_parse_duration, pdf_pages, pdf_expenses, pdf_failures,
+]
+
+# Connection pool gauges: metric name -> (get_pool_status key, type, help)
+POOL_METRICS = {
+    'db_pool_checked_out': ('checked_out', 'gauge', "Connections currently checked out of the pool."),
+    'db_pool_overflow': ('overflow', 'gauge', "Connections open beyond the pool size."),
+    'db_pool_checkouts_total': ('checkouts', 'counter', "Connections checked out of the pool."),
+    'db_pool_checkout_timeouts_total': ('timeouts', 'counter', "Checkouts that timed out waiting for a connection."),
+    'db_pool_checkout_wait_seconds_total': ('total_wait_seconds', 'counter', "Time spent waiting for pool connections."),
+}
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+
+    pool_status = get_pool_status()
+    for name, (key, metric_type, documentation) in POOL_METRICS.items():
+        if key in pool_status:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {_format_value(pool_status[key])}")
+    return '\n'.join(lines) + '\n'
+
+
+# SQL statements
+
+def sql_operation(statement):
+    """The operation label of a SQL statement: its first keyword, or OTHER."""
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return keyword if keyword in SQL_OPERATIONS else 'OTHER'
+
+
+# Whitespace runs collapsed in logged statements
+_WHITESPACE = re.compile(r'\s+')
+
+
+@query_budget.on_query
+def observe_query(statement, elapsed):
+    """Records the duration of a SQL statement, and logs it if it is slow."""
+    operation = sql_operation(statement)
+    db_query_duration.observe(elapsed, operation)
+    if elapsed >= SLOW_QUERY_SECONDS:
+        db_slow_queries.inc(operation)
+        # Parameters are left out, they may hold personal data
+        logger.warning("Slow query (%.3fs, endpoint %s): %s", elapsed, _current_endpoint(),
+                       _WHITESPACE.sub(' ', statement).strip()[:1000])
+
+
+# Requests
+
+_local = threading.local()
+
+
+def _current_endpoint():
+    """Endpoint of the request being handled on this thread, or '-' (e.g. background jobs)."""
+    return getattr(_local, 'endpoint', None) or '-'
+
+
+def observe_request(endpoint, method, status, seconds, queries=None, query_seconds=None):
+    """Records a handled request. Also used by the ASGI server for the API requests it serves itself."""
+    http_requests.inc(endpoint, method, str(status))
+    http_request_duration.observe(seconds, endpoint, method)
+    if queries is not None:
+        http_request_queries.observe(queries, endpoint)
+    if query_seconds is not None:
+        http_request_query_duration.observe(query_seconds, endpoint)
+    if seconds >= SLOW_REQUEST_SECONDS:
+        logger.warning("Slow request %s %s (%s): %.3fs, %s queries", method, endpoint, status, seconds,
+                       queries if queries is not None else '?')
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    # Unmatched URLs share one label, so that scanners cannot create unbounded series
+    _local.endpoint = request.endpoint or 'unmatched'
+    if PROFILING_ENABLED and 'X-Profile' in request.headers:
+        if not PROFILING_TOKEN or request.headers['X-Profile'] == PROFILING_TOKEN:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+
+def _record_request(response):
+    started = g.get('metrics_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    # Counted by query_budget for the request
+    stats = g.get('query_stats')
+    observe_request(
+        _current_endpoint(), request.method, response.status_code, elapsed,
+        queries=stats.queries if stats is not None else None,
+        query_seconds=stats.duration if stats is not None else None,
+    )
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        response.headers['X-Profile-File'] = _save_profile(profiler)
+        timings = [f'app;dur={elapsed * 1000:.1f}']
+        if stats is not None:
+            timings.append(f'db;dur={stats.duration * 1000:.1f};desc="{stats.queries} queries"')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+def _save_profile(profiler):
+    """Writes a request's profile to PROFILE_DIR and logs its slowest functions. Returns the file name."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    filename = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{_current_endpoint()}.prof"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+    if logger.isEnabledFor(logging.INFO):
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(20)
+        logger.info("Profile of %s %s (%s):\n%s", request.method, request.path, filename, summary.getvalue())
+    return filename
+
+
+def _end_request(exception=None):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        # The response was never produced (e.g. an error in another after_request hook)
+        profiler.disable()
+    _local.endpoint = None
+
+
+def metrics_view():
+    """Prometheus scrape endpoint."""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app):
+    """Registers the request instrumentation and the /metrics endpoint on a Flask app."""
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    app.teardown_request(_end_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+# PDF extraction
+
+def record_pdf_parse(source, seconds, pages=0, expenses=0, failed=False):
+    """Records a PDF statement extraction; source is where it ran ('request' or 'import_job')."""
+    pdf_parse_duration.observe(seconds, source)
+    pdf_pages.inc(source, amount=pages)
+    pdf_expenses.inc(source, amount=expenses)
+    if failed:
+        pdf_failures.inc(source)
@@ -0,0 +1,296 @@
+import re
+import json
+import logging
+from datetime import datetime
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
+from database import (engine, Trip, Participant, Category, Expense, ExpenseShare, DeletedExpense, ImportStaging, ImportJob,
+                      SchemaMigration)
+from search import sqlite_fts_exists
+import ledger
+
+# Versioned schema migrations.
+#
+# create_all (init_db) only creates missing tables, so every change to an
+# existing table is a Migration below. Applied versions are recorded in the
+# schema_migrations table; migrate() applies the pending ones in order, at
+# start-up (AUTO_MIGRATE) or with `flask --app app migrate`.
+#
+# Indexes are created with CREATE INDEX IF NOT EXISTS, and on PostgreSQL with
+# CONCURRENTLY, outside a transaction, so that writes to the table continue
+# while the index is built. A concurrent build that failed leaves an invalid
+# index behind; it is dropped and rebuilt on the next run.
+#
+# To add an index to an existing table, declare it on the model and append a
+# migration creating it with create_model_indexes(). Migrations name the
+# indexes they create, so that what they do never changes with the models.
+
+logger = logging.getLogger(__name__)
+
+# Key of the PostgreSQL advisory lock serializing migrations across processes
+MIGRATION_LOCK_KEY = 72_310_022
+
+
+class Migration:
+    """
+    A schema change.
+
+    upgrade is called with a connection. Transactional migrations run in a
+    transaction with the recording of their version; the others run in
+    autocommit mode on PostgreSQL (e.g. for CREATE INDEX CONCURRENTLY) and must
+    be safe to run again. Failures of optional migrations are logged and the
+    migration is retried on the next run.
+    """
+
+    def __init__(self, version, description, upgrade, transactional=True, optional=False):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.transactional = transactional
+        self.optional = optional
+
+    def __repr__(self):
+        return f"<Migration {self.version}>"
+
+
+# Start of the CREATE [UNIQUE] INDEX statements, where CONCURRENTLY goes
+_CREATE_INDEX = re.compile(r'^\s*CREATE (UNIQUE )?INDEX ')
+
+
+def _drop_invalid_index(connection, name):
+    """Drops a PostgreSQL index left invalid by an interrupted concurrent build, so that IF NOT EXISTS rebuilds it."""
+    invalid = connection.execute(text(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+    ), {'name': name}).first()
+    if invalid:
+        logger.warning("Dropping invalid index %s before rebuilding it.", name)
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {connection.dialect.identifier_preparer.quote(name)}"))
+
+
+def _create_index_concurrently(connection, name, ddl):
+    _drop_invalid_index(connection, name)
+    connection.execute(text(_CREATE_INDEX.sub(lambda match: f"{match.group(0)}CONCURRENTLY ", ddl, count=1)))
+
+
+def create_index(connection, index):
+    """Creates an index if it does not exist, concurrently on PostgreSQL."""
+    statement = CreateIndex(index, if_not_exists=True)
+    if connection.dialect.name == 'postgresql':
+        _create_index_concurrently(connection, index.name, str(statement.compile(dialect=connection.dialect)))
+    else:
+        connection.execute(statement)
+
+
+def create_model_indexes(connection, model, *names):
+    """Creates indexes declared on a model, by name."""
+    indexes = {index.name: index for index in model.__table__.indexes}
+    missing = set(names) - set(indexes)
+    if missing:
+        raise ValueError(f"Indexes not declared on {model.__name__}: {', '.join(sorted(missing))}")
+    for name in names:
+        create_index(connection, indexes[name])
+
+
+# The indexes declared on the models before versioned migrations (later ones have migrations of their own)
+_INITIAL_INDEXES = [
+    (Trip, ('ix_trips_id', 'ix_trips_name')),
+    (Participant, ('ix_participants_id', 'ix_participants_name')),
+    (Category, ('ix_categories_id', 'ix_categories_name')),
+    (Expense, ('ix_expenses_id', 'ix_expenses_trip_keyset', 'ix_expenses_trip_date', 'ix_expenses_description_lower',
+               'ix_expenses_trip_last_modified')),
+    (ExpenseShare, ('ix_expense_shares_participant_id',)),
+    (DeletedExpense, ('ix_deleted_expenses_trip_deleted_at',)),
+    (ImportStaging, ('ix_import_staging_trip_id', 'ix_import_staging_expires_at')),
+    (ImportJob, ('ix_import_jobs_trip_id', 'ix_import_jobs_created_at')),
+]
+
+
+def _declared_indexes(connection):
+    """Creates the indexes declared on the models when versioned migrations were introduced (what init_db did before)."""
+    for model, names in _INITIAL_INDEXES:
+        create_model_indexes(connection, model, *names)
+
+
+def _proportions_to_shares(connection, batch_size=1000):
+    """Moves the legacy JSON weights stored in Expense.proportions into expense_shares."""
+    expenses_table = Expense.__table__
+    participant_trip_ids = dict(connection.execute(select(Participant.id, Participant.trip_id)).all())
+    migrated = 0
+    while True:
+        rows = connection.execute(
+            select(expenses_table.c.id, expenses_table.c.trip_id, expenses_table.c.proportions)
+            .where(expenses_table.c.proportions.isnot(None))
+            .order_by(expenses_table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        shares = []
+        for expense_id, trip_id, proportions in rows:
+            try:
+                weights = json.loads(proportions) or {}
+            except ValueError:
+                logger.warning("Invalid proportions JSON in expense %s. Its weights are dropped.", expense_id)
+                weights = {}
+            for participant_id_str, weight in weights.items():
+                try:
+                    participant_id = int(participant_id_str)
+                except ValueError:
+                    logger.warning("Invalid participant ID string '%s' in expense %s proportions. Skipping.", participant_id_str, expense_id)
+                    continue
+                # Skip participants outside the expense's trip (deleted ones would violate the
+                # foreign key); the balances ignore their weights, so dropping them changes nothing
+                if participant_trip_ids.get(participant_id) == trip_id:
+                    shares.append({'expense_id': expense_id, 'participant_id': participant_id, 'weight': weight})
+
+        if shares:
+            connection.execute(ExpenseShare.__table__.insert(), shares)
+        connection.execute(
+            expenses_table.update()
+            .where(expenses_table.c.id.in_([expense_id for expense_id, _, _ in rows]))
+            .values(proportions=None)
+        )
+        migrated += len(rows)
+
+    if migrated:
+        logger.info("Migrated the weights of %s expenses to expense_shares.", migrated)
+
+
+# Search indexes of expense descriptions (see search.py)
+_SQLITE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5("
+    "description, content='expenses', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_ai AFTER INSERT ON expenses BEGIN "
+    "INSERT INTO expenses_fts(rowid, description) VALUES (new.id, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_ad AFTER DELETE ON expenses BEGIN "
+    "INSERT INTO expenses_fts(expenses_fts, rowid, description) VALUES ('delete', old.id, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_au AFTER UPDATE OF description ON expenses BEGIN "
+    "INSERT INTO expenses_fts(expenses_fts, rowid, description) VALUES ('delete', old.id, old.description); "
+    "INSERT INTO expenses_fts(rowid, description) VALUES (new.id, new.description); END",
+]
+
+# Index name -> CREATE INDEX statement (CONCURRENTLY is added like for the model indexes)
+_POSTGRESQL_SEARCH_INDEXES = {
+    'ix_expenses_description_trgm': "CREATE INDEX IF NOT EXISTS ix_expenses_description_trgm ON expenses USING gin (description gin_trgm_ops)",
+    'ix_expenses_description_tsv': "CREATE INDEX IF NOT EXISTS ix_expenses_description_tsv ON expenses USING gin (to_tsvector('simple', coalesce(description, '')))",
+}
+
+
+def _search_indexes(connection):
+    """
+    PostgreSQL: pg_trgm and GIN indexes for substring and word matches.
+    SQLite: an FTS5 trigram table kept in sync with expenses by triggers.
+
+    Fails without the pg_trgm privileges or on SQLite builds without FTS5
+    (before 3.34); search then falls back to LIKE scans.
+    """
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for name, statement in _POSTGRESQL_SEARCH_INDEXES.items():
+            _create_index_concurrently(connection, name, statement)
+    elif connection.dialect.name == 'sqlite':
+        created = not sqlite_fts_exists(connection)
+        for statement in _SQLITE_FTS_DDL:
+            connection.execute(text(statement))
+        if created:
+            # Index the expenses that existed before the FTS table
+            connection.execute(text("INSERT INTO expenses_fts(expenses_fts) VALUES ('rebuild')"))
+
+
+def _foreign_key_indexes(connection):
+    """Payer and category lookups of expenses, duplicate name checks of participants."""
+    create_model_indexes(connection, Expense, 'ix_expenses_paid_by_id', 'ix_expenses_category_id')
+    create_model_indexes(connection, Participant, 'ix_participants_trip_name')
+
+
+def _seed_ledgers(connection):
+    """Ledger rows of the participants that have none (trips created before the ledger), so that reads never write."""
+    # The ledger helpers work on a session, which joins the migration's transaction
+    session = Session(bind=connection)
+    try:
+        for trip_id in ledger.unseeded_trip_ids(session):
+            ledger.rebuild_trip_ledger(session, trip_id)
+        session.flush()
+    finally:
+        session.close()
+
+
+MIGRATIONS = [
+    Migration('0001_declared_indexes', "Indexes declared on the models", _declared_indexes, transactional=False),
+    Migration('0002_expense_shares', "Move the legacy JSON weights of expenses into expense_shares", _proportions_to_shares),
+    Migration('0003_search_indexes', "Search indexes of expense descriptions", _search_indexes, transactional=False, optional=True),
+    Migration('0004_foreign_key_indexes', "Indexes on expense payers and categories, participants by trip and name",
+              _foreign_key_indexes, transactional=False),
+    Migration('0005_seed_ledgers', "Balance ledger rows of the trips that have none", _seed_ledgers),
+]
+
+
+def applied_versions(bind=engine):
+    """Returns {version: applied_at} of the migrations recorded in the database."""
+    SchemaMigration.__table__.create(bind=bind, checkfirst=True)
+    with bind.connect() as connection:
+        return dict(connection.execute(select(SchemaMigration.version, SchemaMigration.applied_at)).all())
+
+
+def pending_migrations(bind=engine):
+    """The migrations not applied to the database yet, in order."""
+    applied = applied_versions(bind)
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def _record(connection, migration):
+    connection.execute(SchemaMigration.__table__.insert().values(
+        version=migration.version, description=migration.description, applied_at=datetime.utcnow()
+    ))
+
+
+def _apply(bind, migration):
+    if migration.transactional or bind.dialect.name != 'postgresql':
+        with bind.begin() as connection:
+            migration.upgrade(connection)
+            _record(connection, migration)
+        return
+
+    with bind.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT')
+        migration.upgrade(connection)
+    with bind.begin() as connection:
+        _record(connection, migration)
+
+
+def _migrate(bind):
+    applied = []
+    for migration in pending_migrations(bind):
+        logger.info("Applying migration %s: %s", migration.version, migration.description)
+        try:
+            _apply(bind, migration)
+        except IntegrityError:
+            # Recorded by another process meanwhile (only PostgreSQL runs take a lock)
+            logger.info("Migration %s was applied by another process.", migration.version)
+            continue
+        except Exception as e:
+            if not migration.optional:
+                raise
+            logger.warning("Optional migration %s failed, it will be retried on the next run: %s", migration.version, e)
+            continue
+        applied.append(migration.version)
+    return applied
+
+
+def migrate(bind=engine):
+    """Applies the pending migrations in order. Returns the versions applied."""
+    if bind.dialect.name != 'postgresql':
+        return _migrate(bind)
+    with bind.connect() as lock_connection:
+        # Other processes starting at the same time wait here, then find nothing pending
+        lock_connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+        lock_connection.commit()
+        try:
+            return _migrate(bind)
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_LOCK_KEY})
+            lock_connection.commit()
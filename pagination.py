@@ -0,0 +1,115 @@
+import base64
+from datetime import datetime
+from sqlalchemy import tuple_
+from database import Expense
+
+# Number of expenses shown per page on the trip page
+EXPENSES_PER_PAGE = 50
+
+# Columns the expense listing is ordered by (most recent first); the id breaks ties.
+# Expenses without an expense_date (legacy rows) come last, after every dated expense.
+KEYSET_COLUMNS = (Expense.expense_date, Expense.date_added, Expense.id)
+# Columns the changes of a delta sync are ordered by (oldest change first)
+SYNC_KEYSET_COLUMNS = (Expense.last_modified, Expense.id)
+
+
+def _isoformat(value):
+    # NULL dates are encoded as an empty field
+    return value.isoformat() if value is not None else ''
+
+
+def _fromisoformat(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def encode_cursor(expense):
+    """Encodes the keyset position of an expense into an opaque, URL-safe cursor string."""
+    raw = f"{_isoformat(expense.expense_date)}|{_isoformat(expense.date_added)}|{expense.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor into an (expense_date, date_added, id) tuple (dates may be None), or None if it is invalid."""
+    try:
+        expense_date_str, date_added_str, expense_id_str = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return _fromisoformat(expense_date_str), _fromisoformat(date_added_str), int(expense_id_str)
+    except (ValueError, UnicodeError):
+        return None
+
+
+def keyset_order(query):
+    """Orders an expense query like the listing: most recent first, expenses without a date last (on every database)."""
+    return query.order_by(Expense.expense_date.is_(None), *(column.desc() for column in KEYSET_COLUMNS))
+
+
+def paginate_expenses(query, cursor=None, per_page=EXPENSES_PER_PAGE):
+    """
+    Returns one page of an expense query using keyset pagination.
+
+    Expenses are ordered by (expense_date, date_added, id) descending and the
+    page starts right after the expense the cursor points to, so the cost of a
+    page does not depend on how far into the listing it is.
+
+    Expenses without an expense_date come after the dated ones. They are read
+    with a second query, only when the dated expenses do not fill the page:
+    each query keeps a plain descending order and a row comparison, which the
+    keyset index answers on every database (a NULLS LAST order or an OR in the
+    filter would make PostgreSQL sort the whole trip).
+
+    Returns (expenses, next_cursor); next_cursor is None on the last page.
+    """
+    position = decode_cursor(cursor) if cursor else None
+
+    expenses = []
+    if position is None or position[0] is not None:
+        dated = query.filter(Expense.expense_date.isnot(None)).order_by(*(column.desc() for column in KEYSET_COLUMNS))
+        if position:
+            dated = dated.filter(tuple_(*KEYSET_COLUMNS) < tuple_(*position))
+        # Fetch one extra row to know whether there is a next page
+        expenses = dated.limit(per_page + 1).all()
+
+    if len(expenses) <= per_page:
+        undated_columns = KEYSET_COLUMNS[1:]
+        undated = query.filter(Expense.expense_date.is_(None)).order_by(*(column.desc() for column in undated_columns))
+        if position and position[0] is None:
+            undated = undated.filter(tuple_(*undated_columns) < tuple_(*position[1:]))
+        expenses += undated.limit(per_page + 1 - len(expenses)).all()
+
+    next_cursor = encode_cursor(expenses[per_page - 1]) if len(expenses) > per_page else None
+    return expenses[:per_page], next_cursor
+
+
+def encode_sync_cursor(expense):
+    """Encodes the position of an expense in a delta sync (last_modified, id) into a cursor string."""
+    raw = f"{expense.last_modified.isoformat()}|{expense.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_sync_cursor(cursor):
+    """Decodes a delta sync cursor into a (last_modified, id) tuple, or None if it is invalid."""
+    try:
+        last_modified_str, expense_id_str = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(last_modified_str), int(expense_id_str)
+    except (ValueError, UnicodeError):
+        return None
+
+
+def paginate_changes(query, since, cursor=None, per_page=EXPENSES_PER_PAGE):
+    """
+    Returns one page of the expenses of a query modified after `since`.
+
+    Expenses are ordered by (last_modified, id) ascending, so an expense
+    modified while a client pages through the changes moves to the end of the
+    listing and is still returned.
+
+    Returns (expenses, next_cursor); next_cursor is None on the last page.
+    """
+    query = query.filter(Expense.last_modified > since).order_by(*SYNC_KEYSET_COLUMNS)
+
+    position = decode_sync_cursor(cursor) if cursor else None
+    if position:
+        query = query.filter(tuple_(*SYNC_KEYSET_COLUMNS) > tuple_(*position))
+
+    expenses = query.limit(per_page + 1).all()
+    next_cursor = encode_sync_cursor(expenses[per_page - 1]) if len(expenses) > per_page else None
+    return expenses[:per_page], next_cursor
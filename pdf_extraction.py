@@ -0,0 +1,241 @@
+import io
+import os
+import re
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import pdfplumber
+
+# Expense extraction from PDF statements, serial or parallel.
+#
+# Text extraction (page.extract_text) dominates the cost of an import and is
+# CPU bound, so large statements are split into page ranges that are handed to
+# a process pool. Each worker opens its own copy of the document, parses its
+# pages and returns the expenses with any warnings; results are merged in page
+# order. This module does not depend on Flask or the database so that workers
+# stay light; warnings are flashed by the caller (utils.process_pdf_report)
+# and logged from the workers.
+
+logger = logging.getLogger(__name__)
+
+# Regex for a statement line, compiled once per process (i.e. once per worker).
+# This pattern looks for:
+# - purchase_day (2 digits)
+# - space
+# - purchase_month (2 digits)
+# - space
+# - processed_day (2 digits)
+# - space
+# - processed_month (2 digits)
+# - space
+# - description (any characters, non-greedily, until the next pattern)
+# - one or more spaces
+# - interest_rate (digits, comma, 2 digits, optional space, %)
+# - one or more spaces
+# - amount (digits, comma, 2 digits)
+# Note: This regex is specific to the provided format.
+# If your PDF format varies, this regex will need adjustment.
+EXPENSE_LINE_PATTERN = re.compile(
+    r'(?P<purchase_day>\d{2})\s'
+    r'(?P<purchase_month>\d{2})\s'
+    r'(?P<processed_day>\d{2})\s'
+    r'(?P<processed_month>\d{2})\s'
+    r'(?P<description>.+?)\s+' # Added + for one or more spaces
+    r'(?P<interest_rate>\d+,\d{2})\s*%\s+' # Added + for one or more spaces
+    r'(?P<amount>\d+,\d{2})'
+)
+
+# Statements with at least this many pages are extracted in parallel (auto mode)
+PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", 16))
+# Number of worker processes (defaults to the number of CPUs)
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+
+# Workers are started with spawn: the pool is created from import job threads of a
+# multithreaded server, and a forked child would inherit locks held by other threads
+# and copies of the open database connections. Spawned workers start a fresh
+# interpreter; the functions they run only need this module.
+START_METHOD = 'spawn'
+
+# Shared process pool, created on first use and reused across imports
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+
+def parse_lines(lines, current_year=None):
+    """
+    Parses statement lines into expenses.
+
+    Returns:
+        (expenses, warnings): the expense dictionaries and the warning messages
+        for lines that could not be parsed completely.
+    """
+    current_year = current_year or datetime.now().year
+    expenses = []
+    warnings = []
+
+    for line in lines:
+        # Search the line for the pattern
+        match = EXPENSE_LINE_PATTERN.search(line)
+        if not match:
+            continue
+        purchase_data = match.groupdict()
+
+        # Convert amount from string with comma to float with dot
+        try:
+            amount = float(purchase_data['amount'].replace(',', '.'))
+        except ValueError:
+            logger.warning("Could not convert amount to float: %s", purchase_data['amount'])
+            warnings.append(f"Warning: Could not convert amount '{purchase_data['amount']}' to a number for an expense. Skipping this entry.")
+            continue # Skip this expense if amount is invalid
+
+        # Construct the expense date (assuming current year)
+        # Note: This assumes the year is the current year.
+        # If your reports span multiple years, you'll need a way to determine the correct year.
+        try:
+            month = int(purchase_data['purchase_month'])
+            day = int(purchase_data['purchase_day'])
+            # Check for valid month and day (basic check)
+            if 1 <= month <= 12 and 1 <= day <= 31:
+                # Attempt to create a date object to validate day/month combination
+                datetime(current_year, month, day)
+                expense_date = f"{current_year}-{purchase_data['purchase_month']}-{purchase_data['purchase_day']}"
+            else:
+                raise ValueError("Invalid month or day") # Raise error for invalid date parts
+        except ValueError:
+            logger.warning("Could not parse date: %s-%s", purchase_data['purchase_month'], purchase_data['purchase_day'])
+            warnings.append(f"Warning: Could not parse date '{purchase_data['purchase_month']}-{purchase_data['purchase_day']}' for an expense. Please verify on the validation page.")
+            expense_date = None # Set date to None if parsing fails
+
+        # Note: paid_by_name is not extracted by the current regex.
+        # You will need to manually select the payer on the validation page.
+        expenses.append({
+            'description': purchase_data['description'].strip(), # Strip whitespace
+            'amount': amount,
+            'paid_by_name': 'Unknown', # Placeholder - update if you can extract this
+            'expense_date': expense_date, # YYYY-MM-DD string or None
+        })
+
+    return expenses, warnings
+
+
+def extract_page_range(pdf_bytes, start, end, current_year=None, on_page=None):
+    """
+    Extracts the expenses of pages [start, end) of a PDF. Runs in the worker processes.
+
+    on_page, if given, is called with the number of expenses found after each page (serial path only).
+    """
+    expenses = []
+    warnings = []
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        for page in pdf.pages[start:end]:
+            page_text = page.extract_text()
+            # Free the parsed layout of the page, workers handle many pages
+            page.close()
+            page_expenses = []
+            if page_text: # Skip empty pages
+                page_expenses, page_warnings = parse_lines(page_text.split("\n"), current_year)
+                expenses.extend(page_expenses)
+                warnings.extend(page_warnings)
+            if on_page is not None:
+                on_page(len(page_expenses))
+    return expenses, warnings
+
+
+def count_pages(pdf_bytes):
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return len(pdf.pages)
+
+
+def page_ranges(page_count, workers):
+    """Splits pages into contiguous ranges, a couple per worker so that slow pages even out."""
+    chunk_count = max(1, min(page_count, workers * 2))
+    chunk_size = -(-page_count // chunk_count) # Ceiling division
+    return [(start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size)]
+
+
+def _get_executor(workers):
+    global _executor, _executor_workers
+    # Several import jobs may start an extraction at the same time
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(START_METHOD))
+            _executor_workers = workers
+        return _executor
+
+
+@atexit.register
+def _shutdown_executor():
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _Progress:
+    """Adapts per-page or per-range updates to the progress(pages_done, page_count, lines_matched) callback."""
+
+    def __init__(self, callback, page_count):
+        self.callback = callback
+        self.page_count = page_count
+        self.pages_done = 0
+        self.lines_matched = 0
+
+    def advance(self, pages, lines):
+        self.pages_done += pages
+        self.lines_matched += lines
+        if self.callback is not None:
+            self.callback(self.pages_done, self.page_count, self.lines_matched)
+
+
+def extract_expenses(pdf_bytes, parallel=None, workers=None, progress=None):
+    """
+    Extracts the expenses of a PDF statement.
+
+    Args:
+        pdf_bytes: The content of the PDF file.
+        parallel: True to use the process pool, False for a serial extraction,
+            None to decide from the page count (PARALLEL_MIN_PAGES).
+        workers: Number of worker processes (defaults to PDF_WORKERS).
+        progress: Optional callback, called with (pages_done, page_count, lines_matched)
+            after each page (serial) or page range (parallel).
+
+    Returns:
+        (expenses, warnings), expenses in page order.
+    """
+    workers = workers or PDF_WORKERS
+    current_year = datetime.now().year
+    page_count = count_pages(pdf_bytes)
+    tracker = _Progress(progress, page_count)
+
+    if parallel is None:
+        parallel = workers > 1 and page_count >= PARALLEL_MIN_PAGES
+    if not parallel or page_count <= 1:
+        return extract_page_range(
+            pdf_bytes, 0, page_count, current_year, on_page=lambda lines: tracker.advance(1, lines)
+        )
+
+    ranges = page_ranges(page_count, workers)
+    executor = _get_executor(workers)
+    futures = {
+        executor.submit(extract_page_range, pdf_bytes, start, end, current_year): index
+        for index, (start, end) in enumerate(ranges)
+    }
+
+    # Report progress as ranges complete, then merge in page order
+    results = [None] * len(ranges)
+    for future in as_completed(futures):
+        index = futures[future]
+        results[index] = future.result()
+        start, end = ranges[index]
+        tracker.advance(end - start, len(results[index][0]))
+
+    expenses = []
+    warnings = []
+    for range_expenses, range_warnings in results:
+        expenses.extend(range_expenses)
+        warnings.extend(range_warnings)
+    return expenses, warnings
@@ -0,0 +1,153 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, current_app, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from database import engine
+
+# Per-request SQL query and row budgets.
+# Every statement sent through the engine (and the time it took) and every row
+# loaded into an ORM object is counted against the stats that are active on
+# the current thread: the stats of the request being handled, and those of any
+# track_queries() block. The statement timings are also handed to the observers
+# registered with on_query (e.g. the metrics histograms and slow query log).
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# Callables receiving (statement, seconds) after every statement
+_query_observers = []
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in strict mode when a request uses more queries or rows than its budget."""
+
+
+class QueryStats:
+    """Counts of the SQL statements executed and ORM rows loaded, and the seconds spent executing the statements."""
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.duration = 0.0
+
+    def __repr__(self):
+        return f"<QueryStats queries={self.queries} rows={self.rows} duration={self.duration:.4f}>"
+
+
+def _active_stats():
+    if not hasattr(_local, 'stats'):
+        _local.stats = []
+    return _local.stats
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+    for stats in _active_stats():
+        stats.queries += 1
+
+
+def _time_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    for stats in _active_stats():
+        stats.duration += elapsed
+    for observer in _query_observers:
+        observer(statement, elapsed)
+
+
+def instrument_engine(instrumented_engine):
+    """Counts and times the statements of an engine (a sync Engine, e.g. AsyncEngine.sync_engine)."""
+    event.listen(instrumented_engine, 'before_cursor_execute', _count_query)
+    event.listen(instrumented_engine, 'after_cursor_execute', _time_query)
+
+
+instrument_engine(engine)
+
+
+def on_query(observer):
+    """Registers observer(statement, seconds), called after every statement of the instrumented engines."""
+    _query_observers.append(observer)
+    return observer
+
+
+@event.listens_for(Session, 'loaded_as_persistent')
+def _count_row(session, instance):
+    for stats in _active_stats():
+        stats.rows += 1
+
+
+@contextmanager
+def track_queries():
+    """
+    Counts queries and rows inside a block, e.g. around a test client call:
+
+        with track_queries() as stats:
+            client.get('/trip/1')
+        assert stats.queries <= 12
+    """
+    stats = QueryStats()
+    _active_stats().append(stats)
+    try:
+        yield stats
+    finally:
+        _active_stats().remove(stats)
+
+
+def query_budget(queries=None, rows=None):
+    """
+    Decorator declaring the query and row budget of a view.
+
+    Overruns are logged as warnings, or raise QueryBudgetExceeded when the
+    app runs with QUERY_BUDGET_STRICT enabled (e.g. in tests).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.query_budget = (queries, rows)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _start_request():
+    g.query_stats = QueryStats()
+    _active_stats().append(g.query_stats)
+
+
+def _check_budget(response):
+    stats = g.get('query_stats')
+    budget = g.get('query_budget')
+    if stats is None or budget is None:
+        return response
+
+    max_queries, max_rows = budget
+    overruns = []
+    if max_queries is not None and stats.queries > max_queries:
+        overruns.append(f"{stats.queries} queries (budget {max_queries})")
+    if max_rows is not None and stats.rows > max_rows:
+        overruns.append(f"{stats.rows} rows (budget {max_rows})")
+
+    if overruns:
+        message = f"{request.endpoint} exceeded its query budget: {', '.join(overruns)}"
+        if current_app.config.get('QUERY_BUDGET_STRICT'):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    return response
+
+
+def _end_request(exception=None):
+    stats = g.pop('query_stats', None)
+    if stats is not None and stats in _active_stats():
+        _active_stats().remove(stats)
+
+
+def init_app(app):
+    """Registers the per-request query counting on a Flask app."""
+    app.config.setdefault('QUERY_BUDGET_STRICT', False)
+    app.before_request(_start_request)
+    app.after_request(_check_budget)
+    app.teardown_request(_end_request)
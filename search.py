@@ -0,0 +1,129 @@
+from sqlalchemy import func, select, text, table, column, or_
+from database import engine, Expense
+from loaders import expense_listing_query
+
+# Database-backed search over expense descriptions.
+#
+# - PostgreSQL: GIN indexes on to_tsvector(description) (word matches, ts_rank)
+#   and on description with gin_trgm_ops (substring matches via ILIKE, similarity).
+# - SQLite: an FTS5 table with the trigram tokenizer, kept in sync with the
+#   expenses table by triggers and ranked with bm25().
+# - Anything else (or databases where the search migration could not create
+#   the indexes, see migrations.py): a case-insensitive LIKE scan.
+#
+# Searches match substrings of the description, like the original in-Python filter.
+
+SEARCH_RESULTS_PER_PAGE = 50
+
+# The trigram tokenizer cannot match terms shorter than three characters
+MIN_FTS_QUERY_LENGTH = 3
+
+# Lightweight construct for the SQLite FTS5 table (not part of the ORM models)
+expenses_fts = table('expenses_fts', column('rowid'), column('description'))
+
+# Search backend in use: 'postgresql', 'sqlite_fts5' or 'like' (detected on first use by detect_backend)
+_backend = None
+
+
+def sqlite_fts_exists(connection):
+    return connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'expenses_fts'")
+    ).first() is not None
+
+
+def detect_backend(bind=engine):
+    """Returns the search backend, detecting it from the database's search indexes on first use."""
+    global _backend
+    if _backend is None:
+        if bind.dialect.name == 'postgresql':
+            with bind.connect() as connection:
+                # The trigram index implies the pg_trgm extension its functions come from
+                indexed = connection.execute(text("SELECT to_regclass('ix_expenses_description_trgm') IS NOT NULL")).scalar()
+            _backend = 'postgresql' if indexed else 'like'
+        elif bind.dialect.name == 'sqlite':
+            with bind.connect() as connection:
+                _backend = 'sqlite_fts5' if sqlite_fts_exists(connection) else 'like'
+        else:
+            _backend = 'like'
+    return _backend
+
+
+def _like_filter(search_query):
+    return func.lower(Expense.description).contains(search_query.lower(), autoescape=True)
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _uses_fts(backend, search_query):
+    return backend == 'sqlite_fts5' and len(search_query) >= MIN_FTS_QUERY_LENGTH
+
+
+def _fts_match(search_query):
+    """FTS5 MATCH clause for a search query, quoted as a phrase so punctuation and operators are matched literally."""
+    return expenses_fts.c.description.match('"' + search_query.replace('"', '""') + '"')
+
+
+def _postgresql_terms(search_query):
+    """Returns (filter clause, relevance) for PostgreSQL: substring (trigram) or word (tsvector) matches."""
+    document = func.to_tsvector('simple', func.coalesce(Expense.description, ''))
+    ts_query = func.plainto_tsquery('simple', search_query)
+    clause = or_(
+        Expense.description.ilike('%' + _escape_like(search_query) + '%', escape='\\'),
+        document.op('@@')(ts_query)
+    )
+    relevance = func.ts_rank(document, ts_query) + func.similarity(Expense.description, search_query)
+    return clause, relevance
+
+
+def match_filter(search_query):
+    """SQL filter selecting the expenses whose description matches a search query."""
+    backend = detect_backend()
+    if backend == 'postgresql':
+        return _postgresql_terms(search_query)[0]
+    if _uses_fts(backend, search_query):
+        return Expense.id.in_(select(expenses_fts.c.rowid).where(_fts_match(search_query)))
+    return _like_filter(search_query)
+
+
+def search_expenses(db, trip_id, search_query, page=1, per_page=SEARCH_RESULTS_PER_PAGE):
+    """
+    Ranked, paginated search of a trip's expenses.
+
+    Returns a dictionary with the page of matching expenses (best matches
+    first, most recent first among equals) and the number and total amount of
+    all matches, both computed in SQL.
+    """
+    page = max(page, 1)
+    backend = detect_backend()
+    filters = [Expense.trip_id == trip_id, match_filter(search_query)]
+
+    total_count, total_amount = db.query(
+        func.count(Expense.id), func.coalesce(func.sum(Expense.amount), 0)
+    ).filter(*filters).one()
+
+    query = expense_listing_query(db).filter(*filters)
+    ordering = []
+    if backend == 'postgresql':
+        ordering.append(_postgresql_terms(search_query)[1].desc())
+    elif _uses_fts(backend, search_query):
+        # bm25() is only available in a query on the FTS table itself, so join its ranked matches
+        matches = select(
+            expenses_fts.c.rowid.label('expense_id'),
+            func.bm25(text('expenses_fts')).label('rank')
+        ).where(_fts_match(search_query)).subquery()
+        query = query.join(matches, matches.c.expense_id == Expense.id)
+        ordering.append(matches.c.rank) # Lower bm25 scores are better matches
+
+    expenses = query.order_by(
+        *ordering, Expense.expense_date.desc(), Expense.id.desc()
+    ).offset((page - 1) * per_page).limit(per_page).all()
+
+    return {
+        'expenses': expenses,
+        'total_count': total_count,
+        'total_amount': total_amount,
+        'page': page,
+        'per_page': per_page,
+    }
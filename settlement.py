@@ -0,0 +1,190 @@
+import os
+import heapq
+
+# Debt simplification: turns {participant_name: balance} into the transfers
+# ({'from', 'to', 'amount'}) that settle every balance.
+#
+# Two strategies are available:
+# - greedy: settles the largest creditor against the largest debtor, moving on
+#   to the next one as each is settled, with heaps in O(n log n). Scales to
+#   thousands of participants, and gives the same transfers as the sorted-list
+#   loop calculate_balances used before.
+# - exact: finds the minimum number of transfers. For n non-zero balances that
+#   is n - k, where k is the largest number of disjoint groups whose balances sum
+#   to zero; each group is then settled with one transfer less than its size.
+#   The search is exponential in n, so it is bounded by a number of search
+#   steps (EXACT_MAX_STEPS) past which greedy is used instead.
+#
+# Greedy is the default. Exact is opt-in (SETTLEMENT_MODE or the mode
+# argument); auto uses it for up to EXACT_MAX_PARTICIPANTS balances. Both
+# bounds depend on the number of balances only, not on a clock, so the same
+# balances always give the same transfers.
+
+# Modes accepted by simplify_debts
+GREEDY = 'greedy'
+EXACT = 'exact'
+AUTO = 'auto' # exact for small groups, greedy otherwise
+
+# Mode of the balances shown by the app (trip page, API, exports, archive snapshots)
+DEFAULT_MODE = os.environ.get("SETTLEMENT_MODE", GREEDY)
+# Largest number of non-zero balances the exact solver is used for in auto mode
+EXACT_MAX_PARTICIPANTS = 14
+# Search steps the exact solver may take (n * 2^(n-1) for n non-zero balances);
+# the default allows 16 balances, about 0.1 s
+EXACT_MAX_STEPS = int(os.environ.get("SETTLEMENT_EXACT_MAX_STEPS", 600_000))
+
+
+def _transfer(debtor, creditor, amount):
+    return {'from': debtor, 'to': creditor, 'amount': round(amount, 2)}
+
+
+def greedy_transfers(balances):
+    """Settles balances by matching the largest creditor with the largest debtor until everyone is settled."""
+    # Heaps are min-heaps: creditors are keyed by negated balance so the largest comes first.
+    # Ties are taken in the order of `balances`, as the stable sort of the former loop did.
+    creditors = [(-balance, index, name) for index, (name, balance) in enumerate(balances.items()) if balance > 0]
+    debtors = [(balance, index, name) for index, (name, balance) in enumerate(balances.items()) if balance < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transactions = []
+    creditor = debtor = None
+    while True:
+        # The current creditor and debtor stay until they are settled
+        if creditor is None:
+            if not creditors:
+                break
+            negated_credit, _, creditor = heapq.heappop(creditors)
+            credit = -negated_credit
+        if debtor is None:
+            if not debtors:
+                break
+            debt, _, debtor = heapq.heappop(debtors)
+
+        # Amount to transfer is the minimum of the absolute balances
+        transfer_amount = min(credit, -debt)
+        # Only add transaction if amount is significant to avoid tiny transfers
+        if round(transfer_amount, 2) > 0:
+            transactions.append(_transfer(debtor, creditor, transfer_amount))
+
+        # Move to the next creditor or debtor once settled (within a cent)
+        credit -= transfer_amount
+        debt += transfer_amount
+        if round(credit, 2) <= 0:
+            creditor = None
+        if round(debt, 2) >= 0:
+            debtor = None
+
+    return transactions
+
+
+def _to_cents(balances):
+    """Converts balances to integer cents that sum to exactly zero, dropping settled participants."""
+    cents = {name: round(balance * 100) for name, balance in balances.items()}
+    residue = sum(cents.values())
+    if residue and cents:
+        # Rounding left a few cents over: absorb them in the largest balance
+        largest = max(cents, key=lambda name: abs(cents[name]))
+        cents[largest] -= residue
+    return {name: value for name, value in cents.items() if value}
+
+
+def _zero_sum_groups(amounts):
+    """
+    Partitions amounts (integers summing to zero) into the largest number of zero-sum groups.
+
+    best[mask] is the largest number of zero-sum prefixes over all orderings of
+    the subset `mask`; it is memoized for every subset in increasing order.
+    Returns the groups as lists of indices.
+    """
+    n = len(amounts)
+    full = (1 << n) - 1
+    subset_sums = [0] * (full + 1)
+    best = [0] * (full + 1)
+
+    for mask in range(1, full + 1):
+        lowest = mask & -mask
+        subset_sums[mask] = subset_sums[mask ^ lowest] + amounts[lowest.bit_length() - 1]
+        most = 0
+        remaining = mask
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            if best[mask ^ bit] > most:
+                most = best[mask ^ bit]
+        best[mask] = most + (1 if subset_sums[mask] == 0 else 0)
+
+    # Walk back from the full set, cutting a group each time the remaining subset sums to zero
+    groups = []
+    current_group = []
+    mask = full
+    while mask:
+        remaining = mask
+        chosen = None
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            if chosen is None or best[mask ^ bit] > best[mask ^ chosen]:
+                chosen = bit
+        current_group.append(chosen.bit_length() - 1)
+        mask ^= chosen
+        if subset_sums[mask] == 0:
+            groups.append(current_group)
+            current_group = []
+    return groups
+
+
+def search_steps(count):
+    """Steps of the exact search for `count` non-zero balances (each subset looks at each of its members)."""
+    return count * 2 ** (count - 1) if count else 0
+
+
+def exact_transfers(balances, max_steps=EXACT_MAX_STEPS):
+    """
+    Settles balances with the minimum number of transfers.
+
+    Time and memory grow as 2^n for n non-zero balances: balances that need
+    more than `max_steps` search steps are settled greedily instead.
+    """
+    cents = _to_cents(balances)
+    if search_steps(len(cents)) > max_steps:
+        return greedy_transfers(balances)
+    names = sorted(cents)
+    amounts = [cents[name] for name in names]
+
+    transactions = []
+    for group in _zero_sum_groups(amounts):
+        # A zero-sum group without zero-sum subgroups is settled greedily in (size - 1) transfers
+        group_balances = {names[i]: amounts[i] / 100 for i in group}
+        transactions.extend(greedy_transfers(group_balances))
+
+    # Rounding to cents can break a zero-sum group (balances of half a cent); greedy,
+    # which works on the balances as they are, is kept when it needs fewer transfers
+    greedy = greedy_transfers(balances)
+    return greedy if len(greedy) < len(transactions) else transactions
+
+
+def simplify_debts(balances, mode=None, max_participants=EXACT_MAX_PARTICIPANTS, max_steps=EXACT_MAX_STEPS):
+    """
+    Turns a {participant_name: balance} mapping into a list of transfers
+    ({'from', 'to', 'amount'}) that settles every balance.
+
+    Args:
+        mode: GREEDY, EXACT (exact within `max_steps` search steps, greedy
+            above) or AUTO (exact for up to `max_participants` non-zero
+            balances as well). Defaults to DEFAULT_MODE.
+        max_participants: Largest number of non-zero balances solved exactly in auto mode.
+        max_steps: Largest number of search steps of the exact solver (see search_steps).
+    """
+    mode = mode or DEFAULT_MODE
+    if mode == GREEDY:
+        return greedy_transfers(balances)
+
+    if mode == AUTO:
+        unsettled = sum(1 for balance in balances.values() if round(balance, 2) != 0)
+        if unsettled > max_participants:
+            return greedy_transfers(balances)
+    elif mode != EXACT:
+        raise ValueError(f"Unknown settlement mode: {mode}")
+
+    return exact_transfers(balances, max_steps)
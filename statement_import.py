@@ -0,0 +1,302 @@
+import io
+import os
+import re
+import csv
+import html
+import codecs
+import logging
+from datetime import datetime
+from sqlalchemy import select
+from database import Participant, TripParticipantDefaultProportion
+from bulk_import import RowIssue, insert_rows, copy_rows, copy_supported
+from caching import bump_trip_version
+import category_suggestions
+
+# Streaming import of bank exports (CSV and OFX).
+#
+# Unlike PDF imports, which are validated row by row, statement lines are
+# saved directly: each one becomes an expense paid by the chosen participant,
+# split with the trip's default weights, with the category suggested for its
+# description. The file is parsed incrementally and loaded in chunks of
+# STATEMENT_IMPORT_CHUNK_SIZE lines, each inserted in bulk (COPY on
+# PostgreSQL, see bulk_import.copy_rows) and committed on its own, so memory
+# use does not depend on the size of the file. A failure keeps the chunks
+# committed before it.
+#
+# CSV files need a header with date, description and amount (or debit and
+# credit) columns; the delimiter is guessed from the header. Dates are read
+# day first (31/12/2024) unless they are ISO dates.
+
+logger = logging.getLogger(__name__)
+
+# Statement lines inserted and committed together
+STATEMENT_IMPORT_CHUNK_SIZE = int(os.environ.get("STATEMENT_IMPORT_CHUNK_SIZE", 5000))
+# Bytes of OFX read at a time
+OFX_READ_SIZE = 64 * 1024
+# Row issues kept for the report (the others are only counted)
+MAX_KEPT_ISSUES = 100
+
+# Which sign marks an expense: bank accounts export debits as negative amounts,
+# card statements and expense lists often as positive ones
+NEGATIVE = 'negative'
+POSITIVE = 'positive'
+
+# Accepted CSV header names (lowercased), by column
+CSV_COLUMNS = {
+    'date': {'date', 'booking date', 'transaction date', 'posting date', 'posted date', 'value date', 'date opération', 'date operation'},
+    'description': {'description', 'label', 'libellé', 'libelle', 'memo', 'payee', 'name', 'details', 'narrative', 'merchant'},
+    'amount': {'amount', 'montant', 'value', 'transaction amount'},
+    'debit': {'debit', 'débit', 'withdrawal', 'withdrawals', 'paid out', 'money out'},
+    'credit': {'credit', 'crédit', 'deposit', 'deposits', 'paid in', 'money in'},
+}
+CSV_DELIMITERS = (',', ';', '\t', '|')
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d.%m.%Y', '%d-%m-%Y', '%Y/%m/%d', '%d/%m/%y', '%Y%m%d')
+
+# Tags of an OFX file (SGML or XML): <NAME>value or </NAME>
+_OFX_TOKEN = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+class StatementError(ValueError):
+    """The file cannot be imported (unknown layout, missing columns)."""
+
+
+class ImportResult:
+    """Outcome of a statement import."""
+
+    def __init__(self):
+        self.imported = 0 # Expenses saved (committed)
+        self.skipped = 0 # Lines that could not be read
+        self.ignored = 0 # Lines with the other sign (e.g. incoming transfers)
+        self.issues = [] # RowIssue of the first MAX_KEPT_ISSUES skipped lines
+        self.error = None # Message of the error that stopped the import, if any
+
+    def add_issue(self, issue):
+        self.skipped += 1
+        if len(self.issues) < MAX_KEPT_ISSUES:
+            self.issues.append(issue)
+
+    def as_dict(self):
+        return {
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'ignored': self.ignored,
+            'issues': [issue.as_dict() for issue in self.issues],
+            'error': self.error,
+        }
+
+
+def parse_amount(value):
+    """Parses an amount such as '-1 234,56', '1,234.56', '(12.50)' or '€12'. Raises ValueError."""
+    value = (value or '').strip()
+    negative = value.startswith('-') or (value.startswith('(') and value.endswith(')')) or value.endswith('-')
+    digits = re.sub(r'[^\d,.]', '', value)
+    if not re.search(r'\d', digits):
+        raise ValueError(f"Invalid amount '{value}'.")
+    if ',' in digits and '.' in digits:
+        # The last separator is the decimal one
+        thousands = ',' if digits.rfind('.') > digits.rfind(',') else '.'
+        digits = digits.replace(thousands, '').replace(',', '.')
+    elif ',' in digits:
+        # 12,50 is a decimal comma, 1,234 a thousands separator
+        digits = digits.replace(',', '.') if re.search(r',\d{1,2}$', digits) else digits.replace(',', '')
+    amount = float(digits)
+    return -amount if negative else amount
+
+
+def parse_date(value):
+    """Parses a statement date (ISO, day first, or OFX YYYYMMDD with an optional time). Raises ValueError."""
+    value = (value or '').strip()
+    # Drop the time part: 2024-03-01T10:00, 01/03/2024 10:00, 20240301120000[-5:EST]
+    candidates = [value.split('T')[0].split(' ')[0]]
+    if re.match(r'^\d{8}', value):
+        candidates.append(value[:8])
+    for candidate in candidates:
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.strptime(candidate, date_format)
+            except ValueError:
+                continue
+    raise ValueError(f"Invalid date '{value}'.")
+
+
+def _statement_line(line, description, date_text, amount_text=None, amount=None):
+    """A parsed statement line: {'line', 'description', 'expense_date', 'amount'}, or with 'error' if it cannot be read."""
+    description = ' '.join((description or '').split())
+    parsed = {'line': line, 'description': description}
+    try:
+        if not description:
+            raise ValueError("Missing description.")
+        parsed['expense_date'] = parse_date(date_text)
+        parsed['amount'] = amount if amount is not None else parse_amount(amount_text)
+    except ValueError as e:
+        parsed['error'] = str(e)
+    return parsed
+
+
+def _csv_columns(header):
+    """Maps the columns of a CSV header to their index. Raises StatementError if required ones are missing."""
+    positions = {}
+    for index, name in enumerate(header):
+        name = name.strip().lower()
+        for column, aliases in CSV_COLUMNS.items():
+            if name in aliases and column not in positions:
+                positions[column] = index
+    if 'date' not in positions or 'description' not in positions or not ({'amount', 'debit'} & positions.keys()):
+        raise StatementError(
+            "The CSV header must have date, description and amount (or debit and credit) columns. "
+            f"Found: {', '.join(name.strip() for name in header) or 'nothing'}."
+        )
+    return positions
+
+
+def iter_csv(stream):
+    """Yields the statement lines of a CSV file (binary stream), reading it line by line."""
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    try:
+        header_line = text_stream.readline()
+        delimiter = max(CSV_DELIMITERS, key=header_line.count)
+        positions = _csv_columns(next(csv.reader([header_line], delimiter=delimiter), []))
+        width = max(positions.values()) + 1
+
+        for line, values in enumerate(csv.reader(text_stream, delimiter=delimiter), start=2):
+            if not any(value.strip() for value in values):
+                continue # Blank line
+            if len(values) < width:
+                yield {'line': line, 'description': None, 'error': f"Expected {width} columns, found {len(values)}."}
+                continue
+            description, date_text = values[positions['description']], values[positions['date']]
+            if 'amount' in positions:
+                yield _statement_line(line, description, date_text, values[positions['amount']])
+                continue
+            # Separate debit and credit columns: debits are negative amounts
+            debit = values[positions['debit']].strip()
+            credit = values[positions['credit']].strip() if 'credit' in positions else ''
+            try:
+                amount = -abs(parse_amount(debit)) if debit else abs(parse_amount(credit))
+            except ValueError as e:
+                yield {'line': line, 'description': description, 'error': str(e)}
+                continue
+            yield _statement_line(line, description, date_text, amount=amount)
+    finally:
+        # Leave the underlying stream open for its owner
+        text_stream.detach()
+
+
+def iter_ofx(stream):
+    """Yields the statement lines (STMTTRN) of an OFX file (binary stream), reading it in chunks."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buffer = ''
+    transaction = None
+    number = 0
+    while True:
+        chunk = stream.read(OFX_READ_SIZE)
+        buffer += decoder.decode(chunk, final=not chunk)
+        # Only tokens followed by the next '<' are complete, keep the rest for the next chunk
+        end = buffer.rfind('<') if chunk else len(buffer)
+        for closing, name, value in _OFX_TOKEN.findall(buffer, 0, end if end > 0 else 0):
+            name = name.upper()
+            if name == 'STMTTRN':
+                if closing and transaction is not None:
+                    number += 1
+                    description = transaction.get('NAME') or transaction.get('MEMO')
+                    yield _statement_line(number, description, transaction.get('DTPOSTED'), transaction.get('TRNAMT'))
+                transaction = None if closing else {}
+            elif transaction is not None and not closing and value.strip():
+                transaction[name] = html.unescape(value.strip())
+        buffer = buffer[end:] if end > 0 else buffer
+        if not chunk:
+            break
+
+
+def detect_format(filename, stream):
+    """Returns 'ofx' or 'csv', from the file name or the first bytes of a seekable stream."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension in ('.ofx', '.qfx'):
+        return 'ofx'
+    if extension in ('.csv', '.txt', '.tsv'):
+        return 'csv'
+    position = stream.tell()
+    head = stream.read(1024).upper()
+    stream.seek(position)
+    return 'ofx' if b'OFXHEADER' in head or b'<OFX>' in head else 'csv'
+
+
+def trip_weights(db, trip_id):
+    """The default weights of a trip's participants ({participant_id: weight}, 1 when unset)."""
+    participant_ids = list(db.scalars(select(Participant.id).where(Participant.trip_id == trip_id)))
+    defaults = dict(db.execute(
+        select(TripParticipantDefaultProportion.participant_id, TripParticipantDefaultProportion.default_proportion)
+        .where(TripParticipantDefaultProportion.trip_id == trip_id)
+    ).all())
+    return {participant_id: defaults.get(participant_id, 1.0) for participant_id in participant_ids}
+
+
+def _load_chunk(db, trip_id, paid_by_id, rows, participant_ids):
+    """Saves a chunk of rows with their suggested categories and commits it."""
+    descriptions = {row['description'] for row in rows}
+    suggestions = category_suggestions.suggest_categories(db, descriptions)
+    for row in rows:
+        row['category_id'] = suggestions.get(row['description'], (None, None))[0]
+
+    load = copy_rows if copy_supported(db) else insert_rows
+    load(db, trip_id, paid_by_id, rows, participant_ids)
+    bump_trip_version(db, trip_id) # Invalidate the cached trip page
+    db.commit()
+    category_suggestions.forget(*descriptions)
+
+
+def import_statement(db, trip_id, paid_by_id, stream, filename=None, expense_sign=NEGATIVE, chunk_size=None):
+    """
+    Imports the expenses of a CSV or OFX statement into a trip.
+
+    Args:
+        stream: Binary file object (seekable if filename does not tell the format).
+        expense_sign: NEGATIVE if expenses are the negative amounts (lines of
+            the other sign are ignored), POSITIVE otherwise.
+
+    Returns:
+        An ImportResult. Raises StatementError before anything is saved if the
+        file or the trip's weights cannot be used.
+    """
+    chunk_size = chunk_size or STATEMENT_IMPORT_CHUNK_SIZE
+    weights = trip_weights(db, trip_id)
+    if weights and not sum(weights.values()):
+        raise StatementError("The default weights of the trip are all zero. Set them before importing a statement.")
+    participant_ids = set(weights)
+
+    file_format = detect_format(filename, stream)
+    lines = iter_ofx(stream) if file_format == 'ofx' else iter_csv(stream)
+    # OFX amounts are always negative for debits
+    sign = -1 if file_format == 'ofx' or expense_sign == NEGATIVE else 1
+
+    result = ImportResult()
+    chunk = []
+    try:
+        for line in lines:
+            if 'error' in line:
+                result.add_issue(RowIssue(line['line'], line['description'], 'line', line['error']))
+                continue
+            if line['amount'] * sign <= 0:
+                result.ignored += 1
+                continue
+            chunk.append({
+                'description': line['description'],
+                'amount': abs(line['amount']),
+                'expense_date': line['expense_date'],
+                'weights': weights, # Shared by all rows, only read
+            })
+            if len(chunk) >= chunk_size:
+                _load_chunk(db, trip_id, paid_by_id, chunk, participant_ids)
+                result.imported += len(chunk)
+                chunk = []
+        if chunk:
+            _load_chunk(db, trip_id, paid_by_id, chunk, participant_ids)
+            result.imported += len(chunk)
+    except StatementError:
+        # Raised by the parsers on the header, before anything was saved
+        raise
+    except Exception as e:
+        db.rollback()
+        logger.exception("Statement import into trip %s stopped after %s expenses", trip_id, result.imported)
+        result.error = str(e)
+    return result
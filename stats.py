@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from database import Expense, Category
+
+
+def parse_date_range(start_date_str, end_date_str):
+    """
+    Parses the YYYY-MM-DD start/end dates of a filter.
+
+    Returns (start_date, end_date, errors). The end date is moved to the end of
+    its day so filtering is inclusive; invalid dates are returned as None with
+    an error message in `errors`.
+    """
+    start_date = None
+    end_date = None
+    errors = []
+    if start_date_str:
+        try:
+            # Set time to start of the day for inclusive filtering
+            start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
+        except ValueError:
+            errors.append("Invalid start date format. Please use YYYY-MM-DD.")
+
+    if end_date_str:
+        try:
+            # Set time to end of the day for inclusive filtering
+            end_date = datetime.strptime(end_date_str, '%Y-%m-%d') + timedelta(days=1) - timedelta(seconds=1)
+        except ValueError:
+            errors.append("Invalid end date format. Please use YYYY-MM-DD.")
+
+    return start_date, end_date, errors
+
+
+def category_totals(db, trip_id, start_date=None, end_date=None):
+    """
+    Sums a trip's expenses per category within an optional date range.
+
+    Runs as a single GROUP BY over the (trip_id, expense_date) range, which the
+    ix_expenses_trip_date index covers. Returns a list of
+    {'category': name, 'amount': total} sorted by amount, largest first;
+    expenses without a category are reported as 'Uncategorized'.
+    """
+    filters = [Expense.trip_id == trip_id]
+    if start_date:
+        filters.append(Expense.expense_date >= start_date)
+    if end_date:
+        filters.append(Expense.expense_date <= end_date)
+
+    rows = db.query(
+        Category.name, func.sum(Expense.amount)
+    ).select_from(Expense).outerjoin(
+        Category, Category.id == Expense.category_id
+    ).filter(*filters).group_by(Expense.category_id, Category.name).all()
+
+    totals = [
+        {"category": category_name or 'Uncategorized', "amount": amount}
+        for category_name, amount in rows
+    ]
+    # Sort by amount descending for the chart legend
+    totals.sort(key=lambda x: x['amount'], reverse=True)
+    return totals
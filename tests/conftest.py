@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+
+# Test fixtures.
+#
+# The engine is created when database.py is imported, so the tests point
+# DATABASE_URL to a scratch SQLite database before importing the app. The
+# database is created (and migrated) once per test session; every test
+# works on trips of its own, created through the routes like a user would.
+
+_WORK_DIRECTORY = tempfile.mkdtemp(prefix='expense-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_WORK_DIRECTORY, 'tests.db')}"
+# The app creates its upload folder in the working directory
+os.chdir(_WORK_DIRECTORY)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from app import app as flask_app
+from database import SessionLocal, Participant
+
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    # Views over their query budget fail the test
+    flask_app.config['QUERY_BUDGET_STRICT'] = True
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def make_trip(client, db):
+    """Creates a trip with participants. Returns (trip_id, participant ids in the order of the names)."""
+    def make(names=('Ann', 'Bob', 'Cid'), name='Trip'):
+        response = client.post('/create_trip', data={'trip_name': name})
+        assert response.status_code == 302
+        trip_id = int(response.headers['Location'].rstrip('/').rsplit('/', 1)[1])
+        for participant_name in names:
+            client.post(f'/trip/{trip_id}/add_participant', data={'participant_name': participant_name})
+        participant_ids = [participant_id for (participant_id,) in
+                           db.query(Participant.id).filter_by(trip_id=trip_id).order_by(Participant.id)]
+        return trip_id, participant_ids
+    return make
+
+
+@pytest.fixture
+def add_expense(client):
+    """Adds an expense with the add_expense form. weights is {participant_id: weight} (the form's defaults if None)."""
+    def add(trip_id, amount, paid_by, weights=None, description='Expense', expense_date='2024-05-01', category_id=''):
+        data = {
+            'description': description, 'amount': str(amount), 'paid_by': str(paid_by),
+            'expense_date': expense_date, 'category_id': str(category_id),
+        }
+        for participant_id, weight in (weights or {}).items():
+            data[f'proportion_{participant_id}'] = str(weight)
+        response = client.post(f'/trip/{trip_id}/add_expense', data=data)
+        assert response.status_code == 302
+        return response
+    return add
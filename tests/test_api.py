@@ -0,0 +1,40 @@
+import pytest
+from database import Expense
+import ledger
+
+
+def test_expenses_fields_and_etag(client, db, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    add_expense(trip_id, 30, ann, {ann: 1, bob: 2}, description='Museum')
+    url = f'/api/v1/trips/{trip_id}/expenses?fields=id,amount,weights'
+
+    response = client.get(url)
+    assert response.status_code == 200
+    [expense] = response.json['expenses']
+    assert set(expense) == {'id', 'amount', 'weights'}
+    assert expense['weights'] == {str(ann): 1.0, str(bob): 2.0}
+
+    etag = response.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    add_expense(trip_id, 12, bob, {ann: 1, bob: 1})
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+
+    assert client.get(f'/api/v1/trips/{trip_id}/expenses?fields=id,secret').status_code == 400
+
+
+def test_trip_balances_and_delta_sync(client, db, make_trip, add_expense):
+    trip_id, (ann, bob, cid) = make_trip()
+    add_expense(trip_id, 60, ann, {ann: 1, bob: 1, cid: 1})
+    add_expense(trip_id, 20, cid, {bob: 1})
+    expense_ids = [expense_id for (expense_id,) in db.query(Expense.id).filter_by(trip_id=trip_id)]
+
+    trip = client.get(f'/api/v1/trips/{trip_id}?fields=name,balances').json
+    assert set(trip) == {'name', 'balances'}
+    assert trip['balances'] == pytest.approx(ledger.get_trip_balances(db, trip_id)[0])
+    assert trip['balances'] == pytest.approx({'Ann': 40.0, 'Bob': -40.0, 'Cid': 0.0})
+
+    client.post(f'/trip/{trip_id}/delete_expense/{expense_ids[0]}')
+    sync = client.get(f'/api/v1/trips/{trip_id}/expenses?since=2000-01-01T00:00:00Z&fields=id').json
+    assert [expense['id'] for expense in sync['expenses']] == expense_ids[1:]
+    assert sync['deleted'] == expense_ids[:1]
+    assert sync['next_since'].endswith('Z')
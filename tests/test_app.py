@@ -0,0 +1,29 @@
+import pytest
+
+
+def test_pages_render(client, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    add_expense(trip_id, 25, ann, {ann: 1, bob: 1})
+
+    for url in ('/', '/create_trip', '/trip/categories', f'/trip/{trip_id}', f'/trip/{trip_id}/add_expense',
+                f'/trip/{trip_id}/add_participant', f'/trip/{trip_id}/category_stats'):
+        assert client.get(url).status_code == 200, url
+
+
+def test_create_trip_requires_a_name(client):
+    # The form is shown again
+    response = client.post('/create_trip', data={'trip_name': ''})
+    assert response.status_code == 200
+    assert b'trip_name' in response.data
+
+
+def test_pool_stats(client):
+    response = client.get('/pool_stats')
+    assert response.status_code == 200
+    assert response.json['pool_class'] == 'InstrumentedQueuePool'
+    assert response.json['checkouts'] >= 1
+
+
+@pytest.mark.parametrize('url', ['/trip/999999', '/api/v1/trips/999999'])
+def test_missing_trip(client, url):
+    assert client.get(url).status_code == 404
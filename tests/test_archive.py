@@ -0,0 +1,70 @@
+from datetime import datetime
+import pytest
+from database import Expense, ExpenseShare
+import ledger
+
+JSON = {'Accept': 'application/json'}
+
+
+def trip_rows(db, trip_id):
+    """The expenses of a trip with their shares, as comparable tuples."""
+    db.expire_all()
+    expenses = db.query(Expense).filter_by(trip_id=trip_id).order_by(Expense.id).all()
+    return [
+        (e.description, e.amount, e.expense_date, e.date_added, e.paid_by_id, e.category_id,
+         sorted((s.participant_id, s.weight) for s in db.query(ExpenseShare).filter_by(expense_id=e.id)))
+        for e in expenses
+    ]
+
+
+def test_archive_and_restore_round_trip(client, db, make_trip, add_expense):
+    trip_id, (ann, bob, cid) = make_trip()
+    add_expense(trip_id, 90, ann, {ann: 1, bob: 1, cid: 1}, description='Hotel')
+    add_expense(trip_id, 35.5, bob, {ann: 2, cid: 1}, description='Dinner', expense_date='2024-05-03')
+    # A legacy expense without a date or shares, added behind the ledger's back
+    db.add(Expense(trip_id=trip_id, description='Undated', amount=7.0, paid_by_id=cid, date_added=datetime(2024, 6, 1)))
+    ledger.rebuild_trip_ledger(db, trip_id)
+    db.commit()
+    before = trip_rows(db, trip_id)
+    balances = client.get(f'/api/v1/trips/{trip_id}/balances').json
+
+    response = client.post(f'/trip/{trip_id}/archive', headers=JSON)
+    assert response.status_code == 200 and response.json['archived'] == 3
+    assert trip_rows(db, trip_id) == []
+    # Frozen balances and transactions, read-only page
+    assert client.get(f'/api/v1/trips/{trip_id}/balances').json == balances
+    assert client.get(f'/trip/{trip_id}').status_code == 200
+    assert client.get(f'/api/v1/trips/{trip_id}/expenses').status_code == 409
+    assert client.post(f'/trip/{trip_id}/archive', headers=JSON).status_code == 409
+
+    response = client.post(f'/trip/{trip_id}/unarchive', headers=JSON)
+    assert response.json == {'restored': 3, 'renumbered': 0}
+    assert trip_rows(db, trip_id) == before
+    assert client.get(f'/api/v1/trips/{trip_id}/balances').json == balances
+    assert ledger.get_trip_balances(db, trip_id)[0] == pytest.approx(balances['balances'])
+    assert client.post(f'/trip/{trip_id}/unarchive', headers=JSON).status_code == 409
+
+
+def test_restore_renumbers_reused_ids(client, db, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    add_expense(trip_id, 20, ann, {ann: 1, bob: 1}, description='Ferry')
+    before = trip_rows(db, trip_id)
+    sync_url = f'/api/v1/trips/{trip_id}/expenses?fields=id&since='
+    sync = client.get(sync_url + '2000-01-01T00:00:00Z').json
+    [old_id] = [expense['id'] for expense in sync['expenses']]
+    client.post(f'/trip/{trip_id}/archive', headers=JSON)
+
+    # The archived expense was the last one: SQLite gives its id to the next expense
+    other_trip_id, (dan, _, _) = make_trip(name='Other')
+    add_expense(other_trip_id, 5, dan, {dan: 1})
+
+    response = client.post(f'/trip/{trip_id}/unarchive', headers=JSON)
+    assert response.json == {'restored': 1, 'renumbered': 1}
+    assert trip_rows(db, trip_id) == before
+    assert len(trip_rows(db, other_trip_id)) == 1
+
+    # Clients that synced before the archive drop the old id and fetch the new one
+    sync = client.get(sync_url + sync['next_since']).json
+    [new_id] = [expense['id'] for expense in sync['expenses']]
+    assert new_id != old_id
+    assert sync['deleted'] == [old_id]
@@ -0,0 +1,54 @@
+import asyncio
+import json
+import asgi
+
+
+async def call(method, path, query_string=b'', headers=(), body=b''):
+    """Sends one HTTP request to the ASGI application. Returns (status, headers, body)."""
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': list(headers),
+        'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000), 'root_path': '',
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response = {'body': b''}
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'], response['headers'] = message['status'], dict(message['headers'])
+        else:
+            response['body'] += message.get('body', b'')
+
+    await asgi.application(scope, receive, send)
+    return response['status'], response['headers'], response['body']
+
+
+def test_native_api_answers_like_the_flask_api(client, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    add_expense(trip_id, 30, ann, {ann: 1, bob: 2})
+    add_expense(trip_id, 12, bob, {ann: 1, bob: 1})
+    urls = [(f'/api/v1/trips/{trip_id}', b''), (f'/api/v1/trips/{trip_id}/expenses', b'per_page=1&fields=id,amount,weights'),
+            (f'/api/v1/trips/{trip_id}/balances', b''), ('/api/v1/trips/999999', b'')]
+
+    async def requests():
+        return [await call('GET', path, query_string) for path, query_string in urls]
+
+    for (path, query_string), (status, headers, body) in zip(urls, asyncio.run(requests())):
+        expected = client.get(path, query_string=query_string.decode())
+        assert status == expected.status_code, path
+        assert json.loads(body) == expected.json, path
+        if status == 200:
+            assert headers[b'etag'].decode() == expected.headers['ETag']
+            status, _, body = asyncio.run(call('GET', path, query_string, headers=[(b'if-none-match', headers[b'etag'])]))
+            assert (status, body) == (304, b'')
+
+
+def test_html_routes_are_served_by_the_flask_app(make_trip):
+    trip_id, _ = make_trip()
+    status, headers, body = asyncio.run(call('GET', f'/trip/{trip_id}'))
+    assert status == 200 and b'<html' in body
+    status, headers, _ = asyncio.run(call(
+        'POST', '/create_trip', headers=[(b'content-type', b'application/x-www-form-urlencoded')], body=b'trip_name=Async+trip'))
+    assert status == 302 and b'/trip/' in headers[b'location']
@@ -0,0 +1,23 @@
+import pytest
+from database import Trip
+from utils import calculate_balances
+from batch_settlement import settle_trips
+
+
+def test_batch_settlement_matches_calculate_balances(client, db, make_trip, add_expense):
+    trip_ids = []
+    for index in range(3):
+        trip_id, (ann, bob, cid) = make_trip(name=f'Batch {index}')
+        add_expense(trip_id, 90 + index, ann, {ann: 1, bob: 1, cid: 1})
+        add_expense(trip_id, 40, bob, {ann: 0, bob: 1, cid: 3})
+        add_expense(trip_id, 25.5, cid, {ann: 0, bob: 0, cid: 0}) # No weights: split equally
+        trip_ids.append(trip_id)
+    empty_trip_id, _ = make_trip(names=(), name='Empty')
+    trip_ids.append(empty_trip_id)
+
+    settled = list(settle_trips(db, trip_ids, chunk_size=2))
+    assert [trip_id for trip_id, _, _ in settled] == trip_ids
+    for trip_id, balances, transactions in settled:
+        expected_balances, expected_transactions = calculate_balances(db.get(Trip, trip_id))
+        assert balances == pytest.approx(expected_balances)
+        assert transactions == expected_transactions
@@ -0,0 +1,43 @@
+import pytest
+from database import Expense
+import trip_blueprint
+from import_staging import stage_import
+import ledger
+
+
+def validation_form(import_id, payer_id, staged, participant_ids):
+    form = {'import_id': import_id, 'paid_by_all': str(payer_id)}
+    for index, expense in enumerate(staged):
+        form[f'accept_expense_{index}'] = 'on'
+        form[f'expense_date_{index}'] = '2024-05-01'
+        for weight, participant_id in enumerate(participant_ids, start=1):
+            form[f'proportion_{index}_{participant_id}'] = str(weight)
+    return form
+
+
+def test_validated_import_is_saved_once(client, db, make_trip, monkeypatch):
+    trip_id, participant_ids = make_trip()
+    ann = participant_ids[0]
+    staged = [{'description': f'Line {index}', 'amount': 10.0 + index} for index in range(5)]
+    import_id = stage_import(db, trip_id, staged)
+    db.commit()
+    form = validation_form(import_id, ann, staged, participant_ids)
+    url = f'/trip/{trip_id}/validate_expenses'
+
+    response = client.post(url, data=form, headers={'Accept': 'application/json'})
+    assert response.status_code == 200
+    expense_ids = response.json['expense_ids']
+    # The ids are returned in the order of the rows
+    assert [db.get(Expense, expense_id).description for expense_id in expense_ids] == [e['description'] for e in staged]
+
+    # A second submit of the same form saves nothing
+    assert client.post(url, data=form).status_code == 302
+    # Nor one that read the staged import before the first one committed (two tabs)
+    monkeypatch.setattr(trip_blueprint, 'get_staged_import', lambda *args: staged)
+    assert client.post(url, data=form, headers={'Accept': 'application/json'}).status_code == 409
+    assert client.post(url, data=form).status_code == 302
+    assert db.query(Expense).filter_by(trip_id=trip_id).count() == len(staged)
+
+    balances, _ = ledger.get_trip_balances(db, trip_id)
+    assert sum(balances.values()) == pytest.approx(0.0, abs=0.01)
+    assert balances['Ann'] == pytest.approx(sum(e['amount'] for e in staged) * 5 / 6, abs=0.01)
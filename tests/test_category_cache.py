@@ -0,0 +1,23 @@
+from database import Category
+from query_budget import track_queries
+
+LISTED = b'<span>Cache test</span>'
+
+
+def test_category_list_follows_added_and_deleted_categories(client, db):
+    client.get('/trip/categories')
+    with track_queries() as stats:
+        assert client.get('/trip/categories').status_code == 200
+    # The version of the list only
+    cached_queries = stats.queries
+    assert cached_queries == 1
+
+    client.post('/trip/categories/add', data={'category_name': 'Cache test'})
+    assert LISTED in client.get('/trip/categories').data
+    with track_queries() as stats:
+        client.get('/trip/categories')
+    assert stats.queries == cached_queries
+
+    category_id = db.query(Category.id).filter_by(name='Cache test').scalar()
+    client.post(f'/trip/categories/delete/{category_id}')
+    assert LISTED not in client.get('/trip/categories').data
@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+from database import Expense, Category
+from import_jobs import guess_categories
+import category_suggestions
+
+
+def test_imported_lines_get_the_latest_category_of_their_description(client, db, make_trip):
+    trip_id, (ann, _, _) = make_trip()
+    food, drinks = Category(name='Suggest food'), Category(name='Suggest drinks')
+    db.add_all([food, drinks])
+    db.flush()
+    added = datetime(2024, 6, 1)
+    db.add_all([
+        Expense(trip_id=trip_id, description='CAFE Central', amount=4, paid_by_id=ann, category_id=food.id, date_added=added),
+        Expense(trip_id=trip_id, description='cafe central', amount=5, paid_by_id=ann, category_id=drinks.id,
+                date_added=added + timedelta(hours=1)),
+        Expense(trip_id=trip_id, description='Cafe Central', amount=6, paid_by_id=ann, date_added=added + timedelta(hours=2)),
+    ])
+    db.commit()
+    category_suggestions.invalidate()
+
+    expenses = guess_categories(db, [{'description': 'Cafe CENTRAL'}, {'description': 'Unknown shop'}])
+    assert (expenses[0]['category_id'], expenses[0]['category_name']) == (drinks.id, 'Suggest drinks')
+    assert (expenses[1]['category_id'], expenses[1]['category_name']) == (None, 'Uncategorized')
+
+    # A newer categorized expense changes the suggestion once its description is forgotten
+    db.add(Expense(trip_id=trip_id, description='Cafe Central', amount=7, paid_by_id=ann, category_id=food.id,
+                   date_added=added + timedelta(hours=3)))
+    db.commit()
+    assert category_suggestions.suggest_categories(db, ['cafe central'])['cafe central'][0] == drinks.id
+    category_suggestions.forget('Cafe Central')
+    assert category_suggestions.suggest_categories(db, ['cafe central'])['cafe central'][0] == food.id
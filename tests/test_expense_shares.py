@@ -0,0 +1,77 @@
+import json
+import pytest
+from datetime import datetime
+from database import Trip, Expense, ExpenseShare
+from utils import calculate_balances
+import ledger
+import migrations
+from batch_settlement import settle_trips
+
+
+def balances_by_engine(db, trip_id):
+    """The balances of a trip as computed by calculate_balances, the SQL aggregate, split_deltas and the batch engine."""
+    db.expire_all()
+    trip = db.get(Trip, trip_id)
+    names = {participant.id: participant.name for participant in trip.participants}
+
+    totals = ledger.aggregate_trip_totals(db, [trip_id])[trip_id]
+    deltas = {}
+    for expense in trip.expenses:
+        ledger.expense_deltas(expense, set(names), deltas=deltas)
+    (_, batch_balances, _), = settle_trips(db, [trip_id])
+
+    return {
+        'calculate_balances': calculate_balances(trip)[0],
+        'aggregate': {names[participant_id]: paid - owed for participant_id, (paid, owed) in totals.items()},
+        'split_deltas': {names[participant_id]: paid - owed for participant_id, (paid, owed) in deltas.items()},
+        'batch': batch_balances,
+    }
+
+
+def assert_engines_agree(db, trip_id, expected):
+    for engine_name, balances in balances_by_engine(db, trip_id).items():
+        for name, balance in expected.items():
+            assert balances.get(name, 0.0) == pytest.approx(balance, abs=1e-6), (engine_name, name)
+
+
+def test_weights_of_participants_outside_the_trip_are_ignored(db, make_trip):
+    trip_id, (ann, bob, cid) = make_trip()
+    _, (other,) = make_trip(names=('Dan',), name='Other trip')
+    expense = Expense(trip_id=trip_id, description='Dinner', amount=90.0, paid_by_id=ann, expense_date=datetime(2024, 5, 1))
+    # A participant of another trip and one that no longer exists
+    expense.shares = [ExpenseShare(participant_id=bob, weight=1), ExpenseShare(participant_id=cid, weight=2),
+                      ExpenseShare(participant_id=other, weight=3), ExpenseShare(participant_id=999999, weight=4)]
+    db.add(expense)
+    db.commit()
+
+    assert_engines_agree(db, trip_id, {'Ann': 90.0, 'Bob': -30.0, 'Cid': -60.0})
+
+
+def test_expense_weighted_only_outside_the_trip_is_split_equally(db, make_trip):
+    trip_id, (ann, bob, cid) = make_trip()
+    _, (other,) = make_trip(names=('Dan',), name='Other trip')
+    expense = Expense(trip_id=trip_id, description='Taxi', amount=30.0, paid_by_id=bob, expense_date=datetime(2024, 5, 1))
+    expense.shares = [ExpenseShare(participant_id=other, weight=1)]
+    db.add(expense)
+    db.commit()
+
+    assert_engines_agree(db, trip_id, {'Ann': -10.0, 'Bob': 20.0, 'Cid': -10.0})
+
+
+def test_migrating_legacy_proportions_keeps_the_balances(db, make_trip):
+    trip_id, (ann, bob, cid) = make_trip()
+    _, (other,) = make_trip(names=('Dan',), name='Other trip')
+    proportions = {str(bob): 1, str(cid): 2, str(other): 3, '999999': 4, 'not-an-id': 5}
+    expense = Expense(trip_id=trip_id, description='Hotel', amount=90.0, paid_by_id=ann,
+                      expense_date=datetime(2024, 5, 1), proportions=json.dumps(proportions))
+    db.add(expense)
+    db.commit()
+
+    with db.get_bind().begin() as connection:
+        migrations._proportions_to_shares(connection)
+
+    db.expire_all()
+    expense = db.get(Expense, expense.id)
+    assert expense.proportions is None
+    assert expense.weights == {bob: 1, cid: 2}
+    assert_engines_agree(db, trip_id, {'Ann': 90.0, 'Bob': -30.0, 'Cid': -60.0})
@@ -0,0 +1,45 @@
+import csv
+import io
+import pytest
+from database import engine
+import ledger
+
+
+def read_csv(response):
+    return list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+
+
+def test_expense_export_adds_up_like_the_balances(client, db, make_trip, add_expense):
+    trip_id, (ann, bob, cid) = make_trip()
+    add_expense(trip_id, 90, ann, {ann: 1, bob: 1, cid: 1}, description='Dinner', expense_date='2024-05-02')
+    add_expense(trip_id, 40, bob, {ann: 0, bob: 1, cid: 3}, description='=cmd()', expense_date='2024-05-01')
+
+    response = client.get(f'/trip/{trip_id}/export/expenses.csv')
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'].endswith('-expenses.csv"')
+    header, *rows = read_csv(response)
+    assert header == ['ID', 'Date', 'Description', 'Amount', 'Paid by', 'Category', 'Share of Ann', 'Share of Bob', 'Share of Cid']
+    # Most recent first, formulas escaped
+    assert [row[2] for row in rows] == ['Dinner', "'=cmd()"]
+
+    balances, _ = ledger.get_trip_balances(db, trip_id)
+    for column, name in enumerate(('Ann', 'Bob', 'Cid'), start=6):
+        owed = sum(float(row[column]) for row in rows)
+        paid = sum(float(row[3]) for row in rows if row[4] == name)
+        assert paid - owed == pytest.approx(balances[name], abs=0.01)
+
+    header, *rows = read_csv(client.get(f'/trip/{trip_id}/export/balances.csv'))
+    assert header == ['Participant', 'Balance']
+    assert {name: float(balance) for name, balance in rows} == pytest.approx(balances, abs=0.01)
+
+
+def test_streamed_export_returns_its_connection(client, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    add_expense(trip_id, 30, ann, {ann: 1, bob: 1})
+    checked_out = engine.pool.checkedout()
+
+    response = client.get(f'/trip/{trip_id}/export/expenses.csv')
+    assert len(read_csv(response)) == 2
+    response.close()
+
+    assert engine.pool.checkedout() == checked_out
@@ -0,0 +1,63 @@
+import secrets
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from database import engine, ImportJob
+import import_jobs
+
+
+def add_job(db, trip_id, status, idle_seconds):
+    updated_at = datetime.utcnow() - timedelta(seconds=idle_seconds)
+    job = ImportJob(id=secrets.token_hex(16), trip_id=trip_id, status=status, updated_at=updated_at, created_at=updated_at)
+    db.add(job)
+    db.commit()
+    return job.id
+
+
+def test_polling_a_lost_job_reports_it_failed_without_writing(client, db, make_trip):
+    trip_id, _ = make_trip()
+    lost = add_job(db, trip_id, import_jobs.RUNNING, import_jobs.IMPORT_JOB_TIMEOUT + 60)
+    running = add_job(db, trip_id, import_jobs.RUNNING, 1)
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(f'/trip/{trip_id}/imports/{lost}')
+        assert client.get(f'/trip/{trip_id}/imports/{lost}/progress').status_code == 200
+        assert client.get(f'/trip/{trip_id}/imports/{running}').json['status'] == import_jobs.RUNNING
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    assert response.json['status'] == import_jobs.FAILED
+    assert response.json['error'] == import_jobs.INTERRUPTED_ERROR
+    assert all(statement.lstrip().upper().startswith('SELECT') for statement in statements)
+
+    # The worker threads record it
+    assert import_jobs.fail_lost_jobs() >= 1
+    db.expire_all()
+    assert db.get(ImportJob, lost).status == import_jobs.FAILED
+    assert db.get(ImportJob, running).status == import_jobs.RUNNING
+
+
+def test_queued_jobs_are_not_lost_and_only_pending_jobs_start(db, make_trip, monkeypatch):
+    trip_id, _ = make_trip()
+    queued = add_job(db, trip_id, import_jobs.PENDING, import_jobs.IMPORT_JOB_TIMEOUT + 60)
+    failed = add_job(db, trip_id, import_jobs.FAILED, 1)
+    import_jobs.fail_lost_jobs()
+    db.expire_all()
+    job = db.get(ImportJob, queued)
+    assert job.status == import_jobs.PENDING and not import_jobs.is_lost(job)
+
+    extracted = []
+    def extract(pdf_bytes, progress=None):
+        extracted.append(pdf_bytes)
+        return [{'description': 'Bakery', 'amount': 4.2, 'expense_date': '2024-05-01'}], []
+    monkeypatch.setattr(import_jobs, 'extract_expenses', extract)
+
+    import_jobs.run_import(failed, trip_id, b'failed')
+    import_jobs.run_import(queued, trip_id, b'queued')
+    assert extracted == [b'queued']
+    db.expire_all()
+    assert db.get(ImportJob, failed).status == import_jobs.FAILED
+    assert db.get(ImportJob, queued).status == import_jobs.DONE
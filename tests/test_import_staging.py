@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+from database import ImportStaging
+from import_staging import stage_import, get_staged_import, discard_import, purge_expired_imports
+
+
+def test_staged_imports_are_scoped_to_their_trip_and_ttl(client, db, make_trip):
+    trip_id, _ = make_trip()
+    other_trip_id, _ = make_trip(name='Other')
+    expenses = [{'description': 'Café', 'amount': 3.5, 'expense_date': '2024-05-01'}]
+    import_id = stage_import(db, trip_id, expenses)
+    expired_id = stage_import(db, trip_id, expenses, ttl=-1)
+    db.commit()
+
+    assert get_staged_import(db, trip_id, import_id) == expenses
+    assert get_staged_import(db, other_trip_id, import_id) is None
+    assert get_staged_import(db, trip_id, expired_id) is None
+    assert get_staged_import(db, trip_id, None) is None
+
+    assert purge_expired_imports(db, datetime.utcnow() + timedelta(seconds=1)) >= 1
+    assert db.get(ImportStaging, expired_id) is None
+    assert discard_import(db, import_id) == 1
+    assert discard_import(db, import_id) == 0
+    db.commit()
+    assert get_staged_import(db, trip_id, import_id) is None
+
+
+def test_validation_page_of_a_staged_import(client, db, make_trip):
+    trip_id, _ = make_trip()
+    import_id = stage_import(db, trip_id, [{'description': 'Ferry ticket', 'amount': 20.0, 'expense_date': '2024-05-01',
+                                            'category_id': None, 'category_name': 'Uncategorized'}])
+    db.commit()
+    response = client.get(f'/trip/{trip_id}/validate_expenses?import_id={import_id}')
+    assert response.status_code == 200 and b'Ferry ticket' in response.data
+    assert client.get(f'/trip/{trip_id}/validate_expenses?import_id=unknown').status_code == 302
@@ -0,0 +1,80 @@
+import pytest
+from database import Trip, Expense, Participant, ParticipantBalance
+from utils import calculate_balances
+import ledger
+import migrations
+
+
+def assert_ledger_matches(db, trip_id):
+    """The ledger gives the balances that calculate_balances recomputes from the expenses."""
+    db.expire_all()
+    balances, transactions = ledger.get_trip_balances(db, trip_id)
+    expected_balances, expected_transactions = calculate_balances(db.get(Trip, trip_id))
+    assert balances.keys() == expected_balances.keys()
+    for name, balance in expected_balances.items():
+        assert balances[name] == pytest.approx(balance, abs=1e-6)
+    assert transactions == expected_transactions
+
+
+def test_ledger_follows_added_edited_and_deleted_expenses(client, db, make_trip, add_expense):
+    trip_id, (ann, bob, cid) = make_trip()
+    add_expense(trip_id, 90, ann, {ann: 1, bob: 1, cid: 1})
+    add_expense(trip_id, 40, bob, {ann: 0, bob: 1, cid: 3})
+    add_expense(trip_id, 25.5, cid, {ann: 0, bob: 0, cid: 0}) # No weights: split equally
+    assert_ledger_matches(db, trip_id)
+
+    expense_ids = [expense_id for (expense_id,) in db.query(Expense.id).filter_by(trip_id=trip_id).order_by(Expense.id)]
+    response = client.post(f'/trip/{trip_id}/edit_expense/{expense_ids[0]}', data={
+        'description': 'Edited', 'amount': '120', 'paid_by': str(cid), 'expense_date': '2024-05-02',
+        'category_id': '', f'proportion_{ann}': '2', f'proportion_{bob}': '1', f'proportion_{cid}': '0',
+    })
+    assert response.status_code == 302
+    assert_ledger_matches(db, trip_id)
+
+    assert client.post(f'/trip/{trip_id}/delete_expense/{expense_ids[1]}').status_code == 302
+    assert_ledger_matches(db, trip_id)
+
+    # A new participant takes a share of the expenses without weights
+    client.post(f'/trip/{trip_id}/add_participant', data={'participant_name': 'Dan'})
+    assert_ledger_matches(db, trip_id)
+
+
+def test_adding_a_participant_is_a_single_commit(client, db, make_trip, add_expense, monkeypatch):
+    trip_id, (ann, bob, _) = make_trip()
+    add_expense(trip_id, 30, ann, {ann: 0, bob: 0})
+    def fail(db, trip_id):
+        raise RuntimeError("Ledger rebuild failed")
+    monkeypatch.setattr(ledger, 'rebuild_trip_ledger', fail)
+    with pytest.raises(RuntimeError):
+        client.post(f'/trip/{trip_id}/add_participant', data={'participant_name': 'Eve'})
+    # Nothing of the new participant was kept
+    db.expire_all()
+    assert db.query(Participant).filter_by(trip_id=trip_id, name='Eve').count() == 0
+    assert_ledger_matches(db, trip_id)
+
+
+def test_reading_balances_of_an_unseeded_trip_does_not_write(client, db, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    add_expense(trip_id, 30, ann, {ann: 1, bob: 2})
+    db.query(ParticipantBalance).filter_by(trip_id=trip_id).delete()
+    db.commit()
+
+    assert client.get(f'/trip/{trip_id}').status_code == 200
+    assert client.get(f'/api/v1/trips/{trip_id}/balances').status_code == 200
+    assert db.query(ParticipantBalance).filter_by(trip_id=trip_id).count() == 0
+    assert_ledger_matches(db, trip_id)
+
+
+def test_seed_ledgers_migration(db, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    add_expense(trip_id, 30, ann, {ann: 1, bob: 2})
+    db.query(ParticipantBalance).filter_by(trip_id=trip_id).delete()
+    db.commit()
+    assert trip_id in ledger.unseeded_trip_ids(db)
+
+    with db.get_bind().begin() as connection:
+        migrations._seed_ledgers(connection)
+
+    assert trip_id not in ledger.unseeded_trip_ids(db)
+    assert db.query(ParticipantBalance).filter_by(trip_id=trip_id).count() == 3
+    assert_ledger_matches(db, trip_id)
@@ -0,0 +1,46 @@
+import re
+import metrics
+from query_budget import track_queries
+
+
+def sample(text, name, **labels):
+    """Value of a sample of the Prometheus text format (0 if absent)."""
+    wanted = ','.join(f'{label}="{value}"' for label, value in labels.items())
+    match = re.search(rf'^{re.escape(name)}\{{{re.escape(wanted)}\}} (\S+)$', text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+def test_requests_and_queries_are_counted(client, make_trip):
+    trip_id, _ = make_trip()
+    before = client.get('/metrics').get_data(as_text=True)
+    client.get(f'/trip/{trip_id}')
+    client.get('/no-such-page')
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    after = response.get_data(as_text=True)
+
+    labels = {'endpoint': 'trip_blueprint.view_trip', 'method': 'GET', 'status': '200'}
+    assert sample(after, 'http_requests_total', **labels) == sample(before, 'http_requests_total', **labels) + 1
+    unmatched = {'endpoint': 'unmatched', 'method': 'GET', 'status': '404'}
+    assert sample(after, 'http_requests_total', **unmatched) == sample(before, 'http_requests_total', **unmatched) + 1
+    assert sample(after, 'http_request_queries_count', endpoint='trip_blueprint.view_trip') >= 1
+    assert sample(after, 'db_query_duration_seconds_count', operation='SELECT') > sample(before, 'db_query_duration_seconds_count', operation='SELECT')
+
+
+def test_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+
+def test_statements_are_timed_once_by_the_query_budget_hook(client, make_trip, monkeypatch, caplog):
+    trip_id, _ = make_trip()
+    def observed():
+        return sum(entry[-1] for entry in metrics.db_query_duration._values.values())
+    before = observed()
+    monkeypatch.setattr(metrics, 'SLOW_QUERY_SECONDS', 0)
+    with track_queries() as stats:
+        client.get(f'/trip/{trip_id}')
+    assert stats.queries >= 1
+    assert observed() - before == stats.queries
+    assert caplog.text.count('Slow query') == stats.queries
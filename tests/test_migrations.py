@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import create_engine, text
+from database import Base
+import migrations
+
+
+@pytest.fixture
+def legacy_engine(tmp_path):
+    """A database with the tables of the models but none of their indexes, like one created before the indexes."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(text(f"DROP INDEX {index.name}"))
+    yield engine
+    engine.dispose()
+
+
+def index_names(engine):
+    # The inspector skips expression indexes on SQLite
+    with engine.connect() as connection:
+        return set(connection.scalars(text("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")))
+
+
+def test_initial_indexes_do_not_follow_the_models(legacy_engine):
+    with legacy_engine.begin() as connection:
+        migrations.MIGRATIONS[0].upgrade(connection)
+    created = index_names(legacy_engine)
+    assert created == {name for _, names in migrations._INITIAL_INDEXES for name in names}
+    # Owned by 0004_foreign_key_indexes
+    assert not created & {'ix_expenses_paid_by_id', 'ix_expenses_category_id', 'ix_participants_trip_name'}
+
+
+def test_migrate_applies_every_migration_once(legacy_engine):
+    assert migrations.migrate(legacy_engine) == [migration.version for migration in migrations.MIGRATIONS]
+    assert set(migrations.applied_versions(legacy_engine)) == {migration.version for migration in migrations.MIGRATIONS}
+    declared = {index.name for table in Base.metadata.sorted_tables for index in table.indexes}
+    assert declared <= index_names(legacy_engine)
+
+    assert migrations.migrate(legacy_engine) == []
+    assert migrations.pending_migrations(legacy_engine) == []
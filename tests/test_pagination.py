@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from database import Expense
+from pagination import paginate_expenses, encode_cursor, decode_cursor, keyset_order
+
+
+def add_expenses(db, trip_id, payer_id, dates):
+    """Adds one expense per date (None for an expense without a date), recorded one second apart."""
+    recorded = datetime(2024, 6, 1)
+    expenses = []
+    for index, expense_date in enumerate(dates):
+        expense = Expense(trip_id=trip_id, description=f'Expense {index}', amount=10.0 + index, paid_by_id=payer_id,
+                          expense_date=expense_date, date_added=recorded + timedelta(seconds=index))
+        db.add(expense)
+        expenses.append(expense)
+    db.commit()
+    return expenses
+
+
+def listing_order(expenses):
+    """Most recent first, expenses without a date last."""
+    dated = sorted((e for e in expenses if e.expense_date is not None), key=lambda e: (e.expense_date, e.date_added, e.id), reverse=True)
+    undated = sorted((e for e in expenses if e.expense_date is None), key=lambda e: (e.date_added, e.id), reverse=True)
+    return [e.id for e in dated + undated]
+
+
+def test_cursor_round_trip():
+    expense = SimpleNamespace(expense_date=datetime(2024, 5, 1, 12, 30), date_added=datetime(2024, 5, 2), id=7)
+    assert decode_cursor(encode_cursor(expense)) == (expense.expense_date, expense.date_added, 7)
+    undated = SimpleNamespace(expense_date=None, date_added=datetime(2024, 5, 2), id=8)
+    assert decode_cursor(encode_cursor(undated)) == (None, datetime(2024, 5, 2), 8)
+    assert decode_cursor('not a cursor') is None
+
+
+def test_pages_cover_every_expense_once_in_order(db, make_trip):
+    trip_id, (ann, _, _) = make_trip()
+    day = datetime(2024, 5, 1)
+    # Ties on the date, and expenses without a date
+    dates = [day, day, None, day + timedelta(days=1), None, day - timedelta(days=3), day, None, day + timedelta(days=1)]
+    expenses = add_expenses(db, trip_id, ann, dates)
+    expected = listing_order(expenses)
+    query = db.query(Expense).filter(Expense.trip_id == trip_id)
+
+    for per_page in (1, 2, 3, 4, len(expenses), len(expenses) + 1):
+        seen, cursor = [], None
+        while True:
+            page, cursor = paginate_expenses(query, cursor, per_page=per_page)
+            assert len(page) <= per_page
+            seen += [expense.id for expense in page]
+            if cursor is None:
+                break
+        assert seen == expected, per_page
+
+    assert [expense.id for expense in keyset_order(query).all()] == expected
+
+
+def test_trip_page_and_api_list_expenses_without_a_date(client, db, make_trip):
+    trip_id, (ann, _, _) = make_trip()
+    _, undated, _ = add_expenses(db, trip_id, ann, [datetime(2024, 5, 1), None, None])
+
+    assert client.get(f'/trip/{trip_id}').status_code == 200
+    assert client.get(f'/trip/{trip_id}/edit_expense/{undated.id}').status_code == 200
+    response = client.get(f'/trip/{trip_id}/search?q=Expense', headers={'Accept': 'application/json'})
+    assert response.status_code == 200 and response.json['total_count'] == 3
+
+    seen, cursor = [], ''
+    while True:
+        response = client.get(f'/api/v1/trips/{trip_id}/expenses?per_page=1&fields=id&cursor={cursor}')
+        assert response.status_code == 200
+        seen += [expense['id'] for expense in response.json['expenses']]
+        cursor = response.json['next_cursor']
+        if not cursor:
+            break
+        assert client.get(f'/trip/{trip_id}?cursor={cursor}').status_code == 200
+    assert len(seen) == 3
@@ -0,0 +1,25 @@
+import threading
+from benchmarks.synthetic import build_statement_pdf
+from pdf_extraction import extract_expenses, parse_lines
+
+
+def test_parallel_extraction_matches_serial():
+    pdf_bytes, line_count = build_statement_pdf(page_count=4, lines_per_page=5)
+    serial, serial_warnings = extract_expenses(pdf_bytes, parallel=False)
+    assert len(serial) == line_count
+
+    # Import jobs start parallel extractions from worker threads
+    results = []
+    thread = threading.Thread(target=lambda: results.append(extract_expenses(pdf_bytes, parallel=True, workers=2)))
+    thread.start()
+    thread.join()
+    (parallel, parallel_warnings), = results
+    assert parallel == serial
+    assert parallel_warnings == serial_warnings
+
+
+def test_unparsable_dates_are_logged_and_reported(caplog):
+    expenses, warnings = parse_lines(['31 02 01 03 Hotel 0,00 % 120,00', '12 03 13 03 Train 0,00 % 45,50'], 2024)
+    assert [(e['description'], e['expense_date']) for e in expenses] == [('Hotel', None), ('Train', '2024-03-12')]
+    assert len(warnings) == 1 and '02-31' in warnings[0]
+    assert 'Could not parse date: 02-31' in caplog.text
@@ -0,0 +1,31 @@
+import pytest
+from query_budget import query_budget, track_queries, QueryBudgetExceeded
+
+
+def page_queries(client, url):
+    with track_queries() as stats:
+        assert client.get(url).status_code == 200
+    return stats.queries
+
+
+def test_trip_page_queries_do_not_grow_with_expenses(client, make_trip, add_expense):
+    trip_id, (ann, bob, cid) = make_trip()
+    add_expense(trip_id, 10, ann, {ann: 1, bob: 1})
+    # Shows the flash messages, and fills the process-wide caches (e.g. the search backend)
+    client.get(f'/trip/{trip_id}?search=Exp')
+    # Another search each time, so that the page is not served from the cache
+    few = page_queries(client, f'/trip/{trip_id}?search=Expense')
+
+    for index in range(30):
+        add_expense(trip_id, 10 + index, [ann, bob, cid][index % 3], {ann: 1, bob: index % 4, cid: 2})
+    client.get(f'/trip/{trip_id}')
+    assert page_queries(client, f'/trip/{trip_id}?search=Expens') == few
+
+
+def test_strict_budget_fails_the_request(client, make_trip, monkeypatch):
+    trip_id, _ = make_trip()
+    view_functions = client.application.view_functions
+    view = view_functions['trip_blueprint.category_stats']
+    monkeypatch.setitem(view_functions, 'trip_blueprint.category_stats', query_budget(queries=0)(view))
+    with pytest.raises(QueryBudgetExceeded):
+        client.get(f'/trip/{trip_id}/category_stats')
@@ -0,0 +1,22 @@
+import pytest
+
+DESCRIPTIONS = ['Taxi to airport', 'Airport lounge', 'Dinner', '100% juice', 'Juice_bar', 'Ski pass']
+
+
+@pytest.mark.parametrize('query', ['airport', 'AIRPORT', 'ju', '100%', 'e_b', 'ski pass', 'nothing'])
+def test_search_matches_substrings(client, make_trip, add_expense, query):
+    trip_id, (ann, bob, _) = make_trip()
+    for index, description in enumerate(DESCRIPTIONS):
+        add_expense(trip_id, 10 + index, ann, {ann: 1, bob: 1}, description=description)
+
+    response = client.get(f'/trip/{trip_id}/search', query_string={'q': query})
+    assert response.status_code == 200
+    expected = [(10 + index, description) for index, description in enumerate(DESCRIPTIONS) if query.lower() in description.lower()]
+    assert response.json['total_count'] == len(expected)
+    assert response.json['total_amount'] == sum(amount for amount, _ in expected)
+    assert sorted(expense['description'] for expense in response.json['expenses']) == sorted(d for _, d in expected)
+
+
+def test_search_requires_a_query(client, make_trip):
+    trip_id, _ = make_trip()
+    assert client.get(f'/trip/{trip_id}/search?q=').status_code == 400
@@ -0,0 +1,90 @@
+import random
+import pytest
+import settlement
+from settlement import simplify_debts, greedy_transfers, exact_transfers, GREEDY, EXACT, AUTO
+
+
+def sorted_list_transfers(balances):
+    """The debt simplification loop calculate_balances used before settlement.py, for reference."""
+    creditor_list = sorted(((p, b) for p, b in balances.items() if b > 0), key=lambda item: item[1], reverse=True)
+    debtor_list = sorted(((p, b) for p, b in balances.items() if b < 0), key=lambda item: item[1])
+    transactions = []
+    c_idx = d_idx = 0
+    while c_idx < len(creditor_list) and d_idx < len(debtor_list):
+        creditor, c_balance = creditor_list[c_idx]
+        debtor, d_balance = debtor_list[d_idx]
+        transfer_amount = min(c_balance, abs(d_balance))
+        if round(transfer_amount, 2) > 0:
+            transactions.append({'from': debtor, 'to': creditor, 'amount': round(transfer_amount, 2)})
+        creditor_list[c_idx] = (creditor, c_balance - transfer_amount)
+        debtor_list[d_idx] = (debtor, d_balance + transfer_amount)
+        if round(creditor_list[c_idx][1], 2) <= 0:
+            c_idx += 1
+        if round(debtor_list[d_idx][1], 2) >= 0:
+            d_idx += 1
+    return transactions
+
+
+def random_balances(rng, size):
+    amounts = [rng.choice([rng.randint(-50, 50), rng.randint(-5, 5) * 10, rng.random() / 100]) + rng.choice([0, 0.25, 1 / 3])
+               for _ in range(size - 1)]
+    amounts.append(-sum(amounts))
+    return {f'P{rng.randint(0, 99)}-{index}': amount for index, amount in enumerate(amounts)}
+
+
+def remaining_after(balances, transactions):
+    remaining = dict(balances)
+    for transaction in transactions:
+        remaining[transaction['from']] += transaction['amount']
+        remaining[transaction['to']] -= transaction['amount']
+    return remaining
+
+
+def test_default_is_the_greedy_mode_of_the_former_loop():
+    assert settlement.DEFAULT_MODE == GREEDY
+    rng = random.Random(8)
+    for _ in range(2000):
+        balances = random_balances(rng, rng.randint(1, 12))
+        assert simplify_debts(balances) == sorted_list_transfers(balances)
+
+
+def test_exact_uses_the_fewest_transfers():
+    # Two pairs settle each other: greedy needs 3 transfers, exact 2
+    balances = {'Ann': 10.0, 'Bob': 6.0, 'Cid': -6.0, 'Dan': -10.0}
+    assert len(greedy_transfers({'Ann': 7.0, 'Bob': 3.0, 'Cid': -5.0, 'Dan': -5.0})) == 3
+    assert len(exact_transfers({'Ann': 7.0, 'Bob': 3.0, 'Cid': -5.0, 'Dan': -5.0})) == 3
+    assert len(exact_transfers(balances)) == 2
+
+    rng = random.Random(4)
+    for _ in range(200):
+        balances = random_balances(rng, rng.randint(2, 9))
+        transactions = simplify_debts(balances, mode=EXACT)
+        assert len(transactions) <= len(greedy_transfers(balances))
+        for balance in remaining_after(balances, transactions).values():
+            assert balance == pytest.approx(0.0, abs=0.01 * (len(transactions) + 1))
+
+
+def test_auto_mode_is_deterministic_and_bounded_by_size():
+    rng = random.Random(5)
+    small = random_balances(rng, 8)
+    assert simplify_debts(small, mode=AUTO) == simplify_debts(small, mode=EXACT)
+    assert simplify_debts(small, mode=AUTO) == simplify_debts(dict(small), mode=AUTO)
+
+    large = random_balances(rng, 20)
+    assert simplify_debts(large, mode=AUTO) == greedy_transfers(large)
+    assert simplify_debts(small, mode=AUTO, max_participants=4) == greedy_transfers(small)
+
+    with pytest.raises(ValueError):
+        simplify_debts(small, mode='fastest')
+
+
+def test_exact_mode_is_bounded_by_search_steps():
+    rng = random.Random(6)
+    large = random_balances(rng, 30)
+    assert settlement.search_steps(30) > settlement.EXACT_MAX_STEPS
+    assert simplify_debts(large, mode=EXACT) == greedy_transfers(large)
+
+    small = {'Ann': 10.0, 'Bob': 6.0, 'Cid': -6.0, 'Dan': -10.0, 'Eve': 2.5, 'Fay': -2.5}
+    steps = settlement.search_steps(len(small))
+    assert simplify_debts(small, mode=EXACT, max_steps=steps) == exact_transfers(small)
+    assert simplify_debts(small, mode=EXACT, max_steps=steps - 1) == greedy_transfers(small)
@@ -0,0 +1,58 @@
+import io
+from datetime import datetime
+import pytest
+from database import Expense
+from statement_import import import_statement, parse_amount, StatementError, POSITIVE
+from test_ledger import assert_ledger_matches
+
+CSV_STATEMENT = (
+    "Date;Libellé;Montant\n"
+    "01/03/2024;Bakery;-12,50\n"
+    "02/03/2024;Salary;2 000,00\n"
+    "not a date;Broken;-3\n"
+    "\n"
+    "2024-03-04;Train;-1 234,56\n"
+    "05/03/2024;Museum;-8\n"
+)
+
+OFX_STATEMENT = """OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240310120000[-5:EST]<TRNAMT>-42.10<NAME>Fish &amp; Chips</STMTTRN>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240311<TRNAMT>100.00<NAME>Refund</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+@pytest.mark.parametrize('value, amount', [
+    ('-1 234,56', -1234.56), ('1,234.56', 1234.56), ('(12.50)', -12.5), ('€12', 12.0), ('1,234', 1234.0), ('12,5', 12.5),
+])
+def test_parse_amount(value, amount):
+    assert parse_amount(value) == amount
+
+
+def test_csv_statement_is_loaded_in_chunks(client, db, make_trip):
+    trip_id, (ann, _, _) = make_trip()
+    result = import_statement(db, trip_id, ann, io.BytesIO(CSV_STATEMENT.encode()), 'statement.csv', chunk_size=2)
+
+    assert (result.imported, result.ignored, result.skipped, result.error) == (3, 1, 1, None)
+    assert [issue.row for issue in result.issues] == [4]
+    expenses = db.query(Expense).filter_by(trip_id=trip_id).order_by(Expense.id).all()
+    assert [(e.description, e.amount, e.expense_date) for e in expenses] == [
+        ('Bakery', 12.5, datetime(2024, 3, 1)), ('Train', 1234.56, datetime(2024, 3, 4)), ('Museum', 8.0, datetime(2024, 3, 5)),
+    ]
+    assert_ledger_matches(db, trip_id)
+
+
+def test_ofx_statement_and_unknown_layouts(client, db, make_trip):
+    trip_id, (_, bob, _) = make_trip()
+    result = import_statement(db, trip_id, bob, io.BytesIO(OFX_STATEMENT.encode()))
+    assert (result.imported, result.ignored) == (1, 1)
+    [expense] = db.query(Expense).filter_by(trip_id=trip_id).all()
+    assert (expense.description, expense.amount, expense.expense_date) == ('Fish & Chips', 42.1, datetime(2024, 3, 10))
+    assert_ledger_matches(db, trip_id)
+
+    # Positive expenses, and a header without the needed columns
+    result = import_statement(db, trip_id, bob, io.BytesIO(b"date,payee,amount\n2024-03-12,Taxi,20\n"), expense_sign=POSITIVE)
+    assert result.imported == 1
+    with pytest.raises(StatementError):
+        import_statement(db, trip_id, bob, io.BytesIO(b"when,what\n2024-03-12,Taxi\n"), 'statement.csv')
@@ -0,0 +1,43 @@
+import pytest
+from database import Category
+
+
+def category_id(client, db, name):
+    client.post('/trip/categories/add', data={'category_name': name})
+    return db.query(Category.id).filter_by(name=name).scalar()
+
+
+RANGES = [{}, {'start_date': '2024-05-02'}, {'end_date': '2024-05-02'}, {'start_date': '2024-05-02', 'end_date': '2024-05-02'}]
+
+
+def test_category_totals_of_live_and_archived_trips(client, db, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    food, transport = category_id(client, db, 'Stats food'), category_id(client, db, 'Stats transport')
+    expenses = [
+        (30, food, '2024-05-01'), (12.5, food, '2024-05-02'), (80, transport, '2024-05-02'),
+        (7, '', '2024-05-02'), (40, transport, '2024-05-03'),
+    ]
+    for amount, category, expense_date in expenses:
+        add_expense(trip_id, amount, ann, {ann: 1, bob: 1}, expense_date=expense_date, category_id=category)
+
+    names = {food: 'Stats food', transport: 'Stats transport', '': 'Uncategorized'}
+    live = {}
+    for date_range in RANGES:
+        response = client.get(f'/trip/{trip_id}/category_stats', query_string=date_range)
+        assert response.status_code == 200
+        expected = {}
+        for amount, category, expense_date in expenses:
+            if date_range.get('start_date', '') <= expense_date <= date_range.get('end_date', '9999'):
+                expected[names[category]] = expected.get(names[category], 0) + amount
+        totals = response.json['categories']
+        assert {total['category']: total['amount'] for total in totals} == pytest.approx(expected)
+        # Largest first
+        assert [total['amount'] for total in totals] == sorted((total['amount'] for total in totals), reverse=True)
+        live[str(date_range)] = totals
+
+    # Archived trips give the same totals from their snapshot
+    assert client.post(f'/trip/{trip_id}/archive', headers={'Accept': 'application/json'}).status_code == 200
+    for date_range in RANGES:
+        assert client.get(f'/trip/{trip_id}/category_stats', query_string=date_range).json['categories'] == live[str(date_range)]
+
+    assert client.get(f'/trip/{trip_id}/category_stats?start_date=May').status_code == 400
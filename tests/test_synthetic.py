@@ -0,0 +1,17 @@
+from database import Trip
+from benchmarks.synthetic import populate
+from test_ledger import assert_ledger_matches
+
+
+def test_synthetic_trips_are_consistent(client, db):
+    first_trip_id = (db.query(Trip.id).order_by(Trip.id.desc()).limit(1).scalar() or 0) + 1
+    counts = populate(trips=2, participants=3, expenses=40, categories=2, seed=7)
+    assert {key: counts[key] for key in ('trips', 'participants', 'categories', 'expenses')} == {
+        'trips': 2, 'participants': 6, 'categories': 2, 'expenses': 80,
+    }
+
+    for trip_id in (first_trip_id, first_trip_id + 1):
+        assert db.get(Trip, trip_id).name == f"Trip {trip_id}"
+        assert_ledger_matches(db, trip_id)
+        # Within the page's query budget (strict in the tests)
+        assert client.get(f'/trip/{trip_id}').status_code == 200
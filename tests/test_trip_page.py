@@ -0,0 +1,25 @@
+def test_unchanged_trip_page_is_not_modified(client, make_trip, add_expense):
+    trip_id, (ann, bob, _) = make_trip()
+    client.get(f'/trip/{trip_id}') # Shows the flash messages of the trip's creation
+    url = f'/trip/{trip_id}'
+
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag and not response.data
+
+    # Other arguments are another page
+    assert client.get(f'{url}?search=Taxi', headers={'If-None-Match': etag}).status_code == 200
+
+    add_expense(trip_id, 42, ann, {ann: 1, bob: 1}, description='Taxi')
+    # The page with the flash message has no ETag
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200 and 'ETag' not in response.headers
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert b'Taxi' in response.data
@@ -0,0 +1,37 @@
+from datetime import datetime
+from types import SimpleNamespace
+from view_models import expense_groups, balance_views, NO_DATE_GROUP
+
+
+def expense(expense_id, expense_date, shares, paid_by_id=1, category=None):
+    return SimpleNamespace(
+        id=expense_id, description=f'Expense {expense_id}', amount=12.345, paid_by_id=paid_by_id, category=category,
+        shares=[SimpleNamespace(participant_id=pid, weight=weight) for pid, weight in shares],
+        expense_date=expense_date, date_added=datetime(2024, 6, 1, 9, 30), last_modified=None,
+    )
+
+
+def test_expense_groups():
+    names = {1: 'Ann', 2: 'Bob'}
+    expenses = [
+        expense(3, datetime(2024, 6, 2), [(1, 1), (2, 2.0)], category=SimpleNamespace(name='Food')),
+        expense(2, datetime(2024, 6, 1), [(1, 1), (9, 1)], paid_by_id=9), # A participant no longer in the trip
+        expense(1, datetime(2024, 5, 30), []),
+        expense(0, None, [(2, 1)]),
+    ]
+    groups = expense_groups(expenses, names)
+    assert [(heading, [view.id for view in views]) for heading, views in groups] == [
+        ('June 2024', [3, 2]), ('May 2024', [1]), (NO_DATE_GROUP, [0]),
+    ]
+    first, second = groups[0][1]
+    assert (first.amount, first.payer_name, first.category_name, first.shares) == ('12.35', 'Ann', 'Food', [('Ann', '1'), ('Bob', '2')])
+    assert (second.payer_name, second.category_name, second.shares) == ('', 'Uncategorized', [('Ann', '1')])
+    assert (first.expense_date, first.date_added, first.last_modified) == ('2024-06-02', '2024-06-01 09:30', '')
+    assert groups[2][1][0].expense_date == ''
+
+
+def test_balance_views():
+    views = balance_views({'Ann': 10.005, 'Bob': -10.0, 'Cid': 0})
+    assert [(view.name, view.state, view.amount) for view in views] == [
+        ('Ann', 'owed', '10.01'), ('Bob', 'owes', '10.00'), ('Cid', 'settled', '0.00'),
+    ]
@@ -0,0 +1,383 @@
+import os
+import json
+import codecs
+import zlib
+import logging
+from collections import namedtuple
+from datetime import datetime
+from itertools import groupby
+from sqlalchemy import select, delete, DateTime
+from database import Trip, Participant, Expense, ExpenseShare, Category, TripSnapshot, DeletedExpense
+from caching import bump_trip_version
+from pagination import EXPENSES_PER_PAGE, keyset_order, decode_cursor, encode_cursor
+from settlement import simplify_debts
+from stats import category_totals
+import ledger
+
+# Trip archival.
+#
+# archive_trip() freezes a finished trip into a TripSnapshot: its balances,
+# settlement transactions and category totals are computed once and stored as
+# JSON, and its expenses and shares are written to a compressed blob and
+# deleted from the expenses tables, so that they no longer weigh on the
+# indexes and queries of the live trips. The trip page of an archived trip is
+# built from the snapshot alone (see trip_page.py): the blob is stored in the
+# order of the expense table (most recent first), so a page or a search is one
+# sequential read of it. Archived trips are read-only (the trip blueprint
+# refuses changes to them); their participants, default weights and ledger
+# rows stay in place, so the API keeps serving their balances.
+#
+# restore_trip() puts every column of the expenses and their shares back and
+# deletes the snapshot. Ids taken in the meantime (SQLite reuses the highest
+# ids once they are deleted) are replaced with new ones, and categories
+# deleted in the meantime are dropped, as delete_category does for live trips.
+
+logger = logging.getLogger(__name__)
+
+# Expenses inserted per statement when a trip is restored
+RESTORE_BATCH_SIZE = int(os.environ.get("RESTORE_BATCH_SIZE", 1000))
+# Rows fetched per round trip when a trip is archived
+ARCHIVE_BATCH_SIZE = 1000
+# Bytes of the blob decompressed at a time
+READ_SIZE = 64 * 1024
+# Layout of the expenses blob written by archive_trip (TripSnapshot.format)
+SNAPSHOT_FORMAT = 1
+
+_JSON = json.JSONDecoder()
+_EXPENSES = Expense.__table__
+_SHARES = ExpenseShare.__table__
+# Columns stored as ISO 8601 strings in the blob
+_DATETIME_COLUMNS = {column.name for column in _EXPENSES.c if isinstance(column.type, DateTime)}
+
+
+class ArchiveError(ValueError):
+    """The trip cannot be archived or restored (already archived, not archived, changed meanwhile)."""
+
+
+ArchivedCategory = namedtuple('ArchivedCategory', 'id name')
+ArchivedShare = namedtuple('ArchivedShare', 'participant_id weight')
+
+
+class ArchivedExpense:
+    """An expense read from a snapshot, with the attributes of an Expense that the views and exports use."""
+    __slots__ = ('id', 'description', 'amount', 'expense_date', 'date_added', 'last_modified',
+                 'paid_by_id', 'category', 'shares')
+
+    def __init__(self, record):
+        expense = record['expense']
+        self.id = expense['id']
+        self.description = expense['description']
+        self.amount = expense['amount']
+        self.expense_date = _datetime(expense['expense_date'])
+        self.date_added = _datetime(expense['date_added'])
+        self.last_modified = _datetime(expense['last_modified'])
+        self.paid_by_id = expense['paid_by_id']
+        self.category = ArchivedCategory(expense['category_id'], record['category']) if record['category'] is not None else None
+        self.shares = [ArchivedShare(participant_id, weight) for participant_id, weight in record['shares']]
+
+    @property
+    def weights(self):
+        """Weights as a {participant_id: weight} dictionary, like Expense.weights."""
+        return {share.participant_id: share.weight for share in self.shares}
+
+
+def _datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def is_archived(db, trip_id):
+    return db.scalar(select(TripSnapshot.trip_id).where(TripSnapshot.trip_id == trip_id)) is not None
+
+
+def get_snapshot(db, trip_id):
+    """The snapshot of an archived trip, or None if the trip is live."""
+    return db.get(TripSnapshot, trip_id)
+
+
+def frozen_settlement(snapshot):
+    """Returns the (balances, transactions) pair of utils.calculate_balances, as frozen in a snapshot."""
+    return json.loads(snapshot.balances), json.loads(snapshot.transactions)
+
+
+def iter_records(snapshot):
+    """Yields the expenses stored in a snapshot ({'expense': columns, 'category': name, 'shares': [[participant_id, weight]]}), most recent first."""
+    if snapshot.format != SNAPSHOT_FORMAT:
+        raise ArchiveError(f"Unsupported snapshot format {snapshot.format} for trip {snapshot.trip_id}.")
+    decompressor = zlib.decompressobj()
+    # Lines are decoded to text once, json.loads would detect the encoding of each
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    blob = memoryview(snapshot.expenses)
+    pending = ''
+    for start in range(0, len(blob), READ_SIZE):
+        pending += decoder.decode(decompressor.decompress(blob[start:start + READ_SIZE]))
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield _JSON.decode(line)
+    pending += decoder.decode(decompressor.flush(), final=True)
+    if pending:
+        yield _JSON.decode(pending)
+
+
+def iter_expenses(snapshot):
+    """Yields the expenses of a snapshot as ArchivedExpenses, most recent first."""
+    for record in iter_records(snapshot):
+        yield ArchivedExpense(record)
+
+
+# Records are filtered before they are turned into ArchivedExpenses: dates are
+# compared as the ISO 8601 strings they are stored as, which sort like the datetimes
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+
+def _in_range(expense, start, end):
+    # Like the SQL filter, an expense without a date is in no range
+    expense_date = expense['expense_date']
+    return expense_date is not None and (start is None or expense_date >= start) and (end is None or expense_date <= end)
+
+
+def _add_category(categories, record):
+    name = record['category'] if record['category'] is not None else 'Uncategorized'
+    categories[name] = categories.get(name, 0.0) + record['expense']['amount']
+
+
+def _sorted_totals(categories):
+    """{category name: amount} as the list stats.category_totals returns, largest first."""
+    totals = [{'category': name, 'amount': amount} for name, amount in categories.items()]
+    totals.sort(key=lambda x: x['amount'], reverse=True)
+    return totals
+
+
+def archived_category_totals(snapshot, start_date=None, end_date=None):
+    """stats.category_totals of an archived trip (frozen in the snapshot, or added up from it for a date range)."""
+    if start_date is None and end_date is None:
+        return json.loads(snapshot.category_totals)
+    start, end = _iso(start_date), _iso(end_date)
+    categories = {}
+    for record in iter_records(snapshot):
+        if _in_range(record['expense'], start, end):
+            _add_category(categories, record)
+    return _sorted_totals(categories)
+
+
+def archived_page(snapshot, search_query=None, cursor=None, start_date=None, end_date=None, per_page=EXPENSES_PER_PAGE):
+    """
+    Reads the trip page's data from a snapshot, as the live page queries it.
+
+    Returns (expenses, next_cursor, total, category totals): a page of the
+    expenses matching search_query (ArchivedExpenses, most recent first, from
+    the keyset cursor on), the total amount of all matches, and the category
+    totals of the expenses between the dates (for the chart, not searched).
+    All of it comes from one pass over the snapshot.
+    """
+    needle = search_query.lower() if search_query else None
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        position = (_iso(position[0]) or '', _iso(position[1]) or '', position[2])
+    dated = start_date is not None or end_date is not None
+    start, end = _iso(start_date), _iso(end_date)
+
+    page, next_cursor = [], None
+    total = 0.0 if needle else snapshot.total_amount
+    categories = {}
+    for record in iter_records(snapshot):
+        expense = record['expense']
+        if dated and _in_range(expense, start, end):
+            _add_category(categories, record)
+        if needle:
+            if needle not in (expense['description'] or '').lower():
+                continue
+            total += expense['amount']
+        if position and (expense['expense_date'] or '', expense['date_added'] or '', expense['id']) >= position:
+            continue
+        if len(page) < per_page:
+            page.append(ArchivedExpense(record))
+        elif next_cursor is None:
+            next_cursor = encode_cursor(page[-1])
+            if not needle and not dated:
+                break # Nothing left to add up
+
+    totals = _sorted_totals(categories) if dated else json.loads(snapshot.category_totals)
+    return page, next_cursor, total, totals
+
+
+def _record(row, shares):
+    expense = {
+        name: value.isoformat() if name in _DATETIME_COLUMNS and value is not None else value
+        for name, value in row._mapping.items() if name in _EXPENSES.c
+    }
+    return {'expense': expense, 'category': row.category_name, 'shares': shares}
+
+
+def _compress_expenses(db, trip_id):
+    """Writes the expenses of a trip and their shares to a compressed blob. Returns (blob, count, total amount)."""
+    statement = (
+        # The order of the trip page, so pages of the snapshot are read from its start
+        keyset_order(
+            select(*_EXPENSES.c, Category.name.label('category_name'), _SHARES.c.participant_id.label('share_participant_id'), _SHARES.c.weight.label('share_weight'))
+            .outerjoin(Category, Category.id == _EXPENSES.c.category_id)
+            .outerjoin(_SHARES, _SHARES.c.expense_id == _EXPENSES.c.id)
+            .where(_EXPENSES.c.trip_id == trip_id)
+        )
+        .order_by(_SHARES.c.participant_id)
+        .execution_options(stream_results=True, yield_per=ARCHIVE_BATCH_SIZE)
+    )
+    compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION)
+    chunks = []
+    count, total = 0, 0.0
+    result = db.execute(statement)
+    try:
+        # Rows of the same expense are consecutive, one per share
+        for _, rows in groupby(result, key=lambda row: row.id):
+            rows = list(rows)
+            shares = [[row.share_participant_id, row.share_weight] for row in rows if row.share_participant_id is not None]
+            line = json.dumps(_record(rows[0], shares), separators=(',', ':'), ensure_ascii=False)
+            chunks.append(compressor.compress(line.encode('utf-8') + b'\n'))
+            count += 1
+            total += rows[0].amount or 0.0
+    finally:
+        result.close()
+    chunks.append(compressor.flush())
+    return b''.join(chunks), count, total
+
+
+def archive_trip(db, trip_id):
+    """
+    Archives a trip in the caller's transaction: stores its snapshot and deletes its expenses and shares.
+
+    Returns the TripSnapshot. Raises ArchiveError if the trip does not exist
+    or is already archived, or if expenses were added or deleted while it was
+    being archived.
+    """
+    if db.scalar(select(Trip.id).where(Trip.id == trip_id)) is None:
+        raise ArchiveError("Trip not found.")
+    if is_archived(db, trip_id):
+        raise ArchiveError("The trip is already archived.")
+    # First, since the writers of the trip bump it too: on PostgreSQL the
+    # archive waits for the writes in progress, on SQLite it locks the database
+    bump_trip_version(db, trip_id)
+
+    participants = db.query(Participant.id, Participant.name).filter(Participant.trip_id == trip_id).order_by(Participant.id).all()
+    totals = ledger.compute_trip_totals(db, trip_id)
+    balances = {
+        name: round(totals[participant_id][0] - totals[participant_id][1], ledger.BALANCE_PRECISION)
+        for participant_id, name in participants
+    }
+    categories = category_totals(db, trip_id)
+    blob, count, total = _compress_expenses(db, trip_id)
+
+    # Shares first (foreign key). A number of deleted expenses different from
+    # the snapshot's means the trip changed since it was read.
+    db.execute(delete(_SHARES).where(_SHARES.c.expense_id.in_(select(_EXPENSES.c.id).where(_EXPENSES.c.trip_id == trip_id))))
+    deleted = db.execute(delete(_EXPENSES).where(_EXPENSES.c.trip_id == trip_id)).rowcount
+    if deleted != count:
+        raise ArchiveError("The trip's expenses changed while it was being archived. Please try again.")
+
+    snapshot = TripSnapshot(
+        trip_id=trip_id,
+        format=SNAPSHOT_FORMAT,
+        expense_count=count,
+        total_amount=total,
+        balances=json.dumps(balances),
+        transactions=json.dumps(simplify_debts(balances)),
+        category_totals=json.dumps(categories),
+        expenses=blob,
+    )
+    db.add(snapshot)
+    db.flush()
+    logger.info("Archived trip %s: %s expenses in a %s byte snapshot.", trip_id, count, len(blob))
+    return snapshot
+
+
+def _expense_row(record, category_ids):
+    """The columns of an archived expense, as inserted back into the expenses table."""
+    row = {
+        name: _datetime(value) if name in _DATETIME_COLUMNS else value
+        for name, value in record['expense'].items() if name in _EXPENSES.c
+    }
+    if row.get('category_id') not in category_ids:
+        row['category_id'] = None
+    return row
+
+
+def _share_rows(expense_id, record):
+    return [{'expense_id': expense_id, 'participant_id': participant_id, 'weight': weight} for participant_id, weight in record['shares']]
+
+
+def _restore_batch(db, records, category_ids):
+    """
+    Inserts a batch of archived expenses with their ids, and their shares.
+
+    Returns the records whose id has been taken meanwhile; they are inserted
+    by _restore_renumbered once every other expense is back, so that the ids
+    they get cannot be ones the next batches need.
+    """
+    taken = set(db.scalars(select(_EXPENSES.c.id).where(_EXPENSES.c.id.in_([record['expense']['id'] for record in records]))))
+    expense_rows, share_rows, renumbered = [], [], []
+    for record in records:
+        if record['expense']['id'] in taken:
+            renumbered.append(record)
+            continue
+        expense_rows.append(_expense_row(record, category_ids))
+        share_rows.extend(_share_rows(record['expense']['id'], record))
+
+    if expense_rows:
+        db.execute(_EXPENSES.insert(), expense_rows)
+    if share_rows:
+        db.execute(_SHARES.insert(), share_rows)
+    return renumbered
+
+
+def _restore_renumbered(db, trip_id, records, category_ids):
+    """
+    Inserts archived expenses whose id has been taken meanwhile, with new ids, and their shares.
+
+    For API clients syncing with `since`, the old id gets a tombstone and the
+    expense counts as modified now, so they drop the old id and fetch the new one.
+    """
+    now = datetime.utcnow()
+    for record in records:
+        row = _expense_row(record, category_ids)
+        old_id = row.pop('id')
+        row['last_modified'] = now
+        expense_id = db.execute(_EXPENSES.insert().values(**row)).inserted_primary_key[0]
+        db.add(DeletedExpense(expense_id=old_id, trip_id=trip_id, deleted_at=now))
+        share_rows = _share_rows(expense_id, record)
+        if share_rows:
+            db.execute(_SHARES.insert(), share_rows)
+
+
+def restore_trip(db, trip_id):
+    """
+    Unarchives a trip in the caller's transaction: puts its expenses and shares back and deletes its snapshot.
+
+    Returns (restored, renumbered): the number of expenses restored and of
+    those whose id had been reused meanwhile and that got a new one.
+    Raises ArchiveError if the trip is not archived.
+    """
+    snapshot = get_snapshot(db, trip_id)
+    if snapshot is None:
+        raise ArchiveError("The trip is not archived.")
+    bump_trip_version(db, trip_id)
+
+    category_ids = set(db.scalars(select(Category.id)))
+    restored = 0
+    batch, renumbered = [], []
+    for record in iter_records(snapshot):
+        batch.append(record)
+        if len(batch) >= RESTORE_BATCH_SIZE:
+            renumbered += _restore_batch(db, batch, category_ids)
+            restored += len(batch)
+            batch = []
+    if batch:
+        renumbered += _restore_batch(db, batch, category_ids)
+        restored += len(batch)
+    _restore_renumbered(db, trip_id, renumbered, category_ids)
+
+    db.delete(snapshot)
+    # The ledger rows were kept while the trip was archived; rebuilt in case the restored rows differ
+    ledger.rebuild_trip_ledger(db, trip_id)
+    if renumbered:
+        logger.warning("Restored trip %s: %s of its %s expenses got a new id.", trip_id, len(renumbered), restored)
+    return restored, len(renumbered)
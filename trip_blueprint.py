@@ -1,174 +1,278 @@
-import json
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
-from datetime import datetime, timedelta # Import timedelta for date calculations
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, make_response, Response
+from datetime import datetime
 # Import the new Category model
-from database import SessionLocal, Trip, Participant, Expense, TripParticipantDefaultProportion, Category
+from database import get_db, SessionLocal, Trip, Participant, Expense, TripParticipantDefaultProportion, Category, DeletedExpense
 from sqlalchemy.orm import joinedload
 from sqlalchemy import desc # Import desc for descending order
-from utils import calculate_balances, process_pdf_report # Import calculate_balances
+import ledger # Incrementally maintained balances
+from loaders import load_trip, default_weights # Shared trip loading
+from query_budget import query_budget # Per-request query/row budgets
+import search # Database-backed expense search
+from stats import parse_date_range, category_totals # SQL-side category statistics
+from import_staging import get_staged_import, discard_import # Server-side staging of PDF imports
+from import_jobs import submit_import, get_job, job_status, DONE # Background PDF import jobs
+import category_suggestions # Cached category suggestions for imports
+from bulk_import import validate_rows, insert_rows, ERROR # Bulk commit path of validated imports
+from statement_import import import_statement as load_statement, StatementError, POSITIVE, NEGATIVE # CSV/OFX imports
+import trip_page # Cached trip page fragments and ETags
+import trip_export # Streaming CSV/XLSX exports
+import trip_archive # Archived trips and their snapshots
+from caching import bump_trip_version # Cache invalidation on changes
+import category_cache # Process-wide cache of the category list
 from werkzeug.utils import secure_filename # Import secure_filename
-from itertools import groupby # Import groupby for grouping expenses
 from sqlalchemy import func # Import func for database functions like lower
 from sqlalchemy import and_ # Import and_ for combining filter conditions
 
+# Number of skipped rows detailed in the message shown after validating an import
+MAX_REPORTED_ISSUES = 5
+
 # Define the blueprint
 # The url_prefix means all routes in this blueprint will start with /trip
 trip_blueprint = Blueprint('trip_blueprint', __name__, url_prefix='/trip')
 
-# Helper to get a database session (can be imported or defined locally)
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+@trip_blueprint.before_request
+def refuse_changes_to_archived_trips():
+    """Archived trips are read-only: their changes are refused until they are unarchived (see trip_archive.py)."""
+    trip_id = (request.view_args or {}).get('trip_id')
+    if request.method != 'POST' or trip_id is None or request.endpoint == 'trip_blueprint.unarchive_trip':
+        return None
+    if not trip_archive.is_archived(get_db(), trip_id):
+        return None
+    message = "This trip is archived. Unarchive it to make changes."
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': message}), 409
+    flash(message, 'warning')
+    return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
 @trip_blueprint.route('/<int:trip_id>')
+# 12 queries, plus 2 when a page continues with expenses without a date (see pagination.paginate_expenses)
+@query_budget(queries=14, rows=2000)
 def view_trip(trip_id):
     """
     Displays the details of a specific trip, including balances,
     with optional search, date range filtering for stats, and expenses grouped by month.
+    Expenses are listed one page at a time; the `cursor` argument selects the page.
     """
-    db = next(get_db())
+    db = get_db()
 
     # Get search query from request arguments
     search_query = request.args.get('search')
+    # Keyset cursor of the expense page to display (None for the most recent expenses)
+    cursor = request.args.get('cursor')
 
     # Get date range filter from request arguments
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
 
     # Convert date strings to datetime objects if they exist
-    start_date = None
-    end_date = None
-    if start_date_str:
-        try:
-            # Set time to start of the day for inclusive filtering
-            start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
-        except ValueError:
-            flash("Invalid start date format. Please use YYYY-MM-DD.", 'danger')
-            start_date_str = None # Clear invalid date
-
-    if end_date_str:
-        try:
-            # Set time to end of the day for inclusive filtering
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d') + timedelta(days=1) - timedelta(seconds=1)
-        except ValueError:
-            flash("Invalid end date format. Please use YYYY-MM-DD.", 'danger')
-            end_date_str = None # Clear invalid date
-
-
-    # Base query to fetch the trip with related data
-    # Eager load participants, expenses (with payer and category), and default proportions
-    query = db.query(Trip).options(
-        joinedload(Trip.participants),
-        # Eager load expenses and their payer and category
-        joinedload(Trip.expenses.and_(True)).joinedload(Expense.payer),
-        joinedload(Trip.expenses.and_(True)).joinedload(Expense.category),
-        joinedload(Trip.participant_default_proportions).joinedload(TripParticipantDefaultProportion.participant)
-    ).filter(Trip.id == trip_id)
-
-    trip = query.first()
+    start_date, end_date, date_errors = parse_date_range(start_date_str, end_date_str)
+    for error in date_errors:
+        flash(error, 'danger')
+    # Clear invalid dates
+    if start_date is None:
+        start_date_str = None
+    if end_date is None:
+        end_date_str = None
+
+
+    # Cached pages are keyed by the trip's version and the page's arguments (one query, see trip_page.py)
+    key = trip_page.page_key(db, trip_id, search_query, cursor, start_date, end_date)
+    etag = trip_page.page_etag(key)
+    # Pages showing flash messages are one-offs: they get no ETag and are never answered with a 304
+    cacheable = not date_errors and not session.get('_flashes')
+    if cacheable and etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    page = trip_page.get_page(db, key, trip_id, search_query, cursor, start_date, end_date, start_date_str, end_date_str)
+    if page is None:
+        return "Trip not found", 404
 
+    response = make_response(render_template(
+        'view_trip.html',
+        trip_id=trip_id,
+        trip_name=page['trip_name'],
+        archived_at=page['archived_at'], # Set for archived trips, which are read-only
+        fragments=page['fragments'], # Participants, balances, transactions and expense table
+        search_query=search_query, # Pass the search query back to the template
+        category_expenses_list=page['category_expenses_list'], # Pass category expense data for the chart
+        start_date=start_date_str, # Pass start date back to template to pre-fill form
+        end_date=end_date_str, # Pass end date back to template to pre-fill form
+        xlsx_export=trip_export.XLSX_AVAILABLE # Link to the XLSX export when openpyxl is installed
+    ))
+    if cacheable:
+        response.set_etag(etag)
+        # Browsers keep the page but revalidate it on every load
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@trip_blueprint.route('/<int:trip_id>/category_stats')
+def category_stats(trip_id):
+    """Returns the trip's expense totals per category for an optional date range as JSON (used by the chart)."""
+    db = get_db()
+    trip = db.query(Trip).get(trip_id)
+    if not trip:
+        return jsonify({'error': "Trip not found"}), 404
+
+    start_date, end_date, date_errors = parse_date_range(request.args.get('start_date'), request.args.get('end_date'))
+    if date_errors:
+        return jsonify({'error': ' '.join(date_errors)}), 400
+
+    snapshot = trip_archive.get_snapshot(db, trip_id)
+    return jsonify({
+        'start_date': request.args.get('start_date') or None,
+        'end_date': request.args.get('end_date') or None,
+        'categories': trip_archive.archived_category_totals(snapshot, start_date, end_date) if snapshot is not None
+                      else category_totals(db, trip_id, start_date, end_date),
+    })
+
+@trip_blueprint.route('/<int:trip_id>/search')
+def search_trip_expenses(trip_id):
+    """Returns ranked, paginated expenses matching the `q` argument as JSON, with match totals."""
+    db = get_db()
+    trip = db.query(Trip).get(trip_id)
+    if not trip:
+        return jsonify({'error': "Trip not found"}), 404
+
+    search_query = request.args.get('q', '').strip()
+    if not search_query:
+        return jsonify({'error': "Missing search query."}), 400
+    if trip_archive.is_archived(db, trip_id):
+        # The trip page searches the snapshot of archived trips; the index only covers live expenses
+        return jsonify({'error': "This trip is archived. Unarchive it to search its expenses."}), 409
+    page = request.args.get('page', 1, type=int)
+
+    results = search.search_expenses(db, trip_id, search_query, page=page)
+    return jsonify({
+        'query': search_query,
+        'page': results['page'],
+        'per_page': results['per_page'],
+        'total_count': results['total_count'],
+        'total_amount': results['total_amount'],
+        'expenses': [
+            {
+                'id': expense.id,
+                'description': expense.description,
+                'amount': expense.amount,
+                'expense_date': expense.expense_date.strftime('%Y-%m-%d') if expense.expense_date else None,
+                'paid_by': expense.payer.name if expense.payer else None,
+                'category': expense.category.name if expense.category else None,
+            }
+            for expense in results['expenses']
+        ],
+    })
+
+def _export_filename(trip, name, extension):
+    """Attachment name of an export, e.g. Ski_2024-expenses.csv."""
+    return f"{secure_filename(trip.name or '') or f'trip-{trip.id}'}-{name}.{extension}"
+
+@trip_blueprint.route('/<int:trip_id>/export/<any(expenses, balances, transactions):table>.csv')
+def export_csv(trip_id, table):
+    """
+    Streams a table of the trip as CSV: its expenses (with payer, category and
+    the amount owed by each participant), its balances or its settlement transactions.
+    """
+    db = get_db()
+    trip = db.query(Trip).get(trip_id)
     if not trip:
         return "Trip not found", 404
 
-    # Get all expenses for grouping and total calculation (regardless of date filter for chart)
-    all_expenses = sorted(trip.expenses, key=lambda x: x.expense_date, reverse=True)
-
-
-    # Filter expenses by description if a search query is provided
-    if search_query:
-        filtered_expenses = [
-            expense for expense in all_expenses
-            if search_query.lower() in expense.description.lower()
-        ]
-    else:
-        filtered_expenses = all_expenses
-
-
-    # Group filtered expenses by month and year for the table display
-    grouped_expenses = {}
-    # Use sorted(filtered_expenses, key=lambda x: x.expense_date, reverse=True) to ensure correct grouping order
-    for month_year, expenses_in_month in groupby(sorted(filtered_expenses, key=lambda x: x.expense_date, reverse=True), key=lambda x: x.expense_date.strftime('%B %Y')):
-        # Convert groupby object to a list and sort by date_added descending within the month
-        grouped_expenses[month_year] = sorted(list(expenses_in_month), key=lambda x: x.date_added, reverse=True)
-
-
-    total_expenses = sum(expense.amount for expense in filtered_expenses) # Calculate total based on filtered expenses for the table header
-
-    # --- Calculate Category Expenses for the Chart (based on date filter) ---
-    category_expenses = {}
-    # Filter expenses by date range for category calculation
-    date_filtered_expenses_for_chart = all_expenses # Start with all expenses for the chart calculation
-
-    if start_date:
-        date_filtered_expenses_for_chart = [
-            expense for expense in date_filtered_expenses_for_chart
-            if expense.expense_date >= start_date
-        ]
-    if end_date:
-         # Use the end_date (which is end-of-day inclusive) for filtering
-         date_filtered_expenses_for_chart = [
-             expense for expense in date_filtered_expenses_for_chart
-             if expense.expense_date <= end_date # Use <= with the end-of-day inclusive date
-         ]
-
-
-    for expense in date_filtered_expenses_for_chart:
-        category_name = expense.category.name if expense.category else 'Uncategorized'
-        if category_name in category_expenses:
-            category_expenses[category_name] += expense.amount
-        else:
-            category_expenses[category_name] = expense.amount
-
-    # Convert category_expenses dictionary to a list of dictionaries for easier JavaScript processing
-    category_expenses_list = [{"category": cat, "amount": amount} for cat, amount in category_expenses.items()]
-    # Sort category_expenses_list by amount descending for the chart legend
-    category_expenses_list.sort(key=lambda x: x['amount'], reverse=True)
-
+    def generate():
+        # Rows are read while the response is sent, after the request's session is closed (teardown), so the
+        # export has its own session, closed when the response ends
+        export_db = SessionLocal()
+        try:
+            yield from trip_export.iter_csv(trip_export.export_tables(export_db, trip_id, [table])[table])
+        finally:
+            export_db.close()
+
+    return Response(generate(), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename="{_export_filename(trip, table, "csv")}"',
+    })
+
+@trip_blueprint.route('/<int:trip_id>/export.xlsx')
+def export_xlsx(trip_id):
+    """Streams the trip's expenses, balances and transactions as an XLSX workbook (one sheet each, needs openpyxl)."""
+    db = get_db()
+    trip = db.query(Trip).get(trip_id)
+    if not trip:
+        return "Trip not found", 404
+    if not trip_export.XLSX_AVAILABLE:
+        flash("XLSX export is not available on this server (openpyxl is not installed). Use the CSV exports instead.", 'warning')
+        return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
-    # Load weights from JSON string for display (reusing proportions_dict name)
-    # This still needs to be done for each expense object before passing to template
-    for month_year, expenses_list in grouped_expenses.items():
-        for expense in expenses_list:
-             expense.proportions_dict = json.loads(expense.proportions) if expense.proportions else {}
+    def generate():
+        # Own session, as for the CSV exports
+        export_db = SessionLocal()
+        try:
+            yield from trip_export.iter_xlsx(trip_export.export_tables(export_db, trip_id))
+        finally:
+            export_db.close()
+
+    return Response(
+        generate(),
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Content-Disposition': f'attachment; filename="{_export_filename(trip, "export", "xlsx")}"'},
+    )
 
+@trip_blueprint.route('/<int:trip_id>/archive', methods=['POST'])
+def archive_trip(trip_id):
+    """
+    Archives a trip: freezes its balances, transactions and category totals
+    into a snapshot and moves its expenses out of the expenses table.
+    """
+    db = get_db()
+    trip = load_trip(db, trip_id, participants=False)
+    if not trip:
+        flash("Trip not found.", 'danger')
+        return redirect(url_for('index'))
 
-    # Build a dictionary of default weights for easier access in the template
-    default_proportions_dict = {
-        str(dp.participant_id): dp.default_proportion # Renamed conceptually to weights
-        for dp in trip.participant_default_proportions
-    }
+    try:
+        snapshot = trip_archive.archive_trip(db, trip_id)
+        db.commit()
+    except trip_archive.ArchiveError as e:
+        db.rollback()
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), 409
+        flash(str(e), 'danger')
+        return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
-    # Calculate balances and transactions based on all expenses (not filtered ones)
-    # Balances should reflect the overall trip, not just the currently filtered view
-    balances, transactions = calculate_balances(trip)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'archived': snapshot.expense_count, 'snapshot_bytes': len(snapshot.expenses)})
+    flash(f"Trip '{trip.name}' archived ({snapshot.expense_count} expense(s)). Its balances are frozen until it is unarchived.", 'success')
+    return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
-    # Fetch all categories to display in the template
-    categories = db.query(Category).order_by(Category.name).all()
+@trip_blueprint.route('/<int:trip_id>/unarchive', methods=['POST'])
+def unarchive_trip(trip_id):
+    """Restores the expenses of an archived trip from its snapshot and makes it editable again."""
+    db = get_db()
+    trip = load_trip(db, trip_id, participants=False)
+    if not trip:
+        flash("Trip not found.", 'danger')
+        return redirect(url_for('index'))
 
+    try:
+        restored, renumbered = trip_archive.restore_trip(db, trip_id)
+        db.commit()
+    except trip_archive.ArchiveError as e:
+        db.rollback()
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), 409
+        flash(str(e), 'danger')
+        return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
-    return render_template(
-        'view_trip.html',
-        trip_id=trip.id,
-        trip=trip,
-        total_expenses=total_expenses, # Total for the expenses shown in the table (filtered by search)
-        default_proportions=default_proportions_dict, # Passing default weights
-        balances=balances, # Pass balances to the template
-        transactions=transactions, # Pass transactions to the template
-        search_query=search_query, # Pass the search query back to the template
-        grouped_expenses=grouped_expenses, # Pass the grouped expenses to the template
-        categories=categories, # Pass categories to the template
-        category_expenses_list=category_expenses_list, # Pass category expense data for the chart
-        start_date=start_date_str, # Pass start date back to template to pre-fill form
-        end_date=end_date_str # Pass end date back to template to pre-fill form
-    )
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'restored': restored, 'renumbered': renumbered})
+    flash(f"Trip '{trip.name}' unarchived ({restored} expense(s) restored).", 'success')
+    if renumbered:
+        flash(f"{renumbered} expense(s) got a new id because theirs had been reused.", 'warning')
+    return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
 @trip_blueprint.route('/<int:trip_id>/add_participant', methods=['GET', 'POST'])
 def add_participant(trip_id):
     """Handles adding a participant to a trip."""
-    db = next(get_db())
+    db = get_db()
     trip = db.query(Trip).get(trip_id)
     if not trip:
         return "Trip not found", 404
@@ -181,8 +285,7 @@ def add_participant(trip_id):
         if participant_name and not existing_participant:
             new_participant = Participant(name=participant_name, trip_id=trip_id, avatar_url=avatar_emoji)
             db.add(new_participant)
-            db.commit()
-            flash(f"Participant '{participant_name}' added successfully!", 'success')
+            db.flush() # Assigns the participant id, committed below with its weight and the ledger
 
             # When a new participant is added, create a default weight entry for them in this trip (defaulting to 1)
             new_default_proportion = TripParticipantDefaultProportion(
@@ -191,7 +294,12 @@ def add_participant(trip_id):
                 default_proportion=1.0 # Default weight is 1
             )
             db.add(new_default_proportion)
+            # Expenses without weights are split among all participants, so rebuild the trip's ledger
+            # (a single aggregate query over the trip's expenses)
+            ledger.rebuild_trip_ledger(db, trip_id)
+            bump_trip_version(db, trip_id) # Invalidate the cached trip page
             db.commit()
+            flash(f"Participant '{participant_name}' added successfully!", 'success')
 
 
         elif existing_participant:
@@ -208,7 +316,7 @@ def add_participant(trip_id):
 @trip_blueprint.route('/<int:trip_id>/edit_participant/<int:participant_id>', methods=['GET', 'POST'])
 def edit_participant(trip_id, participant_id):
     """Handles editing a participant's details."""
-    db = next(get_db())
+    db = get_db()
     trip = db.query(Trip).get(trip_id) # Get the trip to pass to the template
     if not trip:
         return "Trip not found", 404
@@ -231,6 +339,7 @@ def edit_participant(trip_id, participant_id):
         if new_name and not existing_participant_with_name:
             participant.name = new_name
             participant.avatar_url = new_avatar_emoji # Update avatar_url with the new emoji
+            bump_trip_version(db, trip_id) # Invalidate the cached trip page
             db.commit()
             flash(f"Participant '{participant.name}' updated successfully!", 'success')
             # Use blueprint name in url_for
@@ -250,23 +359,17 @@ def edit_participant(trip_id, participant_id):
 @trip_blueprint.route('/<int:trip_id>/add_expense', methods=['GET', 'POST'])
 def add_expense(trip_id):
     """Handles adding an expense to a trip with weights and category."""
-    db = next(get_db())
-    # Eager load participants and their default weights for this trip
-    trip = db.query(Trip).options(
-        joinedload(Trip.participants),
-        joinedload(Trip.participant_default_proportions).joinedload(TripParticipantDefaultProportion.participant)
-    ).get(trip_id)
+    db = get_db()
+    # Load participants and their default weights for this trip
+    trip = load_trip(db, trip_id, default_proportions=True)
     if not trip:
         return "Trip not found", 404
 
     # Fetch all categories
-    categories = db.query(Category).order_by(Category.name).all()
+    categories = category_cache.get_categories(db)
 
     # Build a dictionary of default weights for easier access in the template
-    default_proportions_dict = {
-        str(dp.participant_id): dp.default_proportion # Renamed conceptually to weights
-        for dp in trip.participant_default_proportions
-    }
+    default_proportions_dict = default_weights(trip)
 
 
     if request.method == 'POST':
@@ -332,11 +435,16 @@ def add_expense(trip_id):
                 expense_date=expense_date,
                 trip_id=trip_id,
                 paid_by_id=payer.id,
-                proportions=json.dumps(weights), # Store weights as JSON string
                 category_id=category.id if category else None # Store category_id
             )
+            new_expense.set_weights(weights) # Store weights as expense shares
             db.add(new_expense)
+            # Update the balance ledger in the same transaction
+            participant_ids = {participant.id for participant in trip.participants}
+            ledger.apply_deltas(db, trip_id, ledger.expense_deltas(new_expense, participant_ids))
+            bump_trip_version(db, trip_id) # Invalidate the cached trip page
             db.commit()
+            category_suggestions.forget(description) # Its category may now be the suggested one
             flash("Expense added successfully!", 'success')
             # Use blueprint name in url_for
             return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
@@ -351,8 +459,8 @@ def add_expense(trip_id):
 @trip_blueprint.route('/<int:trip_id>/edit_expense/<int:expense_id>', methods=['GET', 'POST'])
 def edit_expense(trip_id, expense_id):
     """Handles editing an existing expense with weights and category."""
-    db = next(get_db())
-    trip = db.query(Trip).options(joinedload(Trip.participants)).get(trip_id)
+    db = get_db()
+    trip = load_trip(db, trip_id)
     if not trip:
         return "Trip not found", 404
 
@@ -361,9 +469,14 @@ def edit_expense(trip_id, expense_id):
         return "Expense not found", 404
 
     # Fetch all categories
-    categories = db.query(Category).order_by(Category.name).all()
+    categories = category_cache.get_categories(db)
 
     if request.method == 'POST':
+        # Remember what the expense contributed to the balances before it changes
+        participant_ids = {participant.id for participant in trip.participants}
+        balance_deltas = ledger.expense_deltas(expense_to_edit, participant_ids, sign=-1)
+        previous_description = expense_to_edit.description
+
         # Update expense details from form
         expense_to_edit.description = request.form['description']
         expense_to_edit.amount = float(request.form['amount'])
@@ -427,26 +540,31 @@ def edit_expense(trip_id, expense_id):
             expense_to_edit.category = None # Set category to None if no category is selected
 
 
-        expense_to_edit.proportions = json.dumps(updated_weights) # Update weights
+        expense_to_edit.set_weights(updated_weights) # Update weights
         expense_to_edit.last_modified = datetime.utcnow() # Update last modified timestamp
 
+        # Replace the old contribution with the new one in the balance ledger
+        db.flush() # Make sure paid_by_id reflects the new payer
+        ledger.expense_deltas(expense_to_edit, participant_ids, deltas=balance_deltas)
+        ledger.apply_deltas(db, trip_id, balance_deltas)
+        bump_trip_version(db, trip_id) # Invalidate the cached trip page
+
         db.commit()
+        # The category suggestions of both descriptions may have changed
+        category_suggestions.forget(previous_description, request.form['description'])
         flash("Expense updated successfully!", 'success')
         # Use blueprint name in url_for
         return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
     # For GET request, render the edit form
-    # Load weights from JSON string for display in the form (reusing proportions_dict name)
-    expense_to_edit.proportions_dict = json.loads(expense_to_edit.proportions) if expense_to_edit.proportions else {}
-
     return render_template('edit_expense.html', trip_id=trip_id, trip=trip, expense=expense_to_edit, categories=categories) # Passing categories
 
 
 @trip_blueprint.route('/<int:trip_id>/set_default_proportions', methods=['POST'])
 def set_default_proportions(trip_id):
     """Handles setting the default weights for a trip."""
-    db = next(get_db())
-    trip = db.query(Trip).options(joinedload(Trip.participants)).get(trip_id)
+    db = get_db()
+    trip = load_trip(db, trip_id)
     if not trip:
         return "Trip not found", 404
 
@@ -492,6 +610,7 @@ def set_default_proportions(trip_id):
         return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
 
+    bump_trip_version(db, trip_id) # Invalidate the cached trip page
     db.commit() # Commit all changes (deletions and additions)
     flash("Default weights updated successfully!", 'success')
 
@@ -501,8 +620,8 @@ def set_default_proportions(trip_id):
 @trip_blueprint.route('/<int:trip_id>/upload_pdf', methods=['POST'])
 def upload_pdf(trip_id):
     """Handles uploading and processing a PDF report."""
-    db = next(get_db())
-    trip = db.query(Trip).options(joinedload(Trip.participants)).get(trip_id)
+    db = get_db()
+    trip = load_trip(db, trip_id)
     if not trip:
         flash("Trip not found.", 'danger')
         return redirect(url_for('index')) # index is not in blueprint
@@ -520,82 +639,113 @@ def upload_pdf(trip_id):
         return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
     if pdf_file:
-        try:
-            # Process the PDF (mockup function)
-            extracted_expenses = process_pdf_report(pdf_file)
+        # Extraction and category guessing run in the background (see import_jobs.py);
+        # the progress page polls the job and opens the validation page when it is done
+        job_id = submit_import(db, trip_id, pdf_file.read(), filename=secure_filename(pdf_file.filename))
+        return redirect(url_for('trip_blueprint.import_progress', trip_id=trip_id, job_id=job_id))
 
-            if not extracted_expenses:
-                flash("No expenses extracted from the PDF.", 'warning')
-                # Use blueprint name in url_for
-                return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
-
-            # Attempt to guess categories for extracted expenses
-            for expense_data in extracted_expenses:
-                # Look for an existing expense with the same description (case-insensitive)
-                # and a defined category. Order by date added descending to prefer more recent assignments.
-                existing_expense_with_category = db.query(Expense).filter(
-                    func.lower(Expense.description) == func.lower(expense_data['description']),
-                    Expense.category_id.isnot(None)
-                ).order_by(desc(Expense.date_added)).first()
-
-                if existing_expense_with_category and existing_expense_with_category.category:
-                    # Assign the found category ID to the extracted expense data
-                    expense_data['category_id'] = existing_expense_with_category.category.id
-                    # Store the category name for display on the validation page
-                    expense_data['category_name'] = existing_expense_with_category.category.name
-                else:
-                    # If no matching expense with category is found, set category_id to None
-                    expense_data['category_id'] = None
-                    expense_data['category_name'] = 'Uncategorized' # Placeholder name for display
-
-
-            # Store extracted expenses (now with potential category_id) in the session for validation
-            session[f'extracted_expenses_{trip_id}'] = extracted_expenses
-            flash(f"PDF processed. {len(extracted_expenses)} expenses extracted. Please validate and assign categories.", 'info')
-
-            # Redirect to the validation page - Use blueprint name in url_for
-            return redirect(url_for('trip_blueprint.validate_expenses', trip_id=trip_id))
-
-        except Exception as e:
-            flash(f"Error processing PDF: {e}", 'danger')
-            # Log the error for debugging
-            # Ensure 'app' is accessible or log differently in a blueprint
-            # print(f"Error processing PDF for trip {trip_id}: {e}")
-            pass # Suppress logging for now if app is not available
+    flash("Error uploading file.", 'danger')
+    # Use blueprint name in url_for
+    return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
-        # Use blueprint name in url_for
+@trip_blueprint.route('/<int:trip_id>/import_statement', methods=['POST'])
+def import_statement(trip_id):
+    """Imports the expenses of a CSV or OFX bank statement, streamed and saved in chunks."""
+    db = get_db()
+    trip = load_trip(db, trip_id, participants=False)
+    if not trip:
+        flash("Trip not found.", 'danger')
+        return redirect(url_for('index'))
+
+    statement_file = request.files.get('statement_file')
+    if not statement_file or statement_file.filename == '':
+        flash("No selected file.", 'danger')
         return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
-    flash("Error uploading file.", 'danger')
-    # Use blueprint name in url_for
+    payer = None
+    try:
+        payer = db.query(Participant).filter_by(id=int(request.form.get('paid_by', '')), trip_id=trip_id).first()
+    except ValueError:
+        pass
+    if not payer:
+        flash("Please select a valid 'Paid By' participant for the statement.", 'danger')
+        return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
+
+    expense_sign = POSITIVE if request.form.get('expense_sign') == POSITIVE else NEGATIVE
+    try:
+        # The uploaded file is read from its spooled stream, never loaded whole
+        result = load_statement(db, trip_id, payer.id, statement_file.stream,
+                                filename=statement_file.filename, expense_sign=expense_sign)
+    except StatementError as e:
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), 400
+        flash(str(e), 'danger')
+        return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(result.as_dict()), 500 if result.error else 200
+
+    if result.error:
+        flash(f"The import stopped after {result.imported} expense(s) were saved: {result.error}", 'danger')
+    else:
+        flash(f"Successfully imported {result.imported} expense(s) from the statement.", 'success')
+    if result.ignored:
+        flash(f"{result.ignored} line(s) with the other sign (e.g. incoming payments) were ignored.", 'warning')
+    if result.skipped:
+        details = '; '.join(f"line {issue.row}: {issue.message}" for issue in result.issues[:MAX_REPORTED_ISSUES])
+        more = f" (and {result.skipped - MAX_REPORTED_ISSUES} more)" if result.skipped > MAX_REPORTED_ISSUES else ''
+        flash(f"{result.skipped} line(s) could not be read. {details}{more}", 'danger')
     return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
+@trip_blueprint.route('/<int:trip_id>/imports/<job_id>')
+def import_job_status(trip_id, job_id):
+    """Returns the progress of a background PDF import as JSON."""
+    db = get_db()
+    job = get_job(db, trip_id, job_id)
+    if not job:
+        return jsonify({'error': "Import not found."}), 404
+
+    status = job_status(job)
+    if job.status == DONE:
+        status['validate_url'] = url_for('trip_blueprint.validate_expenses', trip_id=trip_id, import_id=job.import_id)
+    return jsonify(status)
+
+@trip_blueprint.route('/<int:trip_id>/imports/<job_id>/progress')
+def import_progress(trip_id, job_id):
+    """Displays the progress of a background PDF import until it can be validated."""
+    db = get_db()
+    trip = load_trip(db, trip_id, participants=False)
+    job = get_job(db, trip_id, job_id) if trip else None
+    if not job:
+        flash("Import not found.", 'danger')
+        return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id) if trip else url_for('index'))
+
+    return render_template('import_progress.html', trip=trip, job=job)
+
 @trip_blueprint.route('/<int:trip_id>/validate_expenses', methods=['GET', 'POST'])
 def validate_expenses(trip_id):
     """Allows users to validate and adjust extracted expenses before saving."""
-    db = next(get_db())
-    trip = db.query(Trip).options(
-        joinedload(Trip.participants),
-        joinedload(Trip.participant_default_proportions).joinedload(TripParticipantDefaultProportion.participant)
-    ).get(trip_id)
+    db = get_db()
+    trip = load_trip(db, trip_id, default_proportions=True)
     if not trip:
         return "Trip not found", 404
 
     # Fetch all categories to display in the dropdown
-    categories = db.query(Category).order_by(Category.name).all()
+    categories = category_cache.get_categories(db)
 
     # Build a dictionary of default weights for easier access in the template
-    default_proportions_dict = {
-        str(dp.participant_id): dp.default_proportion # Renamed conceptually to weights
-        for dp in trip.participant_default_proportions
-    }
+    default_proportions_dict = default_weights(trip)
 
-    session_key = f'extracted_expenses_{trip_id}'
+    # Extracted expenses are staged server-side under this id (see import_staging.py)
+    import_id = request.values.get('import_id')
 
     if request.method == 'POST':
-        validated_expenses_data = []
+        participant_ids = {participant.id for participant in trip.participants}
         form_data = request.form
-        extracted_expenses_from_session = session.get(session_key, [])
+        staged_expenses = get_staged_import(db, trip_id, import_id)
+        if staged_expenses is None:
+            flash("This import has expired or was already saved. Please upload the PDF again.", 'warning')
+            return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
         # Get the single Paid By participant ID from the form
         paid_by_id_str = form_data.get('paid_by_all')
@@ -610,109 +760,56 @@ def validate_expenses(trip_id):
                 if not payer:
                     flash("Invalid Paid By participant selected for all expenses.", 'danger')
                     # Redirect back to validation page with error
-                    return redirect(url_for('trip_blueprint.validate_expenses', trip_id=trip_id))
+                    return redirect(url_for('trip_blueprint.validate_expenses', trip_id=trip_id, import_id=import_id))
             except ValueError:
                 flash("Invalid Paid By participant ID format.", 'danger')
                 # Redirect back to validation page with error
-                return redirect(url_for('trip_blueprint.validate_expenses', trip_id=trip_id))
+                return redirect(url_for('trip_blueprint.validate_expenses', trip_id=trip_id, import_id=import_id))
         else:
             flash("Please select a 'Paid By' participant for all expenses.", 'danger')
             # Redirect back to validation page with error
-            return redirect(url_for('trip_blueprint.validate_expenses', trip_id=trip_id))
-
-
-        # Process form data from the validation page
-        # Iterate based on the number of expenses originally extracted from session
-        for i in range(len(extracted_expenses_from_session)):
-            accept_key = f'accept_expense_{i}'
-            if form_data.get(accept_key) == 'on': # Check if the expense was accepted (checkbox is 'on')
-                # Retrieve original data from session using the index
-                original_expense_data = extracted_expenses_from_session[i]
-                description = original_expense_data.get('description')
-                amount = float(form_data.get(f'amount_{i}')) # Get amount from form in case it was edited (though not currently editable)
-                # Get the expense date string from the form
-                expense_date_str = form_data.get(f'expense_date_{i}')
-                # Get the category ID from the form for this expense
-                category_id_str = form_data.get(f'category_{i}')
-
-
-                # Get weights from the form for this specific expense
-                weights = {}
-                total_submitted_weight = 0
-                weights_valid = True
-                for participant in trip.participants:
-                    # Use the correct form field name format: proportion_expenseIndex_participantId (reusing name)
-                    weight_key = f'proportion_{i}_{participant.id}'
-                    if weight_key in form_data:
-                         try:
-                             weight_value = float(form_data[weight_key]) # Still allow float input here for flexibility if needed later
-                             if weight_value < 0:
-                                  flash(f"Weight for {participant.name} on expense '{description}' cannot be negative. Please enter a non-negative number. This expense will be skipped.", 'danger')
-                                  weights_valid = False # Mark weights as invalid
-                                  break # Exit participant loop for this expense
-                             weights[str(participant.id)] = weight_value
-                             total_submitted_weight += weight_value
-                         except ValueError:
-                             flash(f"Invalid weight value for {participant.name} on expense '{description}'. Please enter numbers only. This expense will be skipped.", 'danger')
-                             weights_valid = False # Mark weights as invalid
-                             break # Exit participant loop for this expense
-
-                if weights_valid: # Only process if weights were valid
-                    # Validation for weights: total weight can be 0, but not if there are participants
-                    if total_submitted_weight == 0 and len(trip.participants) > 0:
-                         flash(f"Total weight for expense '{description}' cannot be zero if there are participants. Please specify how the expense is split. This expense will be skipped.", 'danger')
-                         continue # Skip this expense
-
-                    try:
-                        # Parse the date string from the form
-                        expense_date = datetime.strptime(expense_date_str, '%Y-%m-%d')
-                    except ValueError:
-                        flash(f"Invalid date format '{expense_date_str}' for expense '{description}'. Expected YYYY-MM-DD. This expense will be skipped.", 'warning')
-                        continue # Skip this expense
-
-                    # Validate and set category_id for this expense
-                    expense_category_id = None
-                    if category_id_str:
-                         try:
-                             expense_category_id = int(category_id_str)
-                             # Optional: Verify if category_id exists
-                             category = db.query(Category).get(expense_category_id)
-                             if not category:
-                                  flash(f"Invalid category selected for expense '{description}'. This expense will be saved without a category.", 'warning')
-                                  expense_category_id = None # Set to None if category is invalid
-                         except ValueError:
-                              flash(f"Invalid category ID format for expense '{description}'. This expense will be saved without a category.", 'warning')
-                              expense_category_id = None # Set to None if ID format is invalid
-
-
-                    # Create the Expense object
-                    new_expense = Expense(
-                        description=description,
-                        amount=amount,
-                        expense_date=expense_date, # Use the date from the form
-                        trip_id=trip_id,
-                        paid_by_id=payer.id, # Use the single validated payer ID
-                        proportions=json.dumps(weights), # Store weights here
-                        category_id=expense_category_id, # Store category_id for this expense
-                        date_added=datetime.utcnow(),
-                        last_modified=datetime.utcnow()
-                    )
-                    db.add(new_expense)
-                    validated_expenses_data.append(new_expense) # Add to a list for success message count
+            return redirect(url_for('trip_blueprint.validate_expenses', trip_id=trip_id, import_id=import_id))
 
 
-        db.commit()
-        # Clear the extracted expenses from the session after saving
-        if session_key in session:
-            del session[session_key]
+        # Claim the staged import first, in the same transaction as the saved expenses:
+        # a double submit (or a second tab) finds nothing left to delete and saves nothing
+        if not discard_import(db, import_id):
+            db.rollback()
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({'error': "This import was already saved."}), 409
+            flash("This import was already saved.", 'warning')
+            return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
-        flash(f"Successfully added {len(validated_expenses_data)} validated expenses to the trip.", 'success')
+        # Validate all accepted rows (one query for their categories), then insert them in bulk
+        rows, issues = validate_rows(db, trip, staged_expenses, form_data)
+        expense_ids = insert_rows(db, trip_id, payer.id, rows, participant_ids)
+        bump_trip_version(db, trip_id) # Invalidate the cached trip page
+        db.commit()
+        category_suggestions.forget(*{row['description'] for row in rows})
+
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({
+                'saved': len(expense_ids),
+                'expense_ids': expense_ids,
+                'issues': [issue.as_dict() for issue in issues],
+            })
+
+        flash(f"Successfully added {len(expense_ids)} validated expenses to the trip.", 'success')
+        # One summary message for all the rows with problems, instead of one per row
+        skipped = [issue for issue in issues if issue.severity == ERROR]
+        uncategorized = [issue for issue in issues if issue.severity != ERROR]
+        if skipped:
+            details = '; '.join(f"'{issue.description}': {issue.message}" for issue in skipped[:MAX_REPORTED_ISSUES])
+            more = f" (and {len(skipped) - MAX_REPORTED_ISSUES} more)" if len(skipped) > MAX_REPORTED_ISSUES else ''
+            flash(f"{len(skipped)} expense(s) were skipped. {details}{more}", 'danger')
+        if uncategorized:
+            flash(f"{len(uncategorized)} expense(s) were saved without a category because their category was invalid.", 'warning')
         # Use blueprint name in url_for
         return redirect(url_for('trip_blueprint.view_trip', trip_id=trip_id))
 
 
     else: # GET request
-        extracted_expenses = session.get(session_key, [])
+        extracted_expenses = get_staged_import(db, trip_id, import_id)
         if not extracted_expenses:
             flash("No expenses found for validation. Please upload a PDF.", 'warning')
             # Use blueprint name in url_for
@@ -725,6 +822,7 @@ def validate_expenses(trip_id):
             trip_id=trip_id,
             trip=trip, # Pass the trip object to access participants
             extracted_expenses=extracted_expenses,
+            import_id=import_id,
             default_proportions=default_proportions_dict, # Passing default weights
             categories=categories # Pass categories to the template
         )
@@ -733,12 +831,20 @@ def validate_expenses(trip_id):
 @trip_blueprint.route('/<int:trip_id>/delete_expense/<int:expense_id>', methods=['POST'])
 def delete_expense(trip_id, expense_id):
     """Handles deleting a specific expense from a trip."""
-    db = next(get_db())
+    db = get_db()
     expense_to_delete = db.query(Expense).filter_by(id=expense_id, trip_id=trip_id).first()
 
     if expense_to_delete:
+        # Remove the expense's contribution from the balance ledger
+        balance_deltas = ledger.expense_deltas(expense_to_delete, ledger.trip_participant_ids(db, trip_id), sign=-1)
+        description = expense_to_delete.description
         db.delete(expense_to_delete)
+        # Tombstone for API clients syncing changes (see api_blueprint.py)
+        db.add(DeletedExpense(expense_id=expense_id, trip_id=trip_id))
+        ledger.apply_deltas(db, trip_id, balance_deltas)
+        bump_trip_version(db, trip_id) # Invalidate the cached trip page
         db.commit()
+        category_suggestions.forget(description)
         flash("Expense deleted successfully!", 'success')
     else:
         flash("Expense not found.", 'danger')
@@ -751,14 +857,14 @@ def delete_expense(trip_id, expense_id):
 @trip_blueprint.route('/categories')
 def list_categories():
     """Lists all available expense categories."""
-    db = next(get_db())
-    categories = db.query(Category).order_by(Category.name).all()
+    db = get_db()
+    categories = category_cache.get_categories(db)
     return render_template('list_categories.html', categories=categories)
 
 @trip_blueprint.route('/categories/add', methods=['GET', 'POST'])
 def add_category():
     """Handles adding a new expense category."""
-    db = next(get_db())
+    db = get_db()
     if request.method == 'POST':
         category_name = request.form['category_name'].strip()
         if category_name:
@@ -769,6 +875,7 @@ def add_category():
             else:
                 new_category = Category(name=category_name)
                 db.add(new_category)
+                category_cache.invalidate(db) # The category lists of every worker are stale
                 db.commit()
                 flash(f"Category '{category_name}' added successfully!", 'success')
                 return redirect(url_for('trip_blueprint.list_categories'))
@@ -780,7 +887,7 @@ def add_category():
 @trip_blueprint.route('/categories/delete/<int:category_id>', methods=['POST'])
 def delete_category(category_id):
     """Handles deleting an expense category."""
-    db = next(get_db())
+    db = get_db()
     category_to_delete = db.query(Category).get(category_id)
 
     if category_to_delete:
@@ -788,7 +895,11 @@ def delete_category(category_id):
         # This prevents a foreign key constraint error
         db.query(Expense).filter_by(category_id=category_id).update({Expense.category_id: None})
         db.delete(category_to_delete)
+        # The category lists and, since expenses of every trip may have lost their category, all cached trip pages are stale
+        category_cache.invalidate(db, deleted=True)
         db.commit()
+        # Cached suggestions may point to the deleted category
+        category_suggestions.invalidate()
         flash(f"Category '{category_to_delete.name}' deleted successfully. Expenses previously in this category are now uncategorized.", 'success')
     else:
         flash("Category not found.", 'danger')
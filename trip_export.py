@@ -0,0 +1,205 @@
+import io
+import os
+import csv
+import tempfile
+from itertools import groupby
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from database import Participant, Expense, ExpenseShare, Category
+from ledger import split_deltas, get_trip_balances
+from pagination import keyset_order
+import trip_archive
+
+# Streaming exports of a trip (CSV and XLSX).
+#
+# Expenses are read with one query (expenses joined with their payer,
+# category and shares, in the order of the trip page) on a server-side
+# cursor, fetched EXPORT_BATCH_SIZE rows at a time, and each expense is
+# written as soon as its shares have been read. Shares are resolved to
+# amounts with the split rules of the ledger (ledger.split_deltas), so an
+# exported expense adds up exactly like it does in the balances. Balances and
+# transactions are read from the ledger (ledger.get_trip_balances), which
+# gives the same result as utils.calculate_balances without loading the
+# trip's expenses. Archived trips are read from their snapshot instead (see
+# trip_archive.py).
+#
+# The generators below never hold more than one batch of rows: CSV is
+# written to the response in pieces of about CSV_CHUNK_SIZE characters, XLSX
+# goes through openpyxl's write-only mode to a temporary file which is then
+# sent in pieces (a zip archive cannot be sent before it is complete).
+# openpyxl is optional; without it only the CSV exports are available.
+
+# Rows fetched per round trip from the database cursor
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+# Characters of CSV buffered before they are sent
+CSV_CHUNK_SIZE = 64 * 1024
+# Bytes of the XLSX file sent at a time
+XLSX_CHUNK_SIZE = 64 * 1024
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+# True when openpyxl is installed
+XLSX_AVAILABLE = Workbook is not None
+
+# Exported amounts are rounded to cents
+AMOUNT_DECIMALS = 2
+# Tables of a trip export, in the order of the XLSX sheets
+EXPORT_TABLES = ('expenses', 'balances', 'transactions')
+
+# Spreadsheets run cells starting with these characters as formulas
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _text(value):
+    """Escapes text cells that a spreadsheet would read as a formula (e.g. a description starting with '=')."""
+    if value and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def trip_participants(db, trip_id):
+    """Returns the (id, name) of the trip's participants, in the order of the share columns."""
+    return db.query(Participant.id, Participant.name).filter(Participant.trip_id == trip_id).order_by(Participant.id).all()
+
+
+def _live_expenses(db, trip_id):
+    """Yields (id, date, description, amount, payer id, payer name, category name, weights) of a trip's expenses, most recent first."""
+    payer = aliased(Participant)
+    statement = (
+        # The order of the trip page
+        keyset_order(
+            select(
+                Expense.id, Expense.expense_date, Expense.description, Expense.amount, Expense.paid_by_id,
+                payer.name, Category.name, ExpenseShare.participant_id, ExpenseShare.weight,
+            )
+            .outerjoin(payer, payer.id == Expense.paid_by_id)
+            .outerjoin(Category, Category.id == Expense.category_id)
+            .outerjoin(ExpenseShare, ExpenseShare.expense_id == Expense.id)
+            .where(Expense.trip_id == trip_id)
+        )
+        # Server-side cursor on PostgreSQL, batches of EXPORT_BATCH_SIZE rows everywhere
+        .execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE)
+    )
+    result = db.execute(statement)
+    try:
+        # Rows of the same expense are consecutive, one per share
+        for expense_id, rows in groupby(result, key=lambda row: row[0]):
+            rows = list(rows)
+            _, expense_date, description, amount, paid_by_id, payer_name, category_name, _, _ = rows[0]
+            weights = {participant_id: weight for *_, participant_id, weight in rows if participant_id is not None}
+            yield expense_id, expense_date, description, amount, paid_by_id, payer_name, category_name, weights
+    finally:
+        result.close()
+
+
+def _archived_expenses(snapshot, participants):
+    """Same as _live_expenses, from the snapshot of an archived trip."""
+    names = dict(participants)
+    for expense in trip_archive.iter_expenses(snapshot):
+        yield (expense.id, expense.expense_date, expense.description, expense.amount, expense.paid_by_id,
+               names.get(expense.paid_by_id), expense.category.name if expense.category else None, expense.weights)
+
+
+def expense_rows(db, trip_id, participants, snapshot=None):
+    """
+    Yields the header, then one row per expense of the trip (most recent first):
+    id, date, description, amount, payer, category and the amount owed by
+    each participant (one column per participant). Archived trips are read
+    from their snapshot.
+    """
+    participant_ids = {participant_id for participant_id, _ in participants}
+    yield ['ID', 'Date', 'Description', 'Amount', 'Paid by', 'Category'] + [f"Share of {name}" for _, name in participants]
+
+    expenses = _archived_expenses(snapshot, participants) if snapshot is not None else _live_expenses(db, trip_id)
+    for expense_id, expense_date, description, amount, paid_by_id, payer_name, category_name, weights in expenses:
+        deltas = split_deltas(amount or 0.0, paid_by_id, weights, participant_ids)
+        yield [
+            expense_id,
+            expense_date.strftime('%Y-%m-%d') if expense_date else None,
+            _text(description),
+            amount,
+            _text(payer_name),
+            _text(category_name),
+        ] + [round(deltas.get(participant_id, (0.0, 0.0))[1], AMOUNT_DECIMALS) for participant_id, _ in participants]
+
+
+def balance_rows(balances):
+    """Yields the header, then the balance of each participant (positive when they are owed money)."""
+    yield ['Participant', 'Balance']
+    for name, balance in balances.items():
+        yield [_text(name), round(balance, AMOUNT_DECIMALS)]
+
+
+def transaction_rows(transactions):
+    """Yields the header, then the transfers settling the balances."""
+    yield ['From', 'To', 'Amount']
+    for transaction in transactions:
+        yield [_text(transaction['from']), _text(transaction['to']), round(transaction['amount'], AMOUNT_DECIMALS)]
+
+
+def export_tables(db, trip_id, names=EXPORT_TABLES):
+    """
+    Returns {name: rows} for the requested tables of a trip, each rows
+    iterator starting with its header. Balances and transactions are read
+    from the ledger here; expenses are only read as their rows are consumed.
+    """
+    unknown = set(names) - set(EXPORT_TABLES)
+    if unknown:
+        raise ValueError(f"Unknown export tables: {', '.join(sorted(unknown))}")
+
+    tables = {}
+    snapshot = trip_archive.get_snapshot(db, trip_id)
+    if 'balances' in names or 'transactions' in names:
+        # Archived trips: as they were when the trip was archived
+        balances, transactions = trip_archive.frozen_settlement(snapshot) if snapshot is not None else get_trip_balances(db, trip_id)
+    for name in names:
+        if name == 'expenses':
+            tables[name] = expense_rows(db, trip_id, trip_participants(db, trip_id), snapshot)
+        elif name == 'balances':
+            tables[name] = balance_rows(balances)
+        else:
+            tables[name] = transaction_rows(transactions)
+    return tables
+
+
+def iter_csv(rows):
+    """Writes rows as CSV, yielding the text in pieces of about CSV_CHUNK_SIZE characters."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CSV_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_xlsx(tables):
+    """
+    Writes {sheet name: rows} as an XLSX workbook, one sheet per table, and yields the file in pieces.
+
+    Raises RuntimeError if openpyxl is not installed.
+    """
+    if Workbook is None:
+        raise RuntimeError("XLSX export requires openpyxl.")
+
+    # Write-only sheets keep their rows in temporary files, not in memory
+    workbook = Workbook(write_only=True)
+    for title, rows in tables.items():
+        sheet = workbook.create_sheet(title=title.capitalize())
+        for row in rows:
+            sheet.append(row)
+
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            chunk = output.read(XLSX_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,149 @@
+import os
+import hashlib
+from flask import render_template
+from markupsafe import Markup
+from sqlalchemy import func
+from database import Expense
+import ledger
+import search
+import view_models
+import trip_archive
+from caching import LRUCache, get_versions, trip_key, CATEGORIES_KEY
+from loaders import load_trip, default_weights, expense_listing_query
+from pagination import paginate_expenses
+from stats import category_totals
+
+# Cached trip page.
+#
+# The expensive parts of the trip page (participants, balances, transactions
+# and the expense table) are rendered as fragments and cached in-process
+# together with the chart data. Entries are keyed by the trip's version and
+# the categories version (see caching.py), which the mutating routes bump, and
+# by the page's query arguments. The same key gives the page its ETag, so a
+# reload of an unchanged trip costs one version query (and a 304 when the
+# browser already has the page).
+#
+# Archived trips have no expense rows: their page is built from the trip's
+# snapshot (see trip_archive.py), with the same fragments in read-only mode.
+
+# Number of trip pages (one per trip, version and query arguments) kept in memory
+TRIP_PAGE_CACHE_SIZE = int(os.environ.get("TRIP_PAGE_CACHE_SIZE", 512))
+
+FRAGMENT_TEMPLATES = {
+    'participants': '_trip_participants.html',
+    'balances': '_trip_balances.html',
+    'transactions': '_trip_transactions.html',
+    'expenses': '_trip_expenses.html',
+    'statement_import': '_trip_statement_import.html',
+}
+
+_page_cache = LRUCache(TRIP_PAGE_CACHE_SIZE)
+
+
+def _templates_digest():
+    """Digest of the page's templates, so that ETags change when a deploy changes the markup."""
+    digest = hashlib.sha1()
+    template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    for name in sorted(['view_trip.html', *FRAGMENT_TEMPLATES.values()]):
+        with open(os.path.join(template_dir, name), 'rb') as template:
+            digest.update(template.read())
+    return digest.hexdigest()[:12]
+
+
+_TEMPLATES_DIGEST = _templates_digest()
+
+
+def page_key(db, trip_id, search_query, cursor, start_date, end_date):
+    """Cache key of a trip page: the trip and categories versions (one query) and the page's arguments."""
+    versions = get_versions(db, [trip_key(trip_id), CATEGORIES_KEY])
+    return (
+        trip_id, versions[trip_key(trip_id)], versions[CATEGORIES_KEY],
+        search_query or '', cursor or '',
+        start_date.isoformat() if start_date else '', end_date.isoformat() if end_date else '',
+    )
+
+
+def page_etag(key):
+    return hashlib.sha1(repr((_TEMPLATES_DIGEST, key)).encode()).hexdigest()
+
+
+def build_page(db, trip_id, search_query, cursor, start_date, end_date, start_date_str, end_date_str):
+    """
+    Computes the trip page's data and renders its fragments.
+
+    Returns a dictionary with trip_name, archived_at (None for live trips),
+    category_expenses_list and the rendered fragments, or None if the trip
+    does not exist.
+    """
+    # Fetch the trip with participants, default proportions and its snapshot if it is archived;
+    # expenses are queried page by page below
+    trip = load_trip(db, trip_id, default_proportions=True, snapshot=True)
+    if not trip:
+        return None
+
+    snapshot = trip.snapshot
+    if snapshot is not None:
+        # One pass over the snapshot: the page of expenses, their total and the chart data
+        page_expenses, next_cursor, total_expenses, category_expenses_list = trip_archive.archived_page(
+            snapshot, search_query, cursor, start_date, end_date
+        )
+        # Balances and transactions as they were when the trip was archived
+        balances, transactions = trip_archive.frozen_settlement(snapshot)
+    else:
+        # Filter expenses by description if a search query is provided (uses the database's search index)
+        expense_filters = [Expense.trip_id == trip_id]
+        if search_query:
+            expense_filters.append(search.match_filter(search_query))
+
+        # Fetch one page of the filtered expenses, with payer, category and weights
+        expenses_query = expense_listing_query(db).filter(*expense_filters)
+        page_expenses, next_cursor = paginate_expenses(expenses_query, cursor)
+
+        # Calculate total based on all filtered expenses (not only this page) for the table header
+        total_expenses = db.query(func.coalesce(func.sum(Expense.amount), 0)).filter(*expense_filters).scalar()
+
+        # A list of {"category", "amount"} dictionaries for the chart (based on the date filter), largest first
+        category_expenses_list = category_totals(db, trip_id, start_date, end_date)
+
+        # Read balances and transactions from the ledger (covers all expenses, not filtered ones)
+        balances, transactions = ledger.get_trip_balances(db, trip.id)
+
+    # Prepare the expense rows (payer and share names resolved, values formatted) grouped by month and year
+    # (the page is already sorted most recent first, so each month is contiguous)
+    names = view_models.participant_names(trip.participants)
+    expense_groups = view_models.expense_groups(page_expenses, names)
+
+    # The fragments only iterate over view models (see view_models.py)
+    context = dict(
+        trip_id=trip.id,
+        total_expenses='%.2f' % total_expenses, # Total for the expenses shown in the table (filtered by search)
+        participants=view_models.participant_views(trip.participants, default_weights(trip)),
+        balances=view_models.balance_views(balances),
+        transactions=view_models.transaction_views(transactions),
+        search_query=search_query,
+        expense_groups=expense_groups,
+        cursor=cursor, # Current page cursor (None on the first page)
+        next_cursor=next_cursor, # Cursor of the next page, for the "load more" link
+        start_date=start_date_str,
+        end_date=end_date_str,
+        archived=snapshot is not None, # Archived trips are read-only
+    )
+    return {
+        'trip_name': trip.name,
+        'archived_at': snapshot.archived_at if snapshot is not None else None,
+        'category_expenses_list': category_expenses_list,
+        'fragments': {
+            name: Markup(render_template(template, **context))
+            for name, template in FRAGMENT_TEMPLATES.items()
+        },
+    }
+
+
+def get_page(db, key, trip_id, search_query, cursor, start_date, end_date, start_date_str, end_date_str):
+    """Returns the cached page for key, building and caching it on a miss (None if the trip does not exist)."""
+    page = _page_cache.get(key)
+    if page is None:
+        page = build_page(db, trip_id, search_query, cursor, start_date, end_date, start_date_str, end_date_str)
+        if page is not None:
+            _page_cache.put(key, page)
+    return page
@@ -0,0 +1,98 @@
+from itertools import groupby
+
+# View models of the trip page.
+#
+# Everything the trip page templates display is prepared here in one pass:
+# participants are indexed by id once, so each expense's share list is
+# resolved with dictionary lookups instead of a scan of the participants per
+# weight, and amounts and dates are formatted up front. The templates
+# (_trip_*.html) only iterate over the results.
+
+
+# Heading of the expenses without a date in the expense table
+NO_DATE_GROUP = 'No date'
+
+
+class ParticipantView:
+    """A participant of the trip page, with its default weight."""
+    __slots__ = ('id', 'name', 'avatar', 'initial', 'default_weight')
+
+    def __init__(self, participant, default_weight):
+        self.id = participant.id
+        self.name = participant.name
+        self.avatar = participant.avatar_url # Emoji, if any
+        self.initial = participant.name[0].upper() if participant.name else ''
+        self.default_weight = '%.0f' % default_weight # Weights are shown as integers
+
+
+class ExpenseView:
+    """A row of the expense table."""
+    __slots__ = ('id', 'description', 'amount', 'payer_name', 'category_name', 'shares',
+                 'expense_date', 'date_added', 'last_modified')
+
+    def __init__(self, expense, participant_names):
+        self.id = expense.id
+        self.description = expense.description
+        self.amount = '%.2f' % expense.amount
+        self.payer_name = participant_names.get(expense.paid_by_id, '')
+        self.category_name = expense.category.name if expense.category else 'Uncategorized'
+        # (participant name, weight) pairs; weights of participants no longer in the trip are left out
+        self.shares = [
+            (participant_names[share.participant_id], '%.0f' % share.weight)
+            for share in expense.shares
+            if share.participant_id in participant_names
+        ]
+        self.expense_date = _format_date(expense.expense_date, '%Y-%m-%d')
+        self.date_added = _format_date(expense.date_added, '%Y-%m-%d %H:%M')
+        self.last_modified = _format_date(expense.last_modified, '%Y-%m-%d %H:%M')
+
+
+def _format_date(value, date_format):
+    # Legacy expenses may have no date
+    return value.strftime(date_format) if value is not None else ''
+
+
+class BalanceView:
+    """A participant's balance: 'owed' (positive), 'owes' (negative) or 'settled'."""
+    __slots__ = ('name', 'state', 'amount')
+
+    def __init__(self, name, balance):
+        self.name = name
+        self.state = 'owed' if balance > 0 else 'owes' if balance < 0 else 'settled'
+        self.amount = '%.2f' % abs(balance)
+
+
+def participant_names(participants):
+    """Lookup map of participant names by id."""
+    return {participant.id: participant.name for participant in participants}
+
+
+def participant_views(participants, default_weights):
+    """ParticipantViews of the participants; default_weights is keyed by participant id (string), as loaders.default_weights returns."""
+    return [ParticipantView(participant, default_weights.get(str(participant.id), 0)) for participant in participants]
+
+
+def expense_groups(expenses, names):
+    """
+    Groups expenses sorted most recent first into (month and year, [ExpenseView]) pairs.
+    Expenses without a date (listed last) are grouped under NO_DATE_GROUP.
+
+    names is the participant_names map of the trip.
+    """
+    return [
+        (month_year, [ExpenseView(expense, names) for expense in expenses_in_month])
+        for month_year, expenses_in_month in groupby(expenses, key=lambda expense: _format_date(expense.expense_date, '%B %Y') or NO_DATE_GROUP)
+    ]
+
+
+def balance_views(balances):
+    """BalanceViews of a {participant name: balance} dictionary."""
+    return [BalanceView(name, balance) for name, balance in balances.items()]
+
+
+def transaction_views(transactions):
+    """Settlement transactions with their amounts formatted."""
+    return [
+        {'from': transaction['from'], 'to': transaction['to'], 'amount': '%.2f' % transaction['amount']}
+        for transaction in transactions
+    ]